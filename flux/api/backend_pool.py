@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BackendError(Exception):
+    """SD 后端请求失败（连接错误、超时、HTTP 错误等），用于区分后端故障与任务本身的错误"""
+    pass
+
+
+class SDBackend:
+    def __init__(self, url, max_concurrency=1, name=None):
+        self.url = url.rstrip('/')
+        self.name = name or self.url
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.active = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0
+        self.last_error = None
+        self.total_tasks = 0
+        self.total_failures = 0
+        # 后端当前加载的模型，未知时为 None
+        self.loaded_model = None
+
+    @property
+    def load(self):
+        return self.active / self.max_concurrency
+
+    def is_available(self, now):
+        if self.active >= self.max_concurrency:
+            return False
+        # 不健康的后端在冷却期结束后允许再试一次（半开状态）
+        return self.healthy or now >= self.unhealthy_until
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "url": self.url,
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "healthy": self.healthy,
+            "consecutive_failures": self.consecutive_failures,
+            "total_tasks": self.total_tasks,
+            "total_failures": self.total_failures,
+            "last_error": self.last_error,
+            "loaded_model": self.loaded_model,
+        }
+
+
+def checkpoint_name(value):
+    """去掉 LoRA 后缀以及 WebUI 附加的子目录、哈希和扩展名，用于比较两个模型名是否指向同一个模型"""
+    name = (value or '').split('<lora:')[0].split(' [')[0].strip().replace('\\', '/').rsplit('/', 1)[-1]
+    if name.endswith(('.safetensors', '.ckpt')):
+        name = os.path.splitext(name)[0]
+    return name
+
+
+class BackendPool:
+    """SD 后端池：按并发上限和健康状态，将任务分派给负载最低的后端"""
+
+    def __init__(self, backends, failure_threshold=3, cooldown_seconds=60):
+        if not backends:
+            raise ValueError("至少需要配置一个 SD 后端")
+        self.backends = backends
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+
+    @property
+    def total_capacity(self):
+        return sum(b.max_concurrency for b in self.backends)
+
+    def acquire(self, timeout=0):
+        """选出负载最低的可用后端并占用一个并发槽位
+
+        timeout 为 0 时立即返回，为 None 时一直等待，超时仍无可用后端则返回 None
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while True:
+                backend = self._pick(time.time())
+                if backend is not None:
+                    backend.active += 1
+                    backend.total_tasks += 1
+                    return backend
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                # 不健康后端的冷却期到期不会触发通知，因此最多等待 1 秒后重新检查
+                self._slot_freed.wait(1 if remaining is None else min(remaining, 1))
+
+    def _pick(self, now):
+        candidates = [b for b in self.backends if b.is_available(now)]
+        if not candidates:
+            return None
+        # 优先健康的后端，其次负载最低，最后按累计任务数均衡
+        return min(candidates, key=lambda b: (not b.healthy, b.load, b.total_tasks))
+
+    def release(self, backend, success=True, error=None):
+        with self._lock:
+            backend.active = max(0, backend.active - 1)
+            if success:
+                self._mark_healthy(backend)
+            else:
+                self._mark_failure(backend, error)
+            self._slot_freed.notify_all()
+
+    def cancel(self, backend):
+        """归还已占用但未使用的槽位，不影响健康状态和统计"""
+        with self._lock:
+            backend.active = max(0, backend.active - 1)
+            backend.total_tasks = max(0, backend.total_tasks - 1)
+            self._slot_freed.notify_all()
+
+    @property
+    def active_count(self):
+        with self._lock:
+            return sum(b.active for b in self.backends)
+
+    def has_capacity(self):
+        now = time.time()
+        with self._lock:
+            return any(b.is_available(now) for b in self.backends)
+
+    def _mark_healthy(self, backend):
+        if not backend.healthy:
+            logger.info(f"SD 后端恢复健康: {backend.name}")
+        backend.healthy = True
+        backend.consecutive_failures = 0
+        backend.unhealthy_until = 0
+
+    def _mark_failure(self, backend, error):
+        backend.consecutive_failures += 1
+        backend.total_failures += 1
+        backend.last_error = str(error) if error else None
+        # 后端可能已重启或被手动切换模型，下次使用前重新查询
+        backend.loaded_model = None
+        if backend.consecutive_failures >= self.failure_threshold:
+            if backend.healthy:
+                logger.warning(f"SD 后端连续失败 {backend.consecutive_failures} 次，标记为不健康: {backend.name}")
+            backend.healthy = False
+            backend.unhealthy_until = time.time() + self.cooldown_seconds
+
+    def check_health(self, probe):
+        """对不健康的后端执行探测，probe(backend) 返回 True 表示后端可用"""
+        for backend in self.backends:
+            if backend.healthy:
+                continue
+            try:
+                ok = probe(backend)
+            except Exception as e:
+                ok = False
+                logger.debug(f"SD 后端健康检查失败: {backend.name}, {str(e)}")
+            with self._lock:
+                if ok:
+                    self._mark_healthy(backend)
+                    self._slot_freed.notify_all()
+                else:
+                    backend.unhealthy_until = time.time() + self.cooldown_seconds
+
+    def snapshot(self):
+        with self._lock:
+            return [b.to_dict() for b in self.backends]
+
+
+def load_backends(config, default_url, default_concurrency=1):
+    """从 config.json 的 sd_backends 或环境变量 SD_URLS 构建后端列表，均未配置时回退到 SD_URL"""
+    backends = []
+    for item in config.get('sd_backends', []) or []:
+        if isinstance(item, str):
+            backends.append(SDBackend(item, default_concurrency))
+        elif item.get('url') and item.get('enabled', True):
+            backends.append(SDBackend(item['url'], item.get('max_concurrency', default_concurrency), item.get('name')))
+
+    if not backends:
+        for url in os.getenv('SD_URLS', '').split(','):
+            if url.strip():
+                backends.append(SDBackend(url.strip(), default_concurrency))
+
+    if not backends:
+        backends.append(SDBackend(default_url, default_concurrency))
+    return backends
+
+
+def start_health_checker(pool, probe, interval_seconds):
+    def run():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                pool.check_health(probe)
+            except Exception as e:
+                logger.error(f"SD 后端健康检查出错: {str(e)}")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    logger.info(f"Started SD backend health checker. Checking every {interval_seconds} second(s).")
@@ -11,6 +11,7 @@ import sys
 # import fc
 import subprocess
 import shutil
+from image_store import ImageStore
 
 
 # 加载 .env 文件中的环境变量
@@ -60,6 +61,10 @@ MAX_BACKUPS = int(os.getenv('MAX_BACKUPS', 5))
 BACKUP_DIR = os.path.dirname(BACKUP_DB)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
+# 历史图片按内容哈希保存在 IMAGE_STORE_DIR 中，数据库只保存 key，需要与数据库一起备份
+IMAGE_STORE_DIR = os.getenv('IMAGE_STORE_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'images', 'store'))
+IMAGE_STORE_BACKUP_DIR = os.getenv('IMAGE_STORE_BACKUP_DIR') or os.path.join(BACKUP_DIR, 'image_store')
+
 # 确保所有必要的目录都存在
 os.makedirs(os.path.dirname(ORIGINAL_DB), exist_ok=True)
 os.makedirs(os.path.dirname(BACKUP_DB), exist_ok=True)
@@ -127,6 +132,60 @@ def backup_database():
     logger.info("数据库备份成功完成")
     return backup_file
 
+def backup_image_store():
+    """把历史图片存储增量复制到 IMAGE_STORE_BACKUP_DIR
+
+    存储中的文件以内容哈希命名、写入后不再修改，因此只复制备份目录中还没有的文件。
+    在数据库备份之后执行，备份数据库中引用的图片此时都已写入存储。
+    """
+    logger.info(f"开始备份图片存储: {IMAGE_STORE_DIR} -> {IMAGE_STORE_BACKUP_DIR}")
+    if not os.path.isdir(IMAGE_STORE_DIR):
+        logger.warning(f"图片存储目录不存在，跳过: {IMAGE_STORE_DIR}")
+        return True
+    copied = 0
+    try:
+        for dirpath, _, filenames in os.walk(IMAGE_STORE_DIR):
+            for name in filenames:
+                # 跳过正在写入的临时文件
+                if name.endswith('.tmp'):
+                    continue
+                src = os.path.join(dirpath, name)
+                dest = os.path.join(IMAGE_STORE_BACKUP_DIR, os.path.relpath(src, IMAGE_STORE_DIR))
+                if os.path.exists(dest):
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(src, dest + '.tmp')
+                os.replace(dest + '.tmp', dest)
+                copied += 1
+    except OSError as e:
+        logger.error(f"备份图片存储时发生错误: {str(e)}")
+        return False
+    logger.info(f"图片存储备份完成，新复制 {copied} 个文件")
+    return True
+
+def verify_image_store(backup_db):
+    """检查备份数据库引用的图片在备份的图片存储中都存在"""
+    logger.info("开始检查备份的图片存储")
+    conn = sqlite3.connect(backup_db)
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(image)")}
+        keys = set()
+        for column in ('image_key', 'thumb_key'):
+            if column in columns:
+                keys.update(row[0] for row in conn.execute(f"SELECT {column} FROM image WHERE {column} IS NOT NULL"))
+    finally:
+        conn.close()
+
+    source, backup = ImageStore(IMAGE_STORE_DIR), ImageStore(IMAGE_STORE_BACKUP_DIR)
+    missing = [key for key in keys if not backup.exists(key)]
+    # 备份之后才被删除的图片在原存储中也已不存在，不算备份失败
+    lost = [key for key in missing if source.exists(key)]
+    logger.info(f"备份数据库引用 {len(keys)} 个图片文件，备份中缺少 {len(missing)} 个，其中原存储中仍存在 {len(lost)} 个")
+    if lost:
+        logger.error(f"备份的图片存储不完整，例如: {', '.join(lost[:5])}")
+        return False
+    return True
+
 def verify_integrity():
     logger.info("开始进行数据库完整性检查")
     conn = sqlite3.connect(BACKUP_DB)
@@ -276,7 +335,8 @@ def verify_backup(backup_file):
         ("完整性检查", lambda: check_database_integrity(backup_file)),
         ("记录数比较", lambda: compare_record_counts(ORIGINAL_DB, backup_file)),
         ("校验和比较", lambda: compare_checksums(ORIGINAL_DB, backup_file)),
-        ("恢复测试", lambda: test_restore(backup_file))
+        ("恢复测试", lambda: test_restore(backup_file)),
+        ("图片存储检查", lambda: verify_image_store(backup_file))
     ]
     
     for check_name, check_func in checks:
@@ -297,7 +357,7 @@ def backup_and_verify():
     logger.info(f"开始备份和验证过程，最大重试次数: {MAX_RETRIES}")
     for attempt in range(MAX_RETRIES):
         backup_file = backup_database()
-        if backup_file and verify_backup(backup_file):
+        if backup_file and backup_image_store() and verify_backup(backup_file):
             logger.info("备份和验证成功完成")
             cleanup_old_backups()
             return
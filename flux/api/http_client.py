@@ -0,0 +1,27 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def create_session(pool_size=10, retries=2, backoff_factor=0.5, verify=True):
+    """创建复用连接的 requests.Session，连接池大小为 pool_size
+
+    连接失败时（请求尚未发出）对所有方法重试；收到 502/503/504 或读取失败时只重试
+    GET 等幂等请求，避免重复提交 txt2img、img2img 这类耗时的生成请求。
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['HEAD', 'GET', 'OPTIONS']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.verify = verify
+    return session
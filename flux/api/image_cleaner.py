@@ -1,42 +1,169 @@
 import os
 import shutil
-from datetime import datetime, timedelta
+import sqlite3
 import threading
 import time
 import logging
 
 logger = logging.getLogger(__name__)
 
-def delete_old_images(output_dir, interval_minutes, retention_hours):
+# 每次从索引中取出的过期条目数
+BATCH_SIZE = 500
+
+
+class ImageExpiryIndex:
+    """生成图片目录的过期索引（SQLite），保存图片时写入，清理器只读取已过期的条目
+
+    条目以相对于输出目录的路径（通常是任务 ID）为 key，同一目录只记录第一次写入时的过期时间。
+    清理统计保存在 meta 表中，多个进程共用同一个数据库文件时都能读到。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute('PRAGMA synchronous=NORMAL;')
+        self._conn.execute("CREATE TABLE IF NOT EXISTS expiry (path TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_expiry_expires_at ON expiry (expires_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def register(self, name, retention_seconds, created_at=None):
+        """记录 name 在 created_at + retention_seconds 后过期；已记录的条目保持原过期时间"""
+        expires_at = (time.time() if created_at is None else created_at) + retention_seconds
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO expiry (path, expires_at) VALUES (?, ?)", (name, expires_at))
+            self._conn.commit()
+
+    def expired(self, limit, now=None):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM expiry WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                (time.time() if now is None else now, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, names):
+        with self._lock:
+            self._conn.executemany("DELETE FROM expiry WHERE path = ?", [(name,) for name in names])
+            self._conn.commit()
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            rows = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchall()
+        return rows[0][0] if rows else default
+
+    def update_meta(self, values, increments=None):
+        with self._lock:
+            for key, value in values.items():
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+            for key, value in (increments or {}).items():
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + excluded.value",
+                    (key, value)
+                )
+            self._conn.commit()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            indexed, pending = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(expires_at <= ?), 0) FROM expiry", (now,)
+            ).fetchall()[0]
+            meta = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+        return {
+            "indexed": indexed,
+            "expired_pending": pending,
+            "deleted_total": int(meta.get('deleted_total', 0)),
+            "missing_total": int(meta.get('missing_total', 0)),
+            "errors_total": int(meta.get('errors_total', 0)),
+            "last_run": float(meta['last_run']) if 'last_run' in meta else None,
+            "last_run_deleted": int(meta.get('last_run_deleted', 0)),
+            "last_run_seconds": float(meta.get('last_run_seconds', 0)),
+            "bootstrapped": meta.get('bootstrapped') == '1'
+        }
+
+
+def bootstrap_index(index, output_dir, retention_seconds):
+    """首次启用索引时登记输出目录中已有的条目（按修改时间计算过期时间），之后不再扫描目录"""
+    if index.get_meta('bootstrapped') == '1':
+        return
+    count = 0
+    if os.path.isdir(output_dir):
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                try:
+                    index.register(entry.name, retention_seconds, created_at=entry.stat().st_mtime)
+                    count += 1
+                except OSError as e:
+                    logger.error(f"Error indexing existing entry {entry.path}: {str(e)}")
+    index.update_meta({'bootstrapped': 1})
+    logger.info(f"Indexed {count} existing entries in {output_dir} for expiry")
+
+
+def delete_expired_images(index, output_dir, max_deletes_per_second=0):
+    """删除索引中已过期的目录或文件，max_deletes_per_second 大于 0 时限制删除速率；返回删除数量"""
+    started = time.time()
+    delay = 1.0 / max_deletes_per_second if max_deletes_per_second > 0 else 0
+    deleted = missing = errors = 0
     while True:
-        try:
-            current_time = datetime.now()
-            cutoff_time = current_time - timedelta(hours=retention_hours)
-            
-            for folder_name in os.listdir(output_dir):
-                folder_path = os.path.join(output_dir, folder_name)
-                if os.path.isdir(folder_path):
-                    folder_time = datetime.fromtimestamp(os.path.getctime(folder_path))
-                    if folder_time < cutoff_time:
-                        shutil.rmtree(folder_path)
-                        logger.info(f"Deleted old folder: {folder_path}")
+        names = index.expired(BATCH_SIZE, now=started)
+        if not names:
+            break
+        done = []
+        for name in names:
+            path = os.path.join(output_dir, name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                    deleted += 1
+                elif os.path.exists(path):
+                    os.remove(path)
+                    deleted += 1
                 else:
-                    file_time = datetime.fromtimestamp(os.path.getctime(folder_path))
-                    if file_time < cutoff_time:
-                        os.remove(folder_path)
-                        logger.info(f"Deleted old file: {folder_path}")
-            
-            logger.info("Completed deletion of old images")
+                    missing += 1
+                done.append(name)
+            except OSError as e:
+                # 删除失败的条目保留在索引中，下次清理时重试
+                errors += 1
+                logger.error(f"Error deleting expired image path {path}: {str(e)}")
+            if delay:
+                time.sleep(delay)
+        index.remove(done)
+        if not done or len(names) < BATCH_SIZE:
+            break
+
+    elapsed = time.time() - started
+    index.update_meta(
+        {'last_run': started, 'last_run_deleted': deleted, 'last_run_seconds': round(elapsed, 3)},
+        {'deleted_total': deleted, 'missing_total': missing, 'errors_total': errors}
+    )
+    logger.info(f"Deleted {deleted} expired image path(s) in {elapsed:.2f}s ({missing} already gone, {errors} failed)")
+    return deleted
+
+
+def delete_old_images(index, output_dir, interval_minutes, retention_hours, max_deletes_per_second):
+    try:
+        bootstrap_index(index, output_dir, retention_hours * 3600)
+    except Exception as e:
+        logger.error(f"Error bootstrapping image expiry index: {str(e)}")
+    while True:
+        try:
+            delete_expired_images(index, output_dir, max_deletes_per_second)
         except Exception as e:
             logger.error(f"Error during deletion of old images: {str(e)}")
-        
+
         # 等待指定的分钟数
         time.sleep(interval_minutes * 60)
 
-def start_image_cleaner(output_dir, interval_minutes, retention_hours):
+
+def start_image_cleaner(index, output_dir, interval_minutes, retention_hours, max_deletes_per_second=0):
     delete_thread = threading.Thread(
-        target=delete_old_images, 
-        args=(output_dir, interval_minutes, retention_hours),
+        target=delete_old_images,
+        args=(index, output_dir, interval_minutes, retention_hours, max_deletes_per_second),
         daemon=True
     )
     delete_thread.start()
@@ -0,0 +1,54 @@
+import io
+import base64
+import binascii
+import struct
+from PIL import Image
+
+# 本模块只依赖 Pillow，供图片处理进程池调用，子进程无需加载 Flask 应用
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def split_data_url(data_url):
+    """从 data:image/png;base64,... 中取出 base64 部分，不做解码；不带前缀时原样返回"""
+    if data_url.startswith('data:'):
+        header, _, data = data_url.partition(',')
+        if not header.endswith(';base64'):
+            raise ValueError("只支持 base64 编码的 data URL")
+        return data
+    return data_url
+
+
+def image_size_from_base64(data):
+    """读取 base64 图片的宽高；PNG 只解码文件头中的 IHDR，其他格式由 Pillow 读取文件头
+
+    数据不完整或不是图片时抛出 ValueError。
+    """
+    # PNG 签名 8 字节 + IHDR 长度和类型 8 字节 + 宽高 8 字节，共 24 字节，对应 32 个 base64 字符
+    try:
+        header = base64.b64decode(data[:32])
+        if len(header) >= 24 and header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+            return struct.unpack('>II', header[16:24])
+        with Image.open(io.BytesIO(base64.b64decode(data))) as img:
+            return img.size
+    except (binascii.Error, OSError) as e:
+        raise ValueError(f"无法读取图片尺寸: {str(e)}")
+
+
+def encode_thumbnail(img, size, quality):
+    """按最大边长等比缩放并编码为 WebP"""
+    thumb = img.copy()
+    thumb.thumbnail((size, size))
+    thumb_buffer = io.BytesIO()
+    thumb.save(thumb_buffer, format='WEBP', quality=quality)
+    return thumb_buffer.getvalue()
+
+
+def encode_history_images(png_data, jpeg_quality=85, thumb_size=256, thumb_quality=75):
+    """把 PNG 字节编码为历史记录使用的 JPEG 和 WebP 缩略图，返回 (jpg_bytes, thumb_bytes)"""
+    with Image.open(io.BytesIO(png_data)) as img:
+        # 转换为 RGB 模式（去除 alpha 通道）
+        rgb = img.convert('RGB')
+    jpg_buffer = io.BytesIO()
+    rgb.save(jpg_buffer, format='JPEG', quality=jpeg_quality)
+    return jpg_buffer.getvalue(), encode_thumbnail(rgb, thumb_size, thumb_quality)
@@ -0,0 +1,102 @@
+import logging
+from sqlalchemy import text, Integer, Float
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'image_fts'
+
+# trigram 分词器支持中英文任意子串匹配（与原来的 LIKE '%kw%' 语义一致），
+# 需要 SQLite 3.34+，不支持时退回 unicode61
+TRIGRAM_MIN_LENGTH = 3
+
+
+def _existing_fts(conn):
+    """返回已创建的全文索引使用的分词器，索引不存在时返回 None"""
+    row = conn.execute(text("SELECT sql FROM sqlite_master WHERE type='table' AND name=:name"),
+                       {"name": FTS_TABLE}).fetchone()
+    if not row:
+        return None
+    return 'trigram' if 'trigram' in row[0] else 'unicode61'
+
+
+def detect_fts(engine):
+    """只检测全文索引是否已存在（不创建），返回分词器名称或 None"""
+    with engine.connect() as conn:
+        return _existing_fts(conn)
+
+
+def ensure_fts(engine):
+    """创建 image 表的 FTS5 全文索引及同步触发器，首次创建时回填已有数据
+
+    返回使用的分词器名称，不支持 FTS5 时返回 None
+    """
+    with engine.begin() as conn:
+        tokenizer = _existing_fts(conn)
+        exists = tokenizer is not None
+        if not exists:
+            for candidate in ('trigram', 'unicode61'):
+                try:
+                    conn.execute(text(
+                        f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                        f"prompt, original_prompt, content='image', content_rowid='id', tokenize='{candidate}')"
+                    ))
+                    tokenizer = candidate
+                    break
+                except Exception as e:
+                    logger.warning(f"创建全文索引失败（分词器 {candidate}）: {str(e)}")
+            if tokenizer is None:
+                return None
+
+        # 通过触发器在插入、删除、修改时保持索引同步
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS image_fts_ai AFTER INSERT ON image BEGIN
+                INSERT INTO {FTS_TABLE}(rowid, prompt, original_prompt)
+                VALUES (new.id, new.prompt, new.original_prompt);
+            END
+        """))
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS image_fts_ad AFTER DELETE ON image BEGIN
+                INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, prompt, original_prompt)
+                VALUES ('delete', old.id, old.prompt, old.original_prompt);
+            END
+        """))
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS image_fts_au AFTER UPDATE OF prompt, original_prompt ON image BEGIN
+                INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, prompt, original_prompt)
+                VALUES ('delete', old.id, old.prompt, old.original_prompt);
+                INSERT INTO {FTS_TABLE}(rowid, prompt, original_prompt)
+                VALUES (new.id, new.prompt, new.original_prompt);
+            END
+        """))
+
+        if not exists:
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+            logger.info(f"已创建全文索引 {FTS_TABLE}（分词器 {tokenizer}）并回填已有数据")
+    return tokenizer
+
+
+def build_match_expression(keywords, tokenizer):
+    """把一个或多个关键词转换为 FTS5 MATCH 表达式
+
+    每个关键词内的词语之间为 AND，多个关键词（如原文和译文）之间为 OR。
+    任一词语过短无法使用 trigram 索引时返回 None，由调用方退回 LIKE 查询。
+    """
+    groups = []
+    for keyword in keywords:
+        terms = [t for t in (keyword or '').split() if t]
+        if not terms:
+            continue
+        if tokenizer == 'trigram' and any(len(t) < TRIGRAM_MIN_LENGTH for t in terms):
+            return None
+        quoted = ['"' + t.replace('"', '""') + '"' for t in terms]
+        groups.append('(' + ' AND '.join(quoted) + ')')
+    if not groups:
+        return None
+    return ' OR '.join(dict.fromkeys(groups))
+
+
+def fts_match_subquery(match_expression):
+    """返回 (image_id, rank) 子查询，rank 越小相关度越高"""
+    return text(
+        f"SELECT rowid AS image_id, rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match"
+    ).bindparams(match=match_expression).columns(image_id=Integer, rank=Float).subquery('fts')
@@ -0,0 +1,59 @@
+import os
+import hashlib
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ImageStore:
+    """按内容哈希存放图片文件的存储，数据库中只保存 key（<sha256>.<扩展名>）"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        digest = key.split('.', 1)[0]
+        if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            raise ValueError(f"无效的图片 key: {key}")
+        return os.path.join(self.root, digest[:2], digest[2:4], key)
+
+    def put(self, data, ext='jpg'):
+        key = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+        file_path = self.path(key)
+        if os.path.exists(file_path):
+            return key
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # 先写临时文件再原子替换，避免读到写了一半的文件
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return key
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def exists(self, key):
+        try:
+            return os.path.exists(self.path(key))
+        except ValueError:
+            return False
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+            return True
+        except (FileNotFoundError, ValueError):
+            return False
@@ -0,0 +1,129 @@
+"""把 images.db 中 image.base64 列里的历史图片迁移到内容寻址存储，并生成缩略图
+
+用法: python api/migrate_image_store.py [--db 数据库路径] [--store 存储目录] [--batch-size N] [--vacuum]
+
+迁移可以重复执行，已迁移且已有缩略图的记录会被跳过；已迁移但没有缩略图的记录会补充缩略图。
+"""
+import io
+import os
+import sys
+import base64
+import sqlite3
+import argparse
+import logging
+from dotenv import load_dotenv
+from PIL import Image
+from sqlalchemy import create_engine
+
+from image_store import ImageStore
+from image_codec import encode_thumbnail
+from schema_upgrade import ensure_columns
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+
+# 与 sd_route 使用相同的缩略图参数
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '256'))
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '75'))
+
+# 尚未迁移到存储，或已迁移但还没有缩略图的记录
+PENDING = "((base64 IS NOT NULL AND base64 != '') OR (image_key IS NOT NULL AND thumb_key IS NULL))"
+
+
+def make_thumbnail(data):
+    with Image.open(io.BytesIO(data)) as img:
+        return encode_thumbnail(img.convert('RGB'), THUMBNAIL_SIZE, THUMBNAIL_QUALITY)
+
+
+def migrate(db_path, store, batch_size=200):
+    engine = create_engine(f'sqlite:///{db_path}')
+    try:
+        ensure_columns(engine, 'image', {'image_key': 'VARCHAR(80)', 'thumb_key': 'VARCHAR(80)'})
+    finally:
+        engine.dispose()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        pending = conn.execute(f"SELECT COUNT(*) FROM image WHERE {PENDING}").fetchone()[0]
+        logger.info(f"待迁移的图片数量: {pending}")
+
+        migrated = 0
+        failed = 0
+        thumb_failed = 0
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT id, base64, image_key FROM image WHERE id > ? AND {PENDING} ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for image_id, b64, image_key in rows:
+                last_id = image_id
+                try:
+                    if b64:
+                        data = base64.b64decode(b64)
+                        image_key = store.put(data, 'jpg')
+                    else:
+                        data = store.get(image_key)
+                        if data is None:
+                            raise FileNotFoundError(f"存储中不存在图片 {image_key}")
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"迁移图片失败: id={image_id}, {str(e)}")
+                    continue
+                thumb_key = None
+                try:
+                    thumb_key = store.put(make_thumbnail(data), 'webp')
+                except Exception as e:
+                    # 图片已写入存储，缩略图留到首次访问时再生成
+                    thumb_failed += 1
+                    logger.error(f"生成缩略图失败: id={image_id}, {str(e)}")
+                updates.append((image_key, thumb_key, image_id))
+
+            # 文件写入成功后再清空 base64，中途中断也不会丢失数据
+            conn.executemany("UPDATE image SET image_key = ?, thumb_key = ?, base64 = '' WHERE id = ?", updates)
+            conn.commit()
+            migrated += len(updates)
+            logger.info(f"迁移进度: {migrated}/{pending}")
+
+        logger.info(f"迁移完成: 成功 {migrated} 张，失败 {failed} 张，缩略图生成失败 {thumb_failed} 张")
+        return migrated, failed + thumb_failed
+    finally:
+        conn.close()
+
+
+def vacuum(db_path):
+    logger.info("开始 VACUUM 以回收数据库空间")
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    logger.info("VACUUM 完成")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="迁移 image.base64 中的图片到内容寻址存储并生成缩略图")
+    parser.add_argument('--db', default=os.getenv('ORIGINAL_DB_PATH', os.path.join(current_dir, 'instance', 'images.db')))
+    parser.add_argument('--store', default=os.getenv('IMAGE_STORE_DIR', os.path.join(root_dir, 'images', 'store')))
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--vacuum', action='store_true', help="迁移完成后执行 VACUUM 缩小数据库文件")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        logger.error(f"数据库文件不存在: {args.db}")
+        sys.exit(1)
+
+    logger.info(f"数据库: {args.db}，存储目录: {args.store}")
+    _, failed = migrate(args.db, ImageStore(args.store), args.batch_size)
+    if args.vacuum:
+        vacuum(args.db)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,61 @@
+import math
+import base64
+import json
+from datetime import datetime
+from sqlalchemy.types import TypeDecorator, String
+
+DEFAULT_PER_PAGE = 8
+MAX_PER_PAGE = 100
+
+
+def parse_page_params(data, default_per_page=DEFAULT_PER_PAGE, max_per_page=MAX_PER_PAGE):
+    """从请求参数中读取 (page, per_page)：page 至少为 1，per_page 限制在 1 到 max_per_page 之间
+
+    参数不是整数时抛出 ValueError。
+    """
+    try:
+        page = max(int(data.get('page', 1)), 1)
+        per_page = min(max(int(data.get('per_page', default_per_page)), 1), max_per_page)
+    except (TypeError, ValueError):
+        raise ValueError("无效的分页参数")
+    return page, per_page
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+
+
+def valid_cursor(values, by_relevance):
+    """检查游标是否由当前的排序方式生成：相关度排序为 {'rank', 'id'}，时间排序为 {'created_at', 'id'}"""
+    if not isinstance(values, dict) or type(values.get('id')) is not int:
+        return False
+    if by_relevance:
+        rank = values.get('rank')
+        return type(rank) in (int, float) and math.isfinite(rank)
+    try:
+        datetime.fromisoformat(values['created_at'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return True
+
+
+def stored_timestamp(value):
+    """按 SQLite 中 DateTime 列的存储文本格式化时间
+
+    数据库默认值 CURRENT_TIMESTAMP 写入的时间不带小数秒，SQLAlchemy 写入的时间带 6 位微秒。
+    """
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f' if value.microsecond else '%Y-%m-%d %H:%M:%S')
+
+
+class StoredTimestamp(TypeDecorator):
+    """游标中的时间作为绑定参数时使用与列中相同的存储格式，(created_at, id) 的比较与排序结果一致"""
+
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else stored_timestamp(value)
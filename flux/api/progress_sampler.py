@@ -0,0 +1,66 @@
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressSampler:
+    """在任务执行期间后台轮询 SD 后端的 /sdapi/v1/progress，并把进度回调给调用方
+
+    用作上下文管理器：进入时开始采样，退出时停止并等待采样线程结束，
+    保证任务的最终状态不会被迟到的进度覆盖。
+    """
+
+    def __init__(self, fetch_progress, on_progress, interval=1.0):
+        self.fetch_progress = fetch_progress
+        self.on_progress = on_progress
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._last = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='sd-progress', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                data = self.fetch_progress()
+            except Exception as e:
+                logger.debug(f"获取生成进度失败: {str(e)}")
+                continue
+            if self._stopped.is_set() or not data:
+                continue
+
+            state = data.get('state') or {}
+            # job_count 为 0 表示后端尚未开始或已结束当前任务
+            if not state.get('job_count') and not data.get('progress'):
+                continue
+
+            sample = {
+                "progress": float(data.get('progress') or 0),
+                "eta": round(float(data.get('eta_relative') or 0), 1),
+                "step": state.get('sampling_step'),
+                "steps": state.get('sampling_steps'),
+                "preview": data.get('current_image'),
+            }
+            key = (sample['progress'], sample['step'], bool(sample['preview']))
+            if key == self._last:
+                continue
+            self._last = key
+
+            try:
+                self.on_progress(sample)
+            except Exception as e:
+                logger.error(f"更新生成进度时出错: {str(e)}")
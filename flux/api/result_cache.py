@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def result_key(payload):
+    """对规范化后的 txt2img 参数取哈希，作为结果缓存的 key"""
+    normalized = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """固定种子生成结果的缓存：相同参数的请求直接返回已生成的图片
+
+    每个结果的 PNG 文件存放在 <root>/<key 前两位>/<key>/ 下，索引（种子、大小、最近使用时间）保存在
+    <root>/index.db，可被多个进程共享。总大小超过 max_bytes 时按最近使用时间淘汰。
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, 'index.db'), check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, seeds TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_results_last_used ON results (last_used)")
+        self._conn.commit()
+
+    def _dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _remove(self, key):
+        # 调用方需持有 self._lock
+        self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+        self._conn.commit()
+        shutil.rmtree(self._dir(key), ignore_errors=True)
+
+    def get(self, key):
+        """返回 (PNG 文件路径列表, 种子列表)，未命中时返回 None"""
+        with self._lock:
+            rows = self._conn.execute("SELECT seeds FROM results WHERE key = ?", (key,)).fetchall()
+            if not rows:
+                self.misses += 1
+                return None
+            seeds = json.loads(rows[0][0])
+            paths = [os.path.join(self._dir(key), f"{i}.png") for i in range(len(seeds))]
+            if not all(os.path.exists(path) for path in paths):
+                # 文件被外部删除，索引失效
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return paths, seeds
+
+    def put(self, key, images, seeds):
+        """保存一次生成的 PNG 字节和对应种子"""
+        size = sum(len(data) for data in images)
+        if not images or size > self.max_bytes:
+            return
+        final_dir = self._dir(key)
+        os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+        # 先写入临时目录再整体改名，其他进程不会读到不完整的结果
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(final_dir), suffix='.tmp')
+        try:
+            for i, data in enumerate(images):
+                with open(os.path.join(tmp_dir, f"{i}.png"), 'wb') as f:
+                    f.write(data)
+            with self._lock:
+                if os.path.exists(final_dir):
+                    shutil.rmtree(final_dir, ignore_errors=True)
+                os.rename(tmp_dir, final_dir)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO results (key, seeds, size, last_used) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(seeds[:len(images)]), size, time.time())
+                )
+                self._conn.commit()
+                self._evict()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _evict(self):
+        # 调用方需持有 self._lock
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchall()[0][0]
+        if total <= self.max_bytes:
+            return
+        removed = 0
+        for key, size in self._conn.execute("SELECT key, size FROM results ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+            removed += 1
+        logger.info(f"结果缓存超过 {self.max_bytes} 字节，淘汰 {removed} 条最久未使用的结果")
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchall()[0]
+        return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
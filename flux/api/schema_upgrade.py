@@ -0,0 +1,26 @@
+import logging
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_columns(engine, table_name, columns):
+    """为已存在的表补充新增的列，columns 为 {列名: 列定义 DDL}
+
+    db.create_all() 只会创建缺失的表，不会修改已有表的结构。
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table(table_name):
+        return
+    existing = {column['name'] for column in inspector.get_columns(table_name)}
+    with engine.begin() as conn:
+        for name, ddl in columns.items():
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {ddl}"))
+                logger.info(f"已为表 {table_name} 添加列: {name}")
+
+
+def ensure_indexes(engine, indexes):
+    """为已存在的表补充新增的索引（新建的表由 db.create_all() 创建索引）"""
+    for index in indexes:
+        index.create(bind=engine, checkfirst=True)
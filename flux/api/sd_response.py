@@ -0,0 +1,203 @@
+import re
+import json
+import base64
+import codecs
+
+# 每次从响应中读取的字节数
+CHUNK_SIZE = 256 * 1024
+
+# 字符串之外需要关注的结构字符，以及字符串内的结束引号和转义符
+_STRUCTURE = re.compile(r'[\[\]{}",]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class SDResponseReader:
+    """增量解析 /sdapi/v1/txt2img、img2img 的 JSON 响应
+
+    images 数组中的每个 base64 字符串在读取过程中按块解码为图片字节，不会在内存中同时保留完整的
+    响应文本、base64 字符串和解码结果；skip_keys 中的字段（如回显了输入图片的 parameters）只扫描
+    不解析。其余字段按普通 JSON 解析。
+    """
+
+    def __init__(self, chunks, skip_keys=('parameters',)):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.skip_keys = set(skip_keys)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """丢弃已处理的文本并读取下一块数据，返回丢弃的字符数"""
+        shift = self.pos
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self.buf += text
+                return shift
+        self.buf += self._decoder.decode(b'', final=True)
+        self.eof = True
+        return shift
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ''
+            self._fill()
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"SD 响应格式错误: 期望 {char!r}，位置 {self.pos}")
+        self.pos += 1
+
+    def _value_end(self, discard=False):
+        """扫描当前 JSON 值，返回其结束位置；discard 为 True 时边扫描边丢弃已读内容"""
+        depth = 0
+        i = self.pos
+        in_string = False
+        while True:
+            if in_string:
+                match = _STRING_SPECIAL.search(self.buf, i)
+                if match and match.group() == '"':
+                    i = match.end()
+                    in_string = False
+                    if depth == 0:
+                        return i
+                    continue
+                if match and match.end() < len(self.buf):
+                    # 跳过转义符及其后的字符
+                    i = match.end() + 1
+                    continue
+                if match:
+                    i = match.start()
+            else:
+                match = _STRUCTURE.search(self.buf, i)
+                if match:
+                    char = match.group()
+                    if char == '"':
+                        in_string = True
+                        i = match.end()
+                        continue
+                    if char in '[{':
+                        depth += 1
+                        i = match.end()
+                        continue
+                    if depth == 0:
+                        # 数字、true 等简单值在上一层的逗号或右括号处结束
+                        return match.start()
+                    if char == ',':
+                        i = match.end()
+                        continue
+                    depth -= 1
+                    i = match.end()
+                    if depth == 0:
+                        return i
+                    continue
+            if self.eof:
+                raise ValueError("SD 响应不完整")
+            if not match:
+                i = len(self.buf)
+            if discard:
+                self.pos = i
+            i -= self._fill()
+
+    def _read_value(self):
+        self._peek()
+        end = self._value_end()
+        value = json.loads(self.buf[self.pos:end])
+        self.pos = end
+        return value
+
+    def _skip_value(self):
+        self._peek()
+        self.pos = self._value_end(discard=True)
+
+    def _read_base64(self):
+        """读取一个 base64 字符串（开头的引号已读取），按 4 字符对齐分块解码"""
+        data = bytearray()
+        pending = ''
+        prefix_checked = False
+        while True:
+            end = self.buf.find('"', self.pos)
+            segment = self.buf[self.pos:] if end == -1 else self.buf[self.pos:end]
+            self.pos = len(self.buf) if end == -1 else end + 1
+            text = pending + segment
+            if end == -1 and text.endswith('\\'):
+                # 转义序列被分块截断，留到下一块
+                text, pending = text[:-1], '\\'
+            else:
+                pending = ''
+            text = text.replace('\\/', '/')
+            if not prefix_checked:
+                # 兼容 data URL 形式，去掉 "data:image/png;base64," 前缀
+                if text.startswith('data:'):
+                    comma = text.find(',')
+                    if comma != -1:
+                        text = text[comma + 1:]
+                        prefix_checked = True
+                elif len(text) >= 5 or end != -1:
+                    prefix_checked = True
+                if not prefix_checked:
+                    pending = text + pending
+                    text = ''
+            if end != -1:
+                data += base64.b64decode(text)
+                return bytes(data)
+            usable = len(text) - len(text) % 4
+            data += base64.b64decode(text[:usable])
+            pending = text[usable:] + pending
+            if self.eof:
+                raise ValueError("SD 响应不完整")
+            self._fill()
+
+    def _iter_images(self):
+        self._expect('[')
+        while True:
+            char = self._peek()
+            if char == ']':
+                self.pos += 1
+                return
+            if char == ',':
+                self.pos += 1
+                continue
+            self._expect('"')
+            yield self._read_base64()
+
+    def read(self):
+        """解析整个响应，返回与 response.json() 结构相同的字典，其中 images 为图片字节列表"""
+        result = {}
+        self._expect('{')
+        while True:
+            char = self._peek()
+            if char == '}':
+                self.pos += 1
+                break
+            if char == ',':
+                self.pos += 1
+                continue
+            key = self._read_value()
+            self._expect(':')
+            if key == 'images' and self._peek() == '[':
+                result[key] = list(self._iter_images())
+            elif key in self.skip_keys:
+                self._skip_value()
+            else:
+                result[key] = self._read_value()
+        # 读完剩余数据，连接才能归还连接池
+        while not self.eof:
+            self._fill()
+        return result
+
+
+def read_sd_response(response, chunk_size=CHUNK_SIZE):
+    """流式读取以 stream=True 发出的 SD 请求的响应"""
+    try:
+        return SDResponseReader(response.iter_content(chunk_size=chunk_size)).read()
+    finally:
+        response.close()
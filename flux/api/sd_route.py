@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_from_directory, make_response, session, redirect, url_for, after_this_request, current_app
+from flask import Flask, request, jsonify, send_from_directory, send_file, make_response, session, redirect, url_for, after_this_request, current_app
 from flask_cors import CORS
 from flask import current_app as app
 from flask_sqlalchemy import SQLAlchemy
@@ -17,18 +17,38 @@ import json
 import logging
 import urllib3
 from uuid import uuid4
-from queue import Queue
+from queue import Full
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from openai import OpenAI
 from dotenv import load_dotenv
 import secrets
 from urllib.parse import urlencode
 import jwt
-from image_cleaner import start_image_cleaner
+from image_cleaner import ImageExpiryIndex, start_image_cleaner
+from backend_pool import BackendPool, BackendError, load_backends, start_health_checker, checkpoint_name
+from task_dispatcher import TaskDispatcher
+from task_store import TaskStore
+from state_backend import create_state_backend, LeaderLock, file_lock
+from progress_sampler import ProgressSampler
+from image_store import ImageStore
+from schema_upgrade import ensure_columns, ensure_indexes
+from image_search import ensure_fts, detect_fts, build_match_expression, fts_match_subquery
+from ttl_cache import TTLCache, SQLiteCacheBacking, normalize_prompt
+from http_client import create_session
+from sd_response import read_sd_response
+from result_cache import ResultCache, result_key
+from pagination import parse_page_params, encode_cursor, decode_cursor, valid_cursor, StoredTimestamp
+from image_codec import encode_thumbnail, encode_history_images, split_data_url, image_size_from_base64
+import hashlib
+import atexit
+import signal
 from sqlalchemy import desc
 import sqlite3
 import traceback
 from urllib.parse import urljoin
-from collections import deque, defaultdict
+from collections import deque
 
 # 禁用SSL警告（仅用于测试环境）
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -58,36 +78,137 @@ class Image(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(50), nullable=False)
     prompt = db.Column(db.Text, nullable=False)
-    base64 = db.Column(db.Text, nullable=False)
+    # 用户输入的原始提示词（翻译前），旧数据为空
+    original_prompt = db.Column(db.Text)
+    # 旧数据的 JPEG base64，新数据为空字符串，图片内容存放在 image_store 中
+    base64 = db.Column(db.Text, nullable=False, default='')
+    image_key = db.Column(db.String(80))
+    thumb_key = db.Column(db.String(80))
     seed = db.Column(db.Integer, nullable=False)
     model = db.Column(db.String(100), nullable=False)
     lora = db.Column(db.String(100))
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
 
-# 在应用上下文中创建数据库表
-with app.app_context():
+# 历史查询按用户过滤、按时间倒序翻页，(created_at, id) 同时作为游标分页的排序键
+image_user_created_index = db.Index('ix_image_user_created_at', Image.user_id, Image.created_at.desc(), Image.id.desc())
+
+# 在应用上下文中创建数据库表；多个 worker 同时启动时通过文件锁逐个执行，
+# 后执行的进程看到结构已是最新，不会重复添加列或创建索引
+os.makedirs(app.instance_path, exist_ok=True)
+with app.app_context(), file_lock(os.path.join(app.instance_path, 'images.db.schema.lock')):
     db.create_all()
+    ensure_columns(db.engine, 'image', {'image_key': 'VARCHAR(80)', 'thumb_key': 'VARCHAR(80)', 'original_prompt': 'TEXT'})
+    ensure_indexes(db.engine, [image_user_created_index])
+    # 提示词全文索引，不支持 FTS5 时为 None，搜索退回 LIKE
+    FTS_TOKENIZER = ensure_fts(db.engine)
+fts_checked_at = time.time()
+# 没有可用的全文索引时，重新检测索引是否已由其他进程创建的间隔
+FTS_RECHECK_SECONDS = 60
+
+def get_fts_tokenizer():
+    """返回全文索引的分词器；启动时没有可用索引的进程定期重新检测，不会一直使用 LIKE 搜索"""
+    global FTS_TOKENIZER, fts_checked_at
+    if FTS_TOKENIZER is None and time.time() - fts_checked_at >= FTS_RECHECK_SECONDS:
+        fts_checked_at = time.time()
+        try:
+            FTS_TOKENIZER = detect_fts(db.engine)
+        except Exception as e:
+            logger.warning(f"检测全文索引失败: {str(e)}")
+        if FTS_TOKENIZER:
+            logger.info(f"检测到全文索引（分词器 {FTS_TOKENIZER}），关键词搜索改为使用全文索引")
+    return FTS_TOKENIZER
+
+# 环境变量获取配置（需在读取 secret key 之前加载 .env）
+load_dotenv()
 
 # 设置 secret key
 app.secret_key = os.environ.get('FLASK_SECRET_KEY') or secrets.token_hex(16)
 
-# 环境变量获取配置
-load_dotenv()
 SD_URL = os.getenv('SD_URL', 'https://127.0.0.1:7860')
 OUTPUT_DIR = os.getenv('SD_OUTPUT_DIR', os.path.join(root_dir, 'images', 'sd'))
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_API_BASE = os.getenv('OPENAI_API_BASE')
 ENABLE_IP_RESTRICTION = os.getenv('ENABLE_IP_RESTRICTION', 'False').lower() == 'true'
+# 公平调度：每个用户未完成任务数的上限（0 表示不限制），以及是否按 trust_level 决定优先级
+MAX_TASKS_PER_USER = int(os.getenv('MAX_TASKS_PER_USER', '3'))
+PRIORITY_BY_TRUST_LEVEL = os.getenv('PRIORITY_BY_TRUST_LEVEL', 'True').lower() == 'true'
 CHATGPT_MODEL = os.getenv('CHATGPT_MODEL', 'gpt-4o-mini-2024-07-18')
 TRUST_LEVEL = os.getenv('TRUST_LEVEL', '1')
 MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', '3'))
+# 持久化任务队列：重启后恢复排队和执行中的任务
+TASK_STORE_DB = os.getenv('TASK_STORE_DB') or os.path.join(current_dir, 'instance', 'tasks.db')
+TASK_MAX_ATTEMPTS = int(os.getenv('TASK_MAX_ATTEMPTS', '3'))
+TASK_RETENTION_SECONDS = int(os.getenv('TASK_RETENTION_SECONDS', str(24 * 3600)))
+# 任务状态、IP 限制和对话历史的存储：sqlite 可在多个 worker 进程间共享，memory 只适用于单进程
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite').lower()
+STATE_POLL_INTERVAL = float(os.getenv('STATE_POLL_INTERVAL', '0.5'))
+# 主进程检查并接管已退出 worker 留下的任务的间隔
+TASK_RECOVERY_INTERVAL = int(os.getenv('TASK_RECOVERY_INTERVAL', '30'))
 AUTH_SERVICE_URL = os.getenv('AUTH_SERVICE_URL', 'http://localhost:25002')
 JWT_SECRET = os.getenv('JWT_SECRET')
 JWT_ALGORITHM = os.getenv('JWT_ALGORITHM', 'HS256')
+# 已验证 JWT 的缓存：条目数上限和最长缓存秒数（不会超过令牌自身的过期时间）
+JWT_CACHE_SIZE = int(os.getenv('JWT_CACHE_SIZE', '4096'))
+JWT_CACHE_TTL_SECONDS = int(os.getenv('JWT_CACHE_TTL_SECONDS', '300'))
+
+# SD 后端池配置
+SD_BACKEND_MAX_CONCURRENCY = int(os.getenv('SD_BACKEND_MAX_CONCURRENCY', '1'))
+SD_BACKEND_FAILURE_THRESHOLD = int(os.getenv('SD_BACKEND_FAILURE_THRESHOLD', '3'))
+SD_BACKEND_COOLDOWN_SECONDS = int(os.getenv('SD_BACKEND_COOLDOWN_SECONDS', '60'))
+SD_HEALTH_CHECK_INTERVAL = int(os.getenv('SD_HEALTH_CHECK_INTERVAL', '30'))
+SD_REQUEST_TIMEOUT = int(os.getenv('SD_REQUEST_TIMEOUT', '300'))
+# 对外 HTTP 请求复用连接池：连接超时、失败重试次数与退避系数，以及认证服务请求的读取超时
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.5'))
+AUTH_REQUEST_TIMEOUT = float(os.getenv('AUTH_REQUEST_TIMEOUT', '10'))
+SD_PROGRESS_INTERVAL = float(os.getenv('SD_PROGRESS_INTERVAL', '1'))
+SD_PROGRESS_PREVIEW = os.getenv('SD_PROGRESS_PREVIEW', 'False').lower() == 'true'
+# 批量合并：把参数相同的排队任务合并为一次 txt2img 调用，MAX_BATCH_SIZE 为单次调用的图片总数上限（受显存限制）
+ENABLE_BATCH_COALESCING = os.getenv('ENABLE_BATCH_COALESCING', 'False').lower() == 'true'
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '4'))
+# 切换模型后轮询 /sdapi/v1/options 确认生效的超时和间隔
+MODEL_SWITCH_TIMEOUT = float(os.getenv('MODEL_SWITCH_TIMEOUT', '120'))
+MODEL_SWITCH_POLL_INTERVAL = float(os.getenv('MODEL_SWITCH_POLL_INTERVAL', '0.5'))
+# 分派任务时在排在最前的若干个任务中优先选择与后端已加载模型相同的任务，0 表示严格按顺序
+MODEL_GROUP_WINDOW = int(os.getenv('MODEL_GROUP_WINDOW', '5'))
+
+# 提示词审核与翻译结果缓存
+PROMPT_CACHE_SIZE = int(os.getenv('PROMPT_CACHE_SIZE', '2048'))
+PROMPT_CACHE_TTL_SECONDS = int(os.getenv('PROMPT_CACHE_TTL_SECONDS', str(24 * 3600)))
+PROMPT_CACHE_DB = os.getenv('PROMPT_CACHE_DB', '')  # 为空时只使用内存缓存
+
+# 审核与翻译并发调用 LLM 的线程数和总超时
+LLM_MAX_WORKERS = int(os.getenv('LLM_MAX_WORKERS', '8'))
+LLM_DEADLINE_SECONDS = float(os.getenv('LLM_DEADLINE_SECONDS', '30'))
+# 入队前审核、翻译提示词的预处理线程数
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', '4'))
+# 生成历史记录 JPEG 和缩略图的进程数，0 表示在后处理线程中直接编码
+POSTPROCESS_WORKERS = int(os.getenv('POSTPROCESS_WORKERS', '2'))
+# 退出时等待预处理、正在执行的任务和历史图片写入完成的最长时间，超时后未完成的任务由其他进程或下次启动时恢复
+SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv('SHUTDOWN_TIMEOUT_SECONDS', '300'))
 
 # 从环境变量获取清理间隔和保留时间
 CLEANER_INTERVAL_MINUTES = int(os.getenv('CLEANER_INTERVAL_MINUTES', '60'))
 CLEANER_RETENTION_HOURS = int(os.getenv('CLEANER_RETENTION_HOURS', '48'))
+# 生成图片的过期索引（保存图片时写入，清理器只删除已过期的条目）和每秒最多删除的条目数，0 表示不限速
+CLEANER_INDEX_DB = os.getenv('CLEANER_INDEX_DB') or os.path.join(current_dir, 'instance', 'image_expiry.db')
+CLEANER_MAX_DELETES_PER_SECOND = float(os.getenv('CLEANER_MAX_DELETES_PER_SECOND', '20'))
+
+# 历史搜索时是否把关键词翻译成英文再一起搜索（原始提示词已建立索引，关闭后不再调用 LLM）
+SEARCH_TRANSLATE_KEYWORD = os.getenv('SEARCH_TRANSLATE_KEYWORD', 'True').lower() == 'true'
+# 历史查询总数的缓存时间（秒），用户新增或删除图片时会立即失效
+HISTORY_COUNT_CACHE_SECONDS = int(os.getenv('HISTORY_COUNT_CACHE_SECONDS', '300'))
+
+# 历史图片的内容寻址存储目录（不受图片清理器影响）
+IMAGE_STORE_DIR = os.getenv('IMAGE_STORE_DIR', os.path.join(root_dir, 'images', 'store'))
+# 固定种子生成结果的缓存目录和容量上限（字节），容量为 0 时不启用
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', os.path.join(root_dir, 'images', 'result_cache'))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+# 历史记录缩略图的最大边长和 WebP 质量
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '256'))
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '75'))
+IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', str(7 * 24 * 3600)))
 
 # 禁用SSL警告（仅用于测试环境）
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -108,53 +229,176 @@ def load_config():
 
 config = load_config()
 
+image_store = ImageStore(IMAGE_STORE_DIR)
+image_expiry = ImageExpiryIndex(CLEANER_INDEX_DB)
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES) if RESULT_CACHE_MAX_BYTES > 0 else None
+
 # 更新这些全局变量的定义
 CONTENT_REVIEW_PROMPT = config.get('content_review_prompt', '')
 CONTENT_TRANSLATION_PROMPT = config.get('content_translation_prompt', '')
 SD_MODEL = config.get('sd_model', '')
 
+def create_prompt_cache(name, system_prompt):
+    # 模型或系统提示词变化后，磁盘上的旧结果不再适用，因此把它们的哈希作为命名空间
+    version = hashlib.sha256(f"{CHATGPT_MODEL}\n{system_prompt}".encode('utf-8')).hexdigest()[:12]
+    backing = None
+    if PROMPT_CACHE_DB:
+        backing = SQLiteCacheBacking(PROMPT_CACHE_DB, f"{name}:{version}")
+        removed = backing.purge_expired()
+        logger.info(f"已加载提示词缓存 {name} 的磁盘存储 {PROMPT_CACHE_DB}，清理过期条目 {removed} 条")
+    return TTLCache(maxsize=PROMPT_CACHE_SIZE, ttl=PROMPT_CACHE_TTL_SECONDS, backing=backing, name=name)
+
+moderation_cache = create_prompt_cache('moderation', CONTENT_REVIEW_PROMPT)
+translation_cache = create_prompt_cache('translation', CONTENT_TRANSLATION_PROMPT)
+jwt_cache = TTLCache(maxsize=JWT_CACHE_SIZE, ttl=JWT_CACHE_TTL_SECONDS, name='jwt')
+
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix='llm')
+preprocess_executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix='preprocess')
+
+# 历史图片的编码放到后处理线程和进程池中，SD 后端拿到 PNG 后即可处理下一个任务
+history_executor = ThreadPoolExecutor(max_workers=max(1, POSTPROCESS_WORKERS), thread_name_prefix='postprocess')
+postprocess_pool = None
+postprocess_pool_lock = threading.Lock()
+postprocess_pool_closed = threading.Event()
+
+def get_postprocess_pool():
+    """首次编码历史图片时创建进程池，未启用或正在退出时返回 None
+
+    子进程只执行 image_codec 中的图片编码（仅依赖 Pillow），不会用到 fork 时其他线程持有的锁。
+    """
+    global postprocess_pool
+    if POSTPROCESS_WORKERS <= 0 or shutting_down.is_set() or postprocess_pool_closed.is_set():
+        return None
+    with postprocess_pool_lock:
+        if postprocess_pool is None:
+            postprocess_pool = ProcessPoolExecutor(max_workers=POSTPROCESS_WORKERS,
+                                                   mp_context=multiprocessing.get_context('fork'))
+        return postprocess_pool
+
+# 创建 SD 后端池
+backend_pool = BackendPool(
+    load_backends(config, SD_URL, SD_BACKEND_MAX_CONCURRENCY),
+    failure_threshold=SD_BACKEND_FAILURE_THRESHOLD,
+    cooldown_seconds=SD_BACKEND_COOLDOWN_SECONDS
+)
+
+# 每个执行中的任务同时占用生成请求和进度查询两个连接
+sd_session = create_session(pool_size=max(10, backend_pool.total_capacity * 2), retries=HTTP_MAX_RETRIES,
+                            backoff_factor=HTTP_RETRY_BACKOFF, verify=False)
+auth_session = create_session(retries=HTTP_MAX_RETRIES, backoff_factor=HTTP_RETRY_BACKOFF)
+
 logger.info(f"SD_URL: {SD_URL}")
+logger.info(f"SD backends: {[b['name'] for b in backend_pool.snapshot()]}, total capacity: {backend_pool.total_capacity}")
 logger.info(f"Output directory: {OUTPUT_DIR}")
 logger.info(f"OpenAI API Base: {OPENAI_API_BASE if OPENAI_API_BASE else 'Using default'}")
 logger.info(f"IP restriction enabled: {ENABLE_IP_RESTRICTION}")
 logger.info(f"ChatGPT Model: {CHATGPT_MODEL}")
 logger.info(f"Max Queue Size: {MAX_QUEUE_SIZE}")  # 新增日志输出
 
-# 任务队列和状态字典
-task_queue = Queue(maxsize=MAX_QUEUE_SIZE)
-task_status = {}
-current_task = None
+# 任务队列和共享状态
+os.makedirs(os.path.dirname(TASK_STORE_DB), exist_ok=True)
+task_store = TaskStore(TASK_STORE_DB, maxsize=MAX_QUEUE_SIZE, poll_interval=STATE_POLL_INTERVAL,
+                       retention_seconds=TASK_RETENTION_SECONDS, model_group_window=MODEL_GROUP_WINDOW,
+                       blob_fields=('original_image', 'mask_image'))
+task_store.start_heartbeat()
+task_queue = task_store  # 提供与 queue.Queue 相同的接口，供分派线程使用
+# 任务状态、IP 地址的活跃请求和对话历史
+state = create_state_backend(STATE_BACKEND, TASK_STORE_DB)
 task_lock = threading.Lock()
+# 任务状态变更通知：唤醒本进程中等待的推送连接，其他进程写入的状态通过轮询版本号发现
+task_status_changed = threading.Condition(task_lock)
 
-# 添加一个字典来跟踪 IP 地址的活跃请求
-active_ip_requests = {}
-ip_lock = threading.Lock()
+# 状态推送配置
+SSE_KEEPALIVE_SECONDS = int(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+SSE_MAX_DURATION_SECONDS = int(os.getenv('SSE_MAX_DURATION_SECONDS', '120'))
+# 每个进程同时保持的推送连接数上限：每个连接占用一个工作线程，需小于 gunicorn 的线程数，
+# 超出时返回 503，前端改为轮询
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', '8'))
+sse_slots = threading.BoundedSemaphore(max(SSE_MAX_STREAMS, 1))
 
 # 配置部分
 MAX_CONVERSATION_TURNS = int(os.getenv('MAX_CONVERSATION_TURNS', '10'))  # 默认为10轮
 
-# 使用 defaultdict 和 deque 来存储用户对话
-user_conversations = defaultdict(lambda: deque(maxlen=MAX_CONVERSATION_TURNS))
+# 使用 deque 来限制用户对话的长度，对话保存在共享状态中
+conversation_lock = threading.Lock()
+
+def get_conversation(tmp_id):
+    return deque(state.load_conversation(tmp_id), maxlen=MAX_CONVERSATION_TURNS)
+
+def append_conversation(tmp_id, prompt, translated_prompt):
+    with conversation_lock:
+        conversation_history = get_conversation(tmp_id)
+        # 添加user和AI的回复（右进），超出最大轮数时最早的对话会自动被移除（左出）
+        conversation_history.append({"role": "user", "content": prompt})
+        conversation_history.append({"role": "assistant", "content": translated_prompt})
+        state.save_conversation(tmp_id, list(conversation_history))
 
-def start_next_task():
+def enqueue_task(task):
+    """将任务加入队列，由分派线程取出执行。队列已满或服务正在停止时返回 None，否则返回排队位置"""
+    task_id = task['task_id']
+    if not accepting_tasks():
+        return None
+    with task_lock:
+        # 先写入状态再入队，保证分派线程（可能在其他进程中）写入的"处理中"不会被覆盖
+        queue_position = task_queue.qsize()
+        set_task_status(task_id, {"status": "排队中", "progress": 0, "queuePosition": queue_position, "max_queue_size": queue_position + 1})
+        try:
+            task_queue.put_nowait(task)
+        except Full:
+            return None
+    # 按优先级和用户轮转调度，新任务可能排在已有任务之前
+    update_queue_positions()
+    return task_queue.position(task_id)
+
+def mark_task_started(task, backend):
     with task_lock:
-        if not task_queue.empty():
-            next_task = task_queue.queue[0]  # 获取但不移除下一个任务
-            next_ip = next_task.get('ip_address', 'unknown')
-            next_user_id = next_task.get('user_id', 'unknown')
-            threading.Thread(target=process_task, args=(next_task, next_user_id, next_ip)).start()
-            logger.info(f"Starting next task in queue: {next_task['task_id']}")
-
-def process_task(task, user_id, ip_address):
+        set_task_status(task['task_id'], {"status": "处理中", "progress": 0, "queuePosition": 0, "max_queue_size": task_queue.qsize(), "backend": backend.name})
+    update_queue_positions()
+
+def batch_key_for(task):
+    """计算可合并任务的分组键，不可合并时返回 None
+
+    txt2img 一次调用只接受一个提示词和一个起始种子，WebUI 为批次中的第 i 张图片使用种子 seed + i。
+    因此提示词和生成参数相同的任务才能合并：批次的第一个任务可以使用固定种子，合并进来的任务
+    必须使用随机种子，按顺序接在后面，实际种子从返回的 all_seeds 中读取。
+    """
+    if not ENABLE_BATCH_COALESCING or task['type'] != 'generate':
+        return None
+    params = [task['model'], task['prompt'], task['negative_prompt'], task['steps'], task['width'], task['height']]
+    return hashlib.sha256(json.dumps(params, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def companion_batch_key(task):
+    """写入任务记录的分组键：只有随机种子的任务可以被合并到其他任务的批次中"""
+    return batch_key_for(task) if task['seed'] == -1 else None
+
+def claim_batch_companions(task, backend):
+    """为即将执行的生成任务认领可以合并到同一次调用的排队任务"""
+    batch_key = batch_key_for(task)
+    capacity = MAX_BATCH_SIZE - task['num_images']
+    if not batch_key or capacity <= 0:
+        return []
+    companions = task_store.claim_batch(batch_key, capacity, lambda t: t['num_images'])
+    for companion in companions:
+        logger.info(f"任务 {companion['task_id']} 合并到任务 {task['task_id']} 的批次中执行")
+        mark_task_started(companion, backend)
+    return companions
+
+def process_task(task, backend):
     task_id = task['task_id']
-    logger.info(f"Processing task {task_id} for user {user_id}")
+    user_id = task.get('user_id', 'unknown')
+    logger.info(f"Processing task {task_id} for user {user_id} on backend {backend.name}")
+    backend_ok = True
+    backend_error = None
+    batch = [task]
     
     try:
         if task['type'] == 'inpaint':
             logger.info(f"Starting inpainting task {task_id}")
-            result = inpaint_image(task)
+            result = inpaint_image(task, backend)
             if 'error' in result:
                 logger.error(f"Inpainting task {task_id} failed: {result['error']}")
+                if result.get('backend_error'):
+                    backend_ok, backend_error = False, result['error']
                 update_task_status(task_id, f"重绘失败: {result['error']}", 100, user_id=user_id)
             else:
                 logger.info(f"Inpainting task {task_id} completed successfully")
@@ -165,98 +409,216 @@ def process_task(task, user_id, ip_address):
                                    inpaint_prompt=result['inpaint_prompt'],
                                    user_id=user_id)
         elif task['type'] == 'generate':
-            logger.info(f"Starting image generation task {task_id}")
-            seeds, file_names, save_time = generate_images(task)
-            logger.info(f"Image generation task {task_id} completed")
-            update_task_status(task_id, "完成", 100, seeds=seeds, file_names=file_names, translated_prompt=task['prompt'], user_id=user_id, save_time=save_time)
+            batch += claim_batch_companions(task, backend)
+            logger.info(f"Starting image generation task {task_id} (batch of {len(batch)} tasks)")
+            results = generate_images(batch, backend)
+            for batch_task, (seeds, file_names, save_time) in zip(batch, results):
+                logger.info(f"Image generation task {batch_task['task_id']} completed")
+                update_task_status(batch_task['task_id'], "完成", 100, seeds=seeds, file_names=file_names, translated_prompt=batch_task['prompt'], user_id=batch_task.get('user_id', 'unknown'), save_time=save_time)
         else:
             logger.error(f"Unknown task type for task {task_id}: {task['type']}")
             raise ValueError(f"未知的任务类型: {task['type']}")
+    except BackendError as e:
+        logger.error(f"Backend {backend.name} failed while processing task {task_id}: {str(e)}")
+        backend_ok, backend_error = False, e
+        for batch_task in batch:
+            update_task_status(batch_task['task_id'], f"失败: {str(e)}", 100, user_id=batch_task.get('user_id', 'unknown'))
     except Exception as e:
         logger.error(f"Error processing task {task_id}: {str(e)}")
-        update_task_status(task_id, f"失败: {str(e)}", 100, user_id=user_id)
+        for batch_task in batch:
+            update_task_status(batch_task['task_id'], f"失败: {str(e)}", 100, user_id=batch_task.get('user_id', 'unknown'))
     finally:
-        with task_lock:
-            if not task_queue.empty():
-                task_queue.get()  # 移除当前任务
-            global current_task
-            current_task = None
-        if ENABLE_IP_RESTRICTION:
-            with ip_lock:
-                active_ip_requests.pop(ip_address, None)
-        update_queue_positions()
-        start_next_task()  # 调用新函数启动下一个任务
+        # 最终状态写入后才确认任务完成，进程中途退出时任务会在重启后重新执行
+        for batch_task in batch:
+            task_store.complete(batch_task['task_id'])
+        backend_pool.release(backend, success=backend_ok, error=backend_error)
+        for batch_task in batch:
+            release_ip_request(batch_task.get('ip_address', 'unknown'))
 
 def update_queue_positions():
+    # 只写入位置发生变化的任务；队列长度在读取状态时实时计算，新任务排到队尾时不会改写其他任务的状态
+    queued_ids = task_queue.queued_ids()
     with task_lock:
-        for i, task in enumerate(list(task_queue.queue)):
-            task_id = task['task_id']
-            if task_id in task_status and task_status[task_id]['status'] == "排队中":
-                task_status[task_id]['queuePosition'] = i
-                task_status[task_id]['max_queue_size'] = task_queue.qsize()
+        for i, task_id in enumerate(queued_ids):
+            status = state.get_status(task_id)
+            if status and status['status'] == "排队中" and status.get('queuePosition') != i:
+                status['queuePosition'] = i
+                status['max_queue_size'] = len(queued_ids)
+                set_task_status(task_id, status)
+
+def set_task_status(task_id, status):
+    # 调用方需持有 task_lock
+    state.set_status(task_id, status)
+    task_status_changed.notify_all()
+
+def lookup_task_status(task_id):
+    return state.get_status(task_id)
+
 def update_task_status(task_id, status, progress, **kwargs):
     with task_lock:
-        task_status[task_id] = {
+        set_task_status(task_id, {
             "status": status,
             "progress": progress,
             **kwargs
-        }
+        })
     # logger.info(f"更新任务状态: task_id={task_id}, status={status}, progress={progress}, extra_info={kwargs}")
 
-def set_model_and_lora(task):
-    options_payload = {
-        "sd_model_checkpoint": SD_MODEL,
-    }
-    
-    if "<lora:" in task['model']:
-        lora_info = task['model'].split("<lora:")[1].split(">")[0]
-        lora_name, lora_weight = lora_info.split(":")
-        if not lora_name.endswith('.safetensors'):
-            lora_name += '.safetensors'
-        options_payload["sd_lora"] = f"{lora_name}:{lora_weight}"
-    
-    options_url = f"{SD_URL}/sdapi/v1/options"
+def track_progress(task_ids, backend, status_text, start=0, end=100):
+    """在 SD 请求期间采样后端进度，把实际百分比、剩余时间和可选的预览图写入 task_status
+
+    task_ids 可以是单个任务 ID，也可以是合并执行的一批任务 ID。
+    """
+    if isinstance(task_ids, str):
+        task_ids = [task_ids]
+
+    def fetch_progress():
+        response = sd_session.get(f"{backend.url}/sdapi/v1/progress",
+                                  params={"skip_current_image": "false" if SD_PROGRESS_PREVIEW else "true"},
+                                  timeout=(HTTP_CONNECT_TIMEOUT, 5))
+        response.raise_for_status()
+        return response.json()
+
+    def on_progress(sample):
+        extra = {"eta": sample['eta'], "step": sample['step'], "steps": sample['steps']}
+        if SD_PROGRESS_PREVIEW and sample['preview']:
+            extra['preview'] = f"data:image/png;base64,{sample['preview']}"
+        progress = start + int(sample['progress'] * (end - start))
+        for task_id in task_ids:
+            update_task_status(task_id, status_text, min(progress, end), **extra)
+
+    return ProgressSampler(fetch_progress, on_progress, interval=SD_PROGRESS_INTERVAL)
+
+def task_checkpoint(task):
+    """任务使用的模型的规范化名称：生成任务为 task['model'] 去掉 LoRA 后的模型，重绘任务为请求指定的模型"""
+    return checkpoint_name(task.get('model_name') if task['type'] == 'inpaint' else task['model'])
+
+def fetch_backend_options(backend):
+    response = sd_session.get(f"{backend.url}/sdapi/v1/options", timeout=(HTTP_CONNECT_TIMEOUT, 30))
+    response.raise_for_status()
+    return response.json()
+
+def options_applied(current, expected):
+    for key, value in expected.items():
+        if key == 'sd_model_checkpoint':
+            if checkpoint_name(current.get(key)) != checkpoint_name(value):
+                return False
+        elif current.get(key) != value:
+            return False
+    return True
+
+def apply_backend_options(backend, options_payload, previous_checkpoint=None):
+    """写入 WebUI 选项，并轮询 /sdapi/v1/options 直到设置生效
+
+    WebUI 报告的模型名与配置不完全一致（例如不同的标题格式）时只记录警告，不把后端标记为失败：
+    previous_checkpoint 为切换前的模型，报告的模型已不同于它时视为切换完成。
+    """
+    expected_checkpoint = options_payload.get('sd_model_checkpoint')
+    others = {k: v for k, v in options_payload.items() if k != 'sd_model_checkpoint'}
     try:
-        # logger.info(f"设置模型和LoRA: {options_payload}")
-        options_response = requests.post(url=options_url, json=options_payload, verify=False, timeout=30)
-        options_response.raise_for_status()
-        # logger.info("成功设置模型和LoRA")
-        
-        # 添加3秒延迟
-        # logger.info("等待3秒钟以确保设置生效...")
-        time.sleep(3)
-        # logger.info("延迟结束，继续处理")
+        response = sd_session.post(url=f"{backend.url}/sdapi/v1/options", json=options_payload,
+                                   timeout=(HTTP_CONNECT_TIMEOUT, MODEL_SWITCH_TIMEOUT))
+        response.raise_for_status()
+        deadline = time.time() + MODEL_SWITCH_TIMEOUT
+        while True:
+            current = fetch_backend_options(backend)
+            if options_applied(current, others):
+                reported = current.get('sd_model_checkpoint')
+                if expected_checkpoint is None or checkpoint_name(reported) == checkpoint_name(expected_checkpoint):
+                    return
+                if previous_checkpoint is not None and reported != previous_checkpoint:
+                    logger.warning(f"后端 {backend.name} 报告的模型 {reported} 与配置的 {expected_checkpoint} 不一致")
+                    return
+            if time.time() >= deadline:
+                if options_applied(current, others):
+                    logger.warning(f"后端 {backend.name} 的模型仍为 {current.get('sd_model_checkpoint')}，"
+                                   f"与配置的 {expected_checkpoint} 不一致，继续使用该后端")
+                    return
+                raise BackendError(f"等待设置生效超时（{MODEL_SWITCH_TIMEOUT} 秒）: {options_payload}")
+            time.sleep(MODEL_SWITCH_POLL_INTERVAL)
     except requests.exceptions.RequestException as e:
-        # logger.error(f"设置模型和LoRA失败: {str(e)}")
-        raise Exception(f"设置模型和LoRA失败: {str(e)}")
+        raise BackendError(f"设置模型失败: {str(e)}")
 
-def png_to_jpg_base64(png_base64):
-    # 解码 PNG base64 数据
-    png_data = base64.b64decode(png_base64)
-    
-    # 打开 PNG 图像
-    with PILImage.open(io.BytesIO(png_data)) as img:
-        # 转换为 RGB 模式（去除 alpha 通道）
-        img = img.convert('RGB')
-        
-        # 创建一个字节流来保存 JPEG
-        jpg_buffer = io.BytesIO()
-        
-        # 保存为 JPEG，设置质量为 85（可以根据需要调整）
-        img.save(jpg_buffer, format='JPEG', quality=85)
-        
-        # 获取 JPEG 字节数据并编码为 base64
-        jpg_base64 = base64.b64encode(jpg_buffer.getvalue()).decode('utf-8')
-    
-    return jpg_base64
+def ensure_backend_model(backend, checkpoint):
+    """确保后端已加载指定模型，只有模型不同时才切换"""
+    if not checkpoint or checkpoint_name(backend.loaded_model) == checkpoint_name(checkpoint):
+        return
+    try:
+        current = fetch_backend_options(backend).get('sd_model_checkpoint')
+    except requests.exceptions.RequestException as e:
+        raise BackendError(f"查询后端模型失败: {str(e)}")
+    if checkpoint_name(current) != checkpoint_name(checkpoint):
+        logger.info(f"后端 {backend.name} 切换模型: {current} -> {checkpoint}")
+        apply_backend_options(backend, {"sd_model_checkpoint": checkpoint}, previous_checkpoint=current)
+    backend.loaded_model = checkpoint
+
+def make_thumbnail(img):
+    # 按最大边长等比缩放并编码为 WebP
+    return encode_thumbnail(img, THUMBNAIL_SIZE, THUMBNAIL_QUALITY)
+
+def png_to_jpg(png_data):
+    """把 PNG 字节转换为历史记录使用的 JPEG（质量 85）和缩略图，返回 (jpg_bytes, thumb_bytes)"""
+    args = (png_data, 85, THUMBNAIL_SIZE, THUMBNAIL_QUALITY)
+    pool = get_postprocess_pool()
+    if pool is not None:
+        try:
+            return pool.submit(encode_history_images, *args).result()
+        except BrokenProcessPool:
+            logger.error("图片处理进程池已损坏，改为在当前线程中编码")
+        except RuntimeError:
+            # 解释器退出时进程池会先于 atexit 回调关闭，之后的历史图片都在当前线程中编码
+            postprocess_pool_closed.set()
+            logger.warning("图片处理进程池已关闭，改为在当前线程中编码")
+    return encode_history_images(*args)
+
+def save_history_images(png_data):
+    """把生成结果写入内容寻址存储，返回 (image_key, thumb_key)"""
+    jpg_data, thumb_data = png_to_jpg(png_data)
+    return image_store.put(jpg_data, 'jpg'), image_store.put(thumb_data, 'webp')
+
+def store_history(user_id, entries):
+    """编码历史图片并写入数据库，entries 为 (PNG 字节, 图片记录字段) 列表，在后处理线程中执行"""
+    images_to_save = []
+    for i, (png_data, fields) in enumerate(entries):
+        try:
+            # 将 PNG 转换为 JPEG 和缩略图并写入内容寻址存储
+            image_key, thumb_key = save_history_images(png_data)
+            images_to_save.append({**fields, 'image_key': image_key, 'thumb_key': thumb_key})
+        except Exception as e:
+            logger.error(f"处理历史图片 {i+1} 时出错: {str(e)}")
+            logger.error(f"错误详情: {traceback.format_exc()}")
 
-def generate_images(task):
-    # 首先设置模型和LoRA
-    # webui已经加载，不需要每次生成图片都设置模型和LoRA
-    # set_model_and_lora(task)
+    # 在应用上下文中保存图片信息到数据库
+    with app.app_context():
+        try:
+            for img_info in images_to_save:
+                db.session.add(Image(**img_info))
+            db.session.commit()
+            invalidate_history_count(user_id)
+            logger.info(f"成功保存 {len(images_to_save)} 张图片信息到数据库")
+        except Exception as e:
+            logger.error(f"保存图片信息到数据库时出错: {str(e)}")
+            logger.error(f"错误详情: {traceback.format_exc()}")
+            db.session.rollback()
 
-    # 然后生成图像
-    payload = {
+def submit_history(user_id, entries):
+    if entries:
+        history_executor.submit(store_history, user_id, entries)
+
+def load_image_bytes(image):
+    """读取历史图片的 JPEG 数据，兼容尚未迁移到 image_store 的旧数据"""
+    if image.image_key:
+        return image_store.get(image.image_key)
+    return base64.b64decode(image.base64) if image.base64 else None
+
+def delete_stored_image(image_key, thumb_key=None):
+    # 内容寻址存储可能被多条记录共享，只有没有其他引用时才删除文件
+    if image_key and not Image.query.filter_by(image_key=image_key).first():
+        image_store.delete(image_key)
+    if thumb_key and not Image.query.filter_by(thumb_key=thumb_key).first():
+        image_store.delete(thumb_key)
+
+def build_txt2img_payload(task, batch_size):
+    return {
         "prompt": task['prompt'],
         "negative_prompt": task['negative_prompt'],
         "steps": task['steps'],  # 使用传入的 steps，如果没有则默认为 15
@@ -266,20 +628,43 @@ def generate_images(task):
         "width": task['width'],
         "height": task['height'],
         "seed": task['seed'],
-        "batch_size": task['num_images'],
+        "batch_size": batch_size,
     }
 
+def result_cache_key(task):
+    """固定种子的生成结果可以复用，key 由完整的 txt2img 参数和模型决定；随机种子返回 None"""
+    if result_cache is None or task['type'] != 'generate' or task['seed'] == -1:
+        return None
+    return result_key({"model": SD_MODEL, "payload": build_txt2img_payload(task, task['num_images'])})
+
+def generate_images(tasks, backend):
+    """用一次 txt2img 调用生成一批参数相同的任务，返回每个任务的 (seeds, saved_files, timestamp)"""
+    task = tasks[0]
+    task_ids = [t['task_id'] for t in tasks]
+    batch_size = sum(t['num_images'] for t in tasks)
+
+    # LoRA 通过提示词中的 <lora:...> 加载，只需确认后端当前的模型（可能被重绘任务切换过）
+    ensure_backend_model(backend, SD_MODEL)
+
+    # 然后生成图像
+    payload = build_txt2img_payload(task, batch_size)
+
     # logger.debug(f"Payload: {json.dumps(payload, indent=2)}")
 
-    update_task_status(task['task_id'], f"正在使用模型 {SD_MODEL} 生成图片...", 0)
+    status_text = f"正在使用模型 {SD_MODEL} 生成图片..."
+    for task_id in task_ids:
+        update_task_status(task_id, status_text, 0)
     try:
-        # logger.info(f"送请到 {SD_URL}/sdapi/v1/txt2img")
-        response = requests.post(url=f'{SD_URL}/sdapi/v1/txt2img', json=payload, verify=False, timeout=120)
+        # logger.info(f"送请到 {backend.url}/sdapi/v1/txt2img")
+        with track_progress(task_ids, backend, status_text):
+            response = sd_session.post(url=f'{backend.url}/sdapi/v1/txt2img', json=payload, stream=True,
+                                       timeout=(HTTP_CONNECT_TIMEOUT, SD_REQUEST_TIMEOUT))
         response.raise_for_status()
-        r = response.json()
-    except requests.exceptions.RequestException as e:
+        # 流式解析响应，每张图片只做一次 base64 解码，images 为 PNG 字节
+        r = read_sd_response(response)
+    except (requests.exceptions.RequestException, ValueError) as e:
         logger.error(f"生成图片请求失: {str(e)}")
-        raise Exception(f"生成图片请求失败: {str(e)}")
+        raise BackendError(f"生成图片请求失败: {str(e)}")
 
     images = r['images']
     num_images_received = len(images)
@@ -300,46 +685,99 @@ def generate_images(task):
     seeds = info.get('all_seeds', [task['seed']] * num_images_received)
     # logger.debug(f"种子列表: {seeds}")
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    task_output_dir = os.path.join(OUTPUT_DIR, task['task_id'])
+    # 批量生成时 WebUI 可能在最前面附带一张网格图，按请求的数量只保留最后 batch_size 张
+    if num_images_received > batch_size:
+        images = images[-batch_size:]
+    seeds = seeds[-batch_size:] if len(seeds) > batch_size else seeds
+
+    # 固定种子只可能出现在批次的第一个任务中，它的图片与单独执行时相同，可以写入结果缓存
+    cache_key = result_cache_key(task)
+    if cache_key and len(images) == batch_size and len(seeds) == batch_size:
+        try:
+            result_cache.put(cache_key, images[:task['num_images']], seeds[:task['num_images']])
+        except Exception as e:
+            logger.error(f"保存结果缓存失败: {str(e)}")
+
+    results = []
+    offset = 0
+    for t in tasks:
+        count = t['num_images']
+        results.append(save_generated_images(t, images[offset:offset + count], seeds[offset:offset + count]))
+        offset += count
+    return results
+
+def complete_from_result_cache(task):
+    """固定种子的任务命中结果缓存时，直接用缓存的图片完成任务，返回是否命中"""
+    cache_key = result_cache_key(task)
+    if not cache_key:
+        return False
+    try:
+        cached = result_cache.get(cache_key)
+        if cached is None:
+            return False
+        paths, seeds = cached
+        images = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+    except Exception as e:
+        # 缓存不可用时按正常流程生成
+        logger.error(f"读取结果缓存失败: {str(e)}")
+        return False
+    logger.info(f"任务 {task['task_id']} 命中结果缓存，跳过生成")
+    seeds, file_names, save_time = save_generated_images(task, images, seeds)
+    update_task_status(task['task_id'], "完成", 100, seeds=seeds, file_names=file_names, translated_prompt=task['prompt'],
+                       user_id=task.get('user_id', 'unknown'), save_time=save_time, cached=True)
+    return True
+
+def create_output_dir(task_id):
+    """创建任务的图片输出目录，并登记到过期索引中"""
+    task_output_dir = os.path.join(OUTPUT_DIR, task_id)
     os.makedirs(task_output_dir, exist_ok=True)
+    try:
+        image_expiry.register(task_id, CLEANER_RETENTION_HOURS * 3600)
+    except sqlite3.Error as e:
+        logger.error(f"登记图片目录过期时间失败，任务ID: {task_id}, 错误: {str(e)}")
+    return task_output_dir
+
+def save_generated_images(task, images, seeds):
+    """保存一个任务的生成结果并提交历史记录的后处理，返回 (seeds, saved_files, timestamp)"""
+    num_images_received = len(images)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    task_output_dir = create_output_dir(task['task_id'])
 
     saved_files = []
-    images_to_save = []  # 用于存储需要保存到数据库的图片信息
+    history_entries = []  # 需要编码并保存到数据库的图片
 
     ai_response_content = '### 生成的图片\n\n'
     ai_response_content += f'**Prompt:** {task["prompt"]}\n\n'
     ai_response_content += '<div class="container_sd">\n'
 
-    for i, img_data in enumerate(images):
+    for i, png_data in enumerate(images):
         # logger.debug(f"处理图片 {i+1}/{num_images_received}")
-        # logger.debug(f"图片数据前100个字符: {img_data[:100]}")
         
         try:
-            # 直接解码 base64 数据
-            img = PILImage.open(io.BytesIO(base64.b64decode(img_data)))
             file_name = f"{timestamp}_{seeds[i]}.png"
             logger.debug(f"正在保存图片: {file_name}")
             file_path = os.path.join(task_output_dir, file_name)
-            img.save(file_path)
+            # 后端返回的已经是 PNG，直接写入，不再重新编码
+            with open(file_path, 'wb') as f:
+                f.write(png_data)
             saved_files.append(file_name)
 
             relative_path = f"/images/sd/{task['task_id']}/{file_name}"
             ai_response_content += f'<img src="{relative_path}" alt="Generated image {i+1}">\n'
 
-            # 将 PNG base64 转换为 JPEG base64
-            jpg_base64 = png_to_jpg_base64(img_data)
-
             # 将图片信息添加到待保存列表
-            images_to_save.append({
+            history_entries.append((png_data, {
                 'user_id': task['user_id'],
                 'prompt': task['prompt'],
-                'base64': jpg_base64,  # 使用转换后的 JPEG base64
+                'original_prompt': task.get('original_prompt'),
                 'seed': seeds[i],
                 'model': SD_MODEL,
                 'lora': task.get('lora', ''),
                 'created_at': datetime.utcnow()
-            })
+            }))
 
         except Exception as e:
             logger.error(f"处理图片 {i+1} 时出错: {str(e)}")
@@ -349,23 +787,18 @@ def generate_images(task):
     ai_response_content += '</div>\n\n'
     ai_response_content += f'**Seeds:** {", ".join(map(str, seeds[:num_images_received]))}\n\n'
 
-    # 在应用上下文中保存图片信息到数据库
-    with app.app_context():
-        try:
-            for img_info in images_to_save:
-                new_image = Image(**img_info)
-                db.session.add(new_image)
-            db.session.commit()
-            logger.info(f"成功保存 {len(images_to_save)} 张图片信息到数据库")
-        except Exception as e:
-            logger.error(f"保存图片信息到数据库时出错: {str(e)}")
-            logger.error(f"错误详情: {traceback.format_exc()}")
-            db.session.rollback()
+    # JPEG、缩略图的编码和数据库写入在后处理线程中完成，不占用 SD 后端
+    submit_history(task['user_id'], history_entries)
 
     update_task_status(task['task_id'], "所有图片生成完成", 100)
     return seeds, saved_files, timestamp
 
 def check_prompt_with_chatgpt(prompt):
+    cache_key = normalize_prompt(prompt)
+    cached = moderation_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
         # logger.info(f"正在检查提示词: {prompt}")
         response = client.chat.completions.create(
@@ -383,12 +816,19 @@ def check_prompt_with_chatgpt(prompt):
 
         result = response.choices[0].message.content.strip().lower()
         # logger.info(f"ChatGPT 审核结: {result}")
+        # 只缓存成功的审核结果，API 失败时的默认放行不缓存
+        moderation_cache.set(cache_key, result == '是')
         return result == '是'
     except Exception as e:
         # logger.error(f"ChatGPT API调用错误: {str(e)}")
         return False  # 如果API用失败，我们假设内容是安全的
 
 def translate_to_english(prompt):
+    cache_key = normalize_prompt(prompt)
+    cached = translation_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
         # logger.info(f"正在将提示词翻译为英语: {prompt}")
         response = client.chat.completions.create(
@@ -405,11 +845,118 @@ def translate_to_english(prompt):
 
         translated_prompt = response.choices[0].message.content.strip()
         # logger.info(f"翻译结果: {translated_prompt}")
+        translation_cache.set(cache_key, translated_prompt)
         return translated_prompt
     except Exception as e:
         # logger.error(f"ChatGPT API调用错误: {str(e)}")
         return prompt  # 如果API调用失败，返回原始prompt
 
+def moderate_and_translate(prompt, translate, fallback, on_moderated=None):
+    """并发执行审核和翻译，返回 (是否包含不当内容, 翻译结果)
+
+    审核未通过时直接返回，不再等待翻译结果；超过 LLM_DEADLINE_SECONDS 时
+    与 API 调用失败的处理一致：审核视为通过，翻译退回 fallback。
+    """
+    if not prompt:
+        return False, ''
+
+    deadline = time.time() + LLM_DEADLINE_SECONDS
+    moderation_future = llm_executor.submit(check_prompt_with_chatgpt, prompt)
+    translation_future = llm_executor.submit(translate)
+
+    try:
+        contains_inappropriate_content = moderation_future.result(timeout=max(deadline - time.time(), 0))
+    except FutureTimeoutError:
+        logger.warning(f"提示词审核超时（{LLM_DEADLINE_SECONDS} 秒），按审核通过处理")
+        contains_inappropriate_content = False
+    if contains_inappropriate_content:
+        translation_future.cancel()
+        return True, None
+    if on_moderated and not translation_future.done():
+        on_moderated()
+
+    try:
+        translated_prompt = translation_future.result(timeout=max(deadline - time.time(), 0))
+    except FutureTimeoutError:
+        logger.warning(f"提示词翻译超时（{LLM_DEADLINE_SECONDS} 秒），使用原始提示词")
+        translated_prompt = fallback
+    return False, translated_prompt
+
+def acquire_ip_request(ip_address):
+    # 只在启用 IP 限制时检查
+    return not ENABLE_IP_RESTRICTION or state.try_acquire_ip(ip_address, owner=task_store.worker_id)
+
+def hold_ip_request(ip_address):
+    if ENABLE_IP_RESTRICTION:
+        state.hold_ip(ip_address, owner=task_store.worker_id)
+
+def release_ip_request(ip_address):
+    if ENABLE_IP_RESTRICTION:
+        state.release_ip(ip_address)
+
+def submit_preprocess(task):
+    """接受已登记的任务并立即返回，审核和翻译在预处理线程中完成后再加入队列"""
+    update_task_status(task['task_id'], "审核中", 0)
+    preprocess_executor.submit(preprocess_task, task)
+
+def register_task(task, user_info):
+    """登记新任务并占用队列名额，用户未完成的任务数达到上限时返回 False，队列已满时抛出 queue.Full"""
+    task['priority'] = user_info.get('trust_level', 0) if PRIORITY_BY_TRUST_LEVEL else 0
+    return task_store.add(task, max_per_user=MAX_TASKS_PER_USER)
+
+def preprocess_task(task):
+    task_id = task['task_id']
+    prompt = task['original_prompt']
+    tmp_id = task.get('tmp_id')
+    failure_status = "重绘失败" if task['type'] == 'inpaint' else "失败"
+    if task.get('prompt_optimize'):
+        # 使用对话历史进行翻译
+        history = list(get_conversation(tmp_id))
+        translate = lambda: translate_to_english_with_history(prompt, history, tmp_id)
+    else:
+        # 单次翻译，不使用对话历史
+        translate = lambda: translate_to_english(prompt)
+
+    try:
+        contains_inappropriate_content, translated_prompt = moderate_and_translate(
+            prompt, translate, prompt, on_moderated=lambda: update_task_status(task_id, "翻译中", 0))
+        if contains_inappropriate_content:
+            error = "提示词可能包含不适当的内容。请修改后重试。"
+            logger.info(f"任务 {task_id} 的提示词未通过审核")
+            update_task_status(task_id, f"{failure_status}: {error}", 100, error=error)
+            task_store.complete(task_id)
+            release_ip_request(task['ip_address'])
+            return
+
+        if task.get('prompt_optimize'):
+            append_conversation(tmp_id, prompt, translated_prompt)
+        task['prompt'] = translated_prompt + task.get('prompt_suffix', '')
+        task['batch_key'] = companion_batch_key(task)
+        task['checkpoint'] = task_checkpoint(task)
+
+        # 相同参数、固定种子的结果已生成过时，不再排队占用 SD 后端
+        if complete_from_result_cache(task):
+            task_store.complete(task_id)
+            release_ip_request(task['ip_address'])
+            return
+        logger.info(f"任务 {task_id} 预处理完成: original_prompt='{prompt}', translated_prompt='{task['prompt']}'")
+
+        if enqueue_task(task) is None:
+            if not accepting_tasks():
+                # 服务正在停止：任务保持预处理状态，由主进程恢复后重新预处理
+                logger.info(f"服务正在停止，任务 {task_id} 留待主进程恢复")
+                return
+            error = "队列已满，请稍后再试"
+            update_task_status(task_id, f"{failure_status}: {error}", 100, error=error)
+            task_store.complete(task_id)
+            release_ip_request(task['ip_address'])
+    except Exception as e:
+        logger.error(f"处理提示词时出错: {str(e)}")
+        error = "处理提示词时出现错误，请稍后重试。"
+        update_task_status(task_id, f"{failure_status}: {error}", 100, error=error)
+        task_store.complete(task_id)
+        release_ip_request(task['ip_address'])
+
 @app.route('/')
 def index():
     return send_from_directory(os.path.join(root_dir, 'static'), 'index_m.html')
@@ -427,6 +974,28 @@ def log_request_info():
     ip = get_client_ip()
     logger.info(f'Request from IP: {ip}, Path: {request.path}, Method: {request.method}')
 
+def jwt_cache_key(jwt_token):
+    return hashlib.sha256(jwt_token.encode('utf-8')).hexdigest()
+
+def verify_jwt(jwt_token):
+    """验证 JWT 并返回 payload，验证结果按令牌哈希缓存到令牌过期为止"""
+    cache_key = jwt_cache_key(jwt_token)
+    payload = jwt_cache.get(cache_key)
+    if payload is not None:
+        return payload
+    payload = jwt.decode(jwt_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    exp = payload.get('exp')
+    ttl = JWT_CACHE_TTL_SECONDS if exp is None else min(JWT_CACHE_TTL_SECONDS, exp - time.time())
+    if ttl > 0:
+        jwt_cache.set(cache_key, payload, ttl=ttl)
+    return payload
+
+def update_session(**values):
+    # 只写入发生变化的值，避免每个请求都重新签名并下发 session cookie
+    for key, value in values.items():
+        if session.get(key) != value:
+            session[key] = value
+
 def require_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -444,17 +1013,15 @@ def require_auth(f):
             # logger.info(f"使用的 JWT_ALGORITHM: {JWT_ALGORITHM}")
             
             # 解码和验证 JWT
-            payload = jwt.decode(jwt_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+            payload = verify_jwt(jwt_token)
             # logger.info(f"JWT 成功解码，payload: {payload}")
             
             user_info = payload.get('user_info', {})
             original_access_token = payload.get('access_token')
             
             logger.info(f"JWT 验证成功，用户ID: {user_info.get('id')}")
-            # 更新 session 中的用户信息
-            session['user_info'] = user_info
-            session['user_id'] = user_info.get('id')
-            session['access_token'] = original_access_token  # 保存原始 access token
+            # 更新 session 中的用户信息，保存原始 access token
+            update_session(user_info=user_info, user_id=user_info.get('id'), access_token=original_access_token)
         except jwt.ExpiredSignatureError:
             logger.warning("JWT 已过期，尝试刷新")
             # 尝试刷新令牌
@@ -478,9 +1045,30 @@ def require_auth(f):
 
     return decorated
 
+def require_auth_light(f):
+    """用于状态轮询等高频接口的认证：只验证 JWT，不写 session、不记录 INFO 日志
+
+    JWT 缺失、过期或无效时交给 require_auth 处理（刷新令牌或返回 401）。
+    """
+    full = require_auth(f)
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        jwt_token = request.cookies.get('jwt_token') or session.get('jwt_token')
+        if not jwt_token:
+            return full(*args, **kwargs)
+        try:
+            verify_jwt(jwt_token)
+        except jwt.InvalidTokenError:
+            return full(*args, **kwargs)
+        return f(*args, **kwargs)
+
+    return decorated
+
 def check_token(token):
     try:
-        response = requests.post(f"{AUTH_SERVICE_URL}/oauth2/validate", json={"access_token": token})
+        response = auth_session.post(f"{AUTH_SERVICE_URL}/oauth2/validate", json={"access_token": token},
+                                     timeout=(HTTP_CONNECT_TIMEOUT, AUTH_REQUEST_TIMEOUT))
         if response.status_code == 200:
             user_info = response.json().get('user_info')
             if user_info:
@@ -509,12 +1097,8 @@ def generate():
     ip_address = get_client_ip()
     logger.info(f"请求 IP 地址: {ip_address}")
 
-    # 只在启用 IP 限制时检查
-    if ENABLE_IP_RESTRICTION:
-        with ip_lock:
-            if ip_address in active_ip_requests:
-                return jsonify({"error": "您已有一个活跃请求，请等待当前请求完成后再试"}), 429
-            active_ip_requests[ip_address] = True
+    if not acquire_ip_request(ip_address):
+        return jsonify({"error": "您已有一个活跃请求，请等待当前请求完成后再试"}), 429
 
     prompt = data.get('prompt')
     prompt_optimize = data.get('prompt_optimize', False)
@@ -527,96 +1111,130 @@ def generate():
     else:
         prompt = prompt.strip()  # 移除首尾的空白字符
     
-    try:
-        contains_inappropriate_content = check_prompt_with_chatgpt(prompt) if prompt else False
-        if contains_inappropriate_content:
-            if ENABLE_IP_RESTRICTION:
-                with ip_lock:
-                    active_ip_requests.pop(ip_address, None)
-            return jsonify({"error": "提示词可能包含不适当的内容。请修改后重试。"}), 400
-
-        if prompt_optimize:
-            # 获取用户的对话历史
-            conversation_history = user_conversations[tmp_id]         
-            
-            # 使用对话历史进行翻译
-            translated_prompt = translate_to_english_with_history(prompt, list(conversation_history), tmp_id)
-            
-            # 添加user和AI的回复（右进）
-            conversation_history.append({"role": "user", "content": prompt})
-            conversation_history.append({"role": "assistant", "content": translated_prompt})
-            
-            # 如果超出最大轮数，最早的对话会自动被移除（左出）
-        else:
-            # 单次翻译，不使用对话历史
-            translated_prompt = translate_to_english(prompt) if prompt else ''
-        
-        task_id = str(uuid4())
-        logger.info(f"创建新的重绘任务: task_id={task_id}, original_prompt='{prompt}', translated_prompt='{translated_prompt}'")
+    if not accepting_tasks() or task_queue.full():
+        release_ip_request(ip_address)
+        return jsonify({"error": "队列已满，请稍后再试"}), 429
 
+    try:
         # 构建模型参数
         model_params = SD_MODEL
+        prompt_suffix = ''
         if data.get('lora', False):
             lora_name = data.get('lora_name', '')
             lora_trigger_words = data.get('lora_trigger_words', '')
             lora_weight = data.get('lora_weight', 0.7)  # 默认权重为0.7
             model_params += f"<lora:{lora_name}:{lora_weight}>"
             # 将 lora 信息添加到 prompt 
-            translated_prompt += f", {lora_trigger_words}"
-            translated_prompt += f", <lora:{lora_name}:{lora_weight}>"
+            prompt_suffix += f", {lora_trigger_words}"
+            prompt_suffix += f", <lora:{lora_name}:{lora_weight}>"
 
         task_id = str(uuid4())
+        logger.info(f"创建新的生成任务: task_id={task_id}, original_prompt='{prompt}'")
 
         task = {
             'task_id': task_id,
             'type': 'generate',
             'model': model_params,
-            'prompt': translated_prompt,
+            'prompt': None,  # 预处理完成后写入翻译结果
+            'original_prompt': prompt,
             'negative_prompt': data.get('negative_prompt', 'NSFW'),
             'steps': data.get('steps', 15),  # 添加步数，默认为15
             'width': data.get('width', 512),
             'height': data.get('height', 512),
             'num_images': data.get('num_images', 1),
             'seed': data.get('seed', -1),
+            'prompt_optimize': prompt_optimize,
+            'tmp_id': tmp_id,
+            'prompt_suffix': prompt_suffix,
             'ip_address': ip_address,
             'user_id': session['user_id']  # 添加用户ID到任务中
         }
 
-        if task_queue.qsize() >= MAX_QUEUE_SIZE:
-            if ENABLE_IP_RESTRICTION:
-                with ip_lock:
-                    active_ip_requests.pop(ip_address, None)
+        # 每个用户未完成的任务数有上限，避免个别用户占满队列
+        try:
+            registered = register_task(task, user_info)
+        except Full:
+            release_ip_request(ip_address)
             return jsonify({"error": "队列已满，请稍后再试"}), 429
+        if not registered:
+            release_ip_request(ip_address)
+            return jsonify({"error": f"您已有 {MAX_TASKS_PER_USER} 个任务未完成，请等待完成后再试"}), 429
 
-        queue_position = task_queue.qsize()
-        task_queue.put(task)
-        task_status[task_id] = {"status": "排队中" if queue_position > 0 else "处理中", "progress": 0, "queuePosition": queue_position, "max_queue_size": task_queue.qsize()}
-
-        if queue_position == 0:
-            threading.Thread(target=process_task, args=(task, session['user_id'], ip_address)).start()
-
-        return jsonify({"task_id": task_id, "queuePosition": queue_position, "max_queue_size": task_queue.qsize()})
+        # 审核与翻译在预处理线程中进行，这里立即返回任务 ID
+        submit_preprocess(task)
+        return jsonify({"task_id": task_id, "status": "审核中", "queuePosition": task_queue.qsize(), "max_queue_size": max(task_queue.qsize(), 1)})
     except Exception as e:
         logger.error(f"处理提示词时出错: {str(e)}")
-        if ENABLE_IP_RESTRICTION:
-            with ip_lock:
-                active_ip_requests.pop(ip_address, None)
+        release_ip_request(ip_address)
         return jsonify({"error": "处理提示词时出现错误，请稍后重试。"}), 500
 
-@app.route('/sd/status/<task_id>', methods=['GET'])
-@require_auth
-def get_status(task_id):
-    logger.info(f"Received status request for task {task_id}")
-    status = task_status.get(task_id, {"status": "未知任务", "progress": 0})
+def get_status_payload(task_id):
+    # 返回状态的副本，避免把展示用的排队文案写回 task_status
+    status = dict(lookup_task_status(task_id) or {"status": "未知任务", "progress": 0})
     if status["status"] == "排队中":
-        # 直接在status中更新queuePosition和max_queue_size        
-        status["queuePosition"] = next((i for i, task in enumerate(list(task_queue.queue)) if task['task_id'] == task_id), -1)
+        status["queuePosition"] = task_queue.position(task_id)
         status["max_queue_size"] = task_queue.qsize()
         status["status"] = "排队中，位置" + str(status["queuePosition"]) + "/" + str(status["max_queue_size"])
-        logger.debug(f"***任务 {task_id} 状态: {status['status']}")
+    return status
+
+def wait_for_status_change(task_id, last_version, timeout):
+    """等待任务状态版本号变化，返回最新版本号（超时未变化时返回原值）"""
+    deadline = time.time() + timeout
+    # 共享状态可能被其他进程修改，本进程收不到通知，需要定期检查版本号
+    interval = STATE_POLL_INTERVAL if state.shared else timeout
+    while True:
+        version = state.status_version(task_id)
+        remaining = deadline - time.time()
+        if version != last_version or remaining <= 0:
+            return version
+        with task_status_changed:
+            task_status_changed.wait(timeout=min(interval, remaining))
+
+def is_final_status(status):
+    text = status.get("status", "")
+    return text in ("完成", "重绘完成", "未知任务") or text.startswith("失败") or text.startswith("重绘失败")
+
+@app.route('/sd/status/<task_id>', methods=['GET'])
+@require_auth_light
+def get_status(task_id):
+    logger.info(f"Received status request for task {task_id}")
+    status = get_status_payload(task_id)
     logger.debug(f"^^^任务 {task_id} 状态: {status}")
     return jsonify(status)
 
+@app.route('/sd/stream/<task_id>', methods=['GET'])
+@require_auth_light
+def stream_status(task_id):
+    logger.info(f"Received status stream request for task {task_id}")
+    if not sse_slots.acquire(blocking=False):
+        # 推送连接已占满，避免耗尽工作线程，前端收到错误后改为轮询
+        logger.warning(f"推送连接数已达上限 {SSE_MAX_STREAMS}，任务 {task_id} 改为轮询")
+        return jsonify({"error": "状态推送繁忙，请改用轮询"}), 503
+
+    def event_stream():
+        last_version = None
+        deadline = time.time() + SSE_MAX_DURATION_SECONDS
+        while time.time() < deadline:
+            version = wait_for_status_change(task_id, last_version, min(SSE_KEEPALIVE_SECONDS, max(deadline - time.time(), 0)))
+            if version == last_version:
+                # 保持连接，防止代理因空闲断开
+                yield ": keepalive\n\n"
+                continue
+            last_version = version
+            status = get_status_payload(task_id)
+            yield f"data: {json.dumps(status, ensure_ascii=False)}\n\n"
+            if is_final_status(status):
+                return
+        # 达到最长时间后通知前端重新连接，让出工作线程
+        yield "event: reconnect\ndata: {}\n\n"
+
+    response = app.response_class(event_stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # 连接结束（包括客户端断开）时释放名额
+    response.call_on_close(sse_slots.release)
+    return response
+
 @app.route('/images/sd/<task_id>/<path:filename>')
 def serve_image(task_id, filename):
     logger.info(f"请求图片: {filename}")
@@ -627,11 +1245,6 @@ def serve_image(task_id, filename):
     
     return send_from_directory(image_path, filename)
 
-# 添加这个新函数到文件中
-def encode_image_to_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
 # 假设我们有一个全局变量来控制调试模式
 DEBUG_MODE = True  # 在生产环境中应设置 False
 
@@ -670,41 +1283,34 @@ def inpaint():
     ip_address = get_client_ip()
     logger.info(f"请求 IP 地址: {ip_address}")
 
-    # 只在启用 IP 限制时检查
-    if ENABLE_IP_RESTRICTION:
-        with ip_lock:
-            if ip_address in active_ip_requests:
-                return jsonify({"error": "您已有一个活跃请求，请等待当前请求完成后再试"}), 429
-            active_ip_requests[ip_address] = True
+    if not acquire_ip_request(ip_address):
+        return jsonify({"error": "您已有一个活跃请求，请等待当前请求完成后再试"}), 429
 
     prompt = data.get('prompt', '')
     # 移除了对空提示词的检查，允许提示词为空
     
-    try:
-        contains_inappropriate_content = check_prompt_with_chatgpt(prompt) if prompt else False
-        if contains_inappropriate_content:
-            if ENABLE_IP_RESTRICTION:
-                with ip_lock:
-                    active_ip_requests.pop(ip_address, None)
-            return jsonify({"error": "提示词可能包含不适当的内容。请修改后重试。"}), 400
-
-        translated_prompt = translate_to_english(prompt) if prompt else ''
+    if not accepting_tasks() or task_queue.full():
+        release_ip_request(ip_address)
+        return jsonify({"error": "队列已满，请稍后再试"}), 429
 
+    try:
         task_id = str(uuid4())
         logger.info(f"创建新的重绘任务: task_id={task_id}")
 
         # 如果有 LoRA 信息，也添加到任务中
+        prompt_suffix = ''
         if data.get('lora', False):
             lora_name = data.get('lora_name', '')
             lora_trigger_words = data.get('lora_trigger_words', '')
             lora_weight = data.get('lora_weight', 0.7)
-            translated_prompt += f", {lora_trigger_words}"
-            translated_prompt += f", <lora:{lora_name}:{lora_weight}>"
+            prompt_suffix += f", {lora_trigger_words}"
+            prompt_suffix += f", <lora:{lora_name}:{lora_weight}>"
 
         task = {
             'task_id': task_id,
             'type': 'inpaint',
-            'prompt': translated_prompt,
+            'prompt': None,  # 预处理完成后写入翻译结果
+            'original_prompt': prompt,
             'negative_prompt': data.get('negative_prompt', ''),
             'steps': data.get('steps', 30),
             'original_image': data.get('original_image'),
@@ -712,6 +1318,7 @@ def inpaint():
             'denoising_strength': data.get('denoising_strength', 0.7),
             'model_name': data.get('model_name', "realisticVisionV51_v51VAE.safetensors"),
             'model': SD_MODEL,
+            'prompt_suffix': prompt_suffix,
             'ip_address': ip_address,
             'user_id': session['user_id']  # 添加用户ID到任务中
         }
@@ -722,32 +1329,27 @@ def inpaint():
             lora_weight = data.get('lora_weight', 0.7)
             task['model'] += f"<lora:{lora_name}:{lora_weight}>"
 
-        if task_queue.qsize() >= MAX_QUEUE_SIZE:
-            if ENABLE_IP_RESTRICTION:
-                with ip_lock:
-                    active_ip_requests.pop(ip_address, None)
+        try:
+            registered = register_task(task, user_info)
+        except Full:
+            release_ip_request(ip_address)
             return jsonify({"error": "队列已满，请稍后再试"}), 429
+        if not registered:
+            release_ip_request(ip_address)
+            return jsonify({"error": f"您已有 {MAX_TASKS_PER_USER} 个任务未完成，请等待完成后再试"}), 429
 
-        queue_position = task_queue.qsize()
-        task_queue.put(task)
-        task_status[task_id] = {"status": "排队中" if queue_position > 0 else "处理中", "progress": 0, "queuePosition": queue_position, "max_queue_size": task_queue.qsize()}
-
-        if queue_position == 0:
-            threading.Thread(target=process_task, args=(task, session['user_id'], ip_address)).start()
-
+        submit_preprocess(task)
         return jsonify({"task_id": task_id, "status": "pending"})
     except Exception as e:
         logger.error(f"处理提示词时出错: {str(e)}")
-        if ENABLE_IP_RESTRICTION:
-            with ip_lock:
-                active_ip_requests.pop(ip_address, None)
+        release_ip_request(ip_address)
         return jsonify({"error": "处理提示词时出现错误，请稍后重试。"}), 500
 
 @app.route('/sd/task_status/<task_id>', methods=['GET'])
-@require_auth
+@require_auth_light
 def get_task_status(task_id):
     logger.info(f"Received task status request for task {task_id}")
-    status = task_status.get(task_id, {"status": "知任务", "progress": 0})
+    status = lookup_task_status(task_id) or {"status": "未知任务", "progress": 0}
     logger.info(f"获取任务状态: task_id={task_id}, status={status}")
     return jsonify(status)
 
@@ -780,7 +1382,7 @@ def get_user_info():
     return jsonify(safe_user_info)
 
 # 修改 inpaint_image 函数以返回结果不是直接响应
-def inpaint_image(task):
+def inpaint_image(task, backend):
     task_id = task['task_id']
     logger.info(f"开始重绘任务: task_id={task_id}")
     update_task_status(task_id, "重绘中...", 0)
@@ -793,39 +1395,21 @@ def inpaint_image(task):
 
     logger.info(f"重绘任务参数: task_id={task_id}, prompt={prompt}, model_name={model_name}, steps={steps}")
 
-    # 创时目录来保存图片
-    temp_dir = f"temp_{task_id}"
-    os.makedirs(temp_dir, exist_ok=True)
-
     try:
-        # 保存原始图片和遮罩图片
-        original_image_path = os.path.join(temp_dir, "original.png")
-        mask_image_path = os.path.join(temp_dir, "mask.png")
-
-        # 从 base64 解码并保存图片
-        with open(original_image_path, "wb") as f:
-            f.write(base64.b64decode(original_image.split(',')[1]))
-        with open(mask_image_path, "wb") as f:
-            f.write(base64.b64decode(mask_image.split(',')[1]))
+        # 直接使用 data URL 中的 base64 数据，不再落盘和重新编码
+        original_image_b64 = split_data_url(original_image)
+        mask_image_b64 = split_data_url(mask_image)
 
-        # 重新编码图片为 base64
-        original_image_b64 = encode_image_to_base64(original_image_path)
-        mask_image_b64 = encode_image_to_base64(mask_image_path)
-
-        # 获取图片尺寸
-        with PILImage.open(original_image_path) as img:
-            original_width, original_height = img.size
-
-        # 获取蒙版图片尺寸
-        with PILImage.open(mask_image_path) as img:
-            mask_width, mask_height = img.size
+        # 从 PNG 文件头读取图片尺寸，无需完整解码
+        original_width, original_height = image_size_from_base64(original_image_b64)
+        mask_width, mask_height = image_size_from_base64(mask_image_b64)
 
         logger.info(f"原始图片尺寸: {original_width}x{original_height}")
         logger.info(f"蒙版图片尺寸: {mask_width}x{mask_height}")
         update_task_status(task_id, "正在设置模型", 10)
 
-        # 设置模型和LoRA
-        # set_model_and_lora(task)
+        # 设置模型，LoRA 通过提示词加载
+        ensure_backend_model(backend, model_name)
 
         payload = {
             "init_images": [original_image_b64],
@@ -851,7 +1435,8 @@ def inpaint_image(task):
             "override_settings": {
                 "sd_model_checkpoint": model_name
             },
-            "override_settings_restore_afterwards": True,
+            # 不恢复原模型，避免每次重绘都来回切换；后端当前加载的模型记录在 backend.loaded_model 中
+            "override_settings_restore_afterwards": False,
             "script_args": [],
             "include_init_images": False,
             "script_name": "",
@@ -881,10 +1466,15 @@ def inpaint_image(task):
 
         update_task_status(task_id, "正在发送重绘请求", 30)
         # 发送请求到 SD API
-        logger.info(f"准备发送重绘请求到 {SD_URL}")
-        response = requests.post(url=f'{SD_URL}/sdapi/v1/img2img', json=payload, verify=False, timeout=120)
-        response.raise_for_status()
-        result = response.json()
+        logger.info(f"准备发送重绘请求到 {backend.url}")
+        try:
+            with track_progress(task_id, backend, "正在重绘", start=30, end=70):
+                response = sd_session.post(url=f'{backend.url}/sdapi/v1/img2img', json=payload, stream=True,
+                                           timeout=(HTTP_CONNECT_TIMEOUT, SD_REQUEST_TIMEOUT))
+            response.raise_for_status()
+            result = read_sd_response(response)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise BackendError(f"重绘请求失败: {str(e)}")
 
         if 'images' not in result or not result['images']:
             logger.error("响应中没有有效的图片数据")
@@ -896,41 +1486,28 @@ def inpaint_image(task):
 
         # 保存重绘后的图片
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        save_dir = os.path.join(OUTPUT_DIR, task_id)
-        os.makedirs(save_dir, exist_ok=True)
+        save_dir = create_output_dir(task_id)
         file_name = f"{timestamp}_inpaint.png"
         save_path = os.path.join(save_dir, file_name)
         
         with open(save_path, "wb") as f:
-            f.write(base64.b64decode(inpainted_image))
+            f.write(inpainted_image)
 
         logger.info(f"重绘图片已保存: {save_path}")
 
         # 构建图片URL
         image_url = f"/images/sd/{task_id}/{file_name}"
 
-        # 将重绘的图片保存到数据库
-        with app.app_context():
-            try:
-                # 将 PNG base64 转换为 JPEG base64
-                jpg_base64 = png_to_jpg_base64(inpainted_image)
-
-                new_image = Image(
-                    user_id=task['user_id'],
-                    prompt=task['prompt'],
-                    base64=jpg_base64,
-                    seed=-1,  # 重绘通常不使用种子，所以设为-1
-                    model=task['model_name'],
-                    lora=task.get('lora', ''),
-                    created_at=datetime.utcnow()
-                )
-                db.session.add(new_image)
-                db.session.commit()
-                logger.info(f"重绘图片信息已保存到数据库: task_id={task_id}")
-            except Exception as e:
-                logger.error(f"保存重绘图片信息到数据库时出错: {str(e)}")
-                logger.error(f"错误详情: {traceback.format_exc()}")
-                db.session.rollback()
+        # 将重绘的图片保存到数据库（在后处理线程中编码并写入）
+        submit_history(task['user_id'], [(inpainted_image, {
+            'user_id': task['user_id'],
+            'prompt': task['prompt'],
+            'original_prompt': task.get('original_prompt'),
+            'seed': -1,  # 重绘通常不使用种子，所以设为-1
+            'model': task['model_name'],
+            'lora': task.get('lora', ''),
+            'created_at': datetime.utcnow()
+        })])
 
         logger.info(f"重绘任务完成: task_id={task_id}")
         update_task_status(task_id, "重绘完成", 100, inpainted_image_url=image_url)
@@ -947,17 +1524,16 @@ def inpaint_image(task):
         error_msg = f"处理重绘任务时出错: {str(e)}"
         logger.error(f"{error_msg} task_id={task_id}")
         update_task_status(task_id, "重绘失败", 100, error=error_msg)
-        return {"error": error_msg}
-    finally:
-        # 清理临时文件
-        for file in os.listdir(temp_dir):
-            os.remove(os.path.join(temp_dir, file))
-        os.rmdir(temp_dir)
+        return {"error": error_msg, "backend_error": isinstance(e, BackendError)}
 
 @app.route('/login')
 def login():
     logger.info("用户请求登录")
-    auth_response = requests.get(f"{AUTH_SERVICE_URL}/oauth/authorize")
+    try:
+        auth_response = auth_session.get(f"{AUTH_SERVICE_URL}/oauth/authorize", timeout=(HTTP_CONNECT_TIMEOUT, AUTH_REQUEST_TIMEOUT))
+    except requests.RequestException as e:
+        logger.error(f"请求认证服务失败: {str(e)}")
+        return jsonify({"error": "Failed to start authentication process"}), 500
     if auth_response.status_code == 200:
         auth_data = auth_response.json()
         logger.info(f"重定向到认证服务的授权 URL: {auth_data['auth_url']}")
@@ -975,8 +1551,12 @@ def auth_complete():
         return jsonify({"error": "No token provided"}), 400
 
     logger.info("使用临时令牌获取用户信息")
-    user_info_response = requests.post(f"{AUTH_SERVICE_URL}/oauth/userinfo", 
-                                       json={"temp_token": temp_token})
+    try:
+        user_info_response = auth_session.post(f"{AUTH_SERVICE_URL}/oauth/userinfo", json={"temp_token": temp_token},
+                                               timeout=(HTTP_CONNECT_TIMEOUT, AUTH_REQUEST_TIMEOUT))
+    except requests.RequestException as e:
+        logger.error(f"请求认证服务失败: {str(e)}")
+        return jsonify({"error": "Failed to get user info"}), 400
     if user_info_response.status_code != 200:
         logger.error(f"获取用户信息失败: {user_info_response.text}")
         return jsonify({"error": "Failed to get user info"}), 400
@@ -1033,8 +1613,8 @@ def refresh_jwt_token():
 
     try:
         # 向认证服务发送刷新请求
-        response = requests.post(f"{AUTH_SERVICE_URL}/oauth/refresh", 
-                                 json={"refresh_token": refresh_token})
+        response = auth_session.post(f"{AUTH_SERVICE_URL}/oauth/refresh", json={"refresh_token": refresh_token},
+                                     timeout=(HTTP_CONNECT_TIMEOUT, AUTH_REQUEST_TIMEOUT))
         if response.status_code == 200:
             new_token_data = response.json()
             
@@ -1067,14 +1647,23 @@ def logout():
     logout_success = True
 
     if user_id:
-        logout_response = requests.post(f"{AUTH_SERVICE_URL}/oauth/logout", json={"user_id": user_id})
-        if logout_response.status_code == 200:
+        try:
+            logout_response = auth_session.post(f"{AUTH_SERVICE_URL}/oauth/logout", json={"user_id": user_id},
+                                                timeout=(HTTP_CONNECT_TIMEOUT, AUTH_REQUEST_TIMEOUT))
+        except requests.RequestException as e:
+            logger.warning(f"请求认证服务登出失败: {str(e)}")
+            logout_response = None
+        if logout_response is not None and logout_response.status_code == 200:
             logger.info(f"用户 {user_id} 在认证服务中成功登出")
         else:
             logger.warning(f"用户 {user_id} 在认证服务登出失败")
             logout_success = False
     
-    # 清除会话
+    # 清除会话，并让本进程已缓存的 JWT 验证结果失效。JWT 本身无状态，在过期前仍能通过签名验证，
+    # 其他进程中的缓存只是保存了同样的验证结果，因此不需要跨进程失效
+    jwt_token = request.cookies.get('jwt_token') or session.get('jwt_token')
+    if jwt_token:
+        jwt_cache.delete(jwt_cache_key(jwt_token))
     session.clear()
     logger.info(f"用户 {user_id} 已成功从本地会话登出")
     
@@ -1109,8 +1698,173 @@ def before_request():
 with app.app_context():
     log_startup_info()
 
-# 启动图片清理器
-start_image_cleaner(OUTPUT_DIR, CLEANER_INTERVAL_MINUTES, CLEANER_RETENTION_HOURS)
+def probe_backend(backend):
+    response = sd_session.get(f"{backend.url}/sdapi/v1/progress", params={"skip_current_image": "true"}, timeout=(HTTP_CONNECT_TIMEOUT, 5))
+    return response.status_code == 200
+
+def recover_tasks():
+    """恢复已退出进程留下的未完成任务，返回需要重新预处理的任务"""
+    requeued, exhausted, preprocessing = task_store.recover(TASK_MAX_ATTEMPTS)
+    released = state.release_orphan_ip_locks(task_store.live_workers() | {task_store.worker_id})
+    with task_lock:
+        for task in requeued:
+            set_task_status(task['task_id'], {"status": "排队中", "progress": 0})
+        for task in exhausted:
+            error = "任务多次执行中断，请重新提交"
+            failure_status = "重绘失败" if task['type'] == 'inpaint' else "失败"
+            set_task_status(task['task_id'], {"status": f"{failure_status}: {error}", "progress": 100, "error": error})
+    for task in requeued + preprocessing:
+        hold_ip_request(task['ip_address'])
+    if requeued or exhausted or preprocessing or released:
+        logger.info(f"已恢复未完成的任务: 重新排队 {len(requeued)} 个，重新预处理 {len(preprocessing)} 个，"
+                    f"超过重试次数 {len(exhausted)} 个，释放遗留的 IP 限制 {released} 个")
+    return preprocessing
+
+def run_maintenance():
+    # 定期接管心跳超时的 worker 留下的任务，并清理过期记录
+    while True:
+        time.sleep(TASK_RECOVERY_INTERVAL)
+        try:
+            for task in recover_tasks():
+                submit_preprocess(task)
+            task_store.purge_finished()
+            state.purge(TASK_RETENTION_SECONDS)
+        except Exception as e:
+            logger.error(f"恢复任务时出错: {str(e)}")
+
+task_dispatcher = None
+shutting_down = threading.Event()
+
+def accepting_tasks():
+    # 非主进程只负责接收任务，由主进程分派
+    if task_dispatcher is not None:
+        return task_dispatcher.accepting
+    return not shutting_down.is_set()
+
+def become_leader():
+    """由唯一的主进程运行：任务恢复与分派、后端健康检查和图片清理"""
+    global task_dispatcher
+    pending_preprocess = recover_tasks()
+    task_store.purge_finished()
+    state.purge(TASK_RETENTION_SECONDS)
+
+    # 启动图片清理器
+    start_image_cleaner(image_expiry, OUTPUT_DIR, CLEANER_INTERVAL_MINUTES, CLEANER_RETENTION_HOURS,
+                        CLEANER_MAX_DELETES_PER_SECOND)
+    # 启动 SD 后端健康检查
+    start_health_checker(backend_pool, probe_backend, SD_HEALTH_CHECK_INTERVAL)
+
+    # 启动任务分派线程，工作线程数与后端池的总并发数一致
+    dispatcher = TaskDispatcher(task_queue, backend_pool, process_task, on_dispatch=mark_task_started,
+                                preference=lambda backend: {"prefer_checkpoint": checkpoint_name(backend.loaded_model) or None})
+    dispatcher.start()
+    task_dispatcher = dispatcher
+    update_queue_positions()
+    for task in pending_preprocess:
+        submit_preprocess(task)
+    threading.Thread(target=run_maintenance, name='task-maintenance', daemon=True).start()
+
+leader_lock = None
+
+def start_leadership():
+    """在模块中的所有处理函数定义完成后调用，避免恢复的任务在导入过程中执行"""
+    global leader_lock
+    if state.shared:
+        # 多个 worker 进程通过文件锁选出一个主进程分派任务，主进程退出后由其他进程接管
+        leader_lock = LeaderLock(TASK_STORE_DB + '.leader')
+        if leader_lock.acquire(blocking=False):
+            logger.info(f"进程 {os.getpid()} 成为主进程，开始分派任务")
+            become_leader()
+        else:
+            logger.info(f"进程 {os.getpid()} 作为普通 worker 运行，任务由主进程分派")
+            leader_lock.wait_and_run(become_leader)
+    else:
+        become_leader()
+
+shutdown_complete = threading.Event()
+
+def shutdown_executor(shutdown, deadline):
+    """在后台线程中执行 shutdown（等待线程池排空），最多等待到 deadline，返回是否已完成"""
+    waiter = threading.Thread(target=shutdown, daemon=True)
+    waiter.start()
+    waiter.join(max(0, deadline - time.monotonic()))
+    return not waiter.is_alive()
+
+def shutdown_dispatcher():
+    """停止接收任务，排空预处理、正在执行的任务和历史图片写入，最多等待 SHUTDOWN_TIMEOUT_SECONDS 秒
+
+    由 SIGTERM（直接运行时）、gunicorn 的 worker_exit 钩子或 atexit 调用，返回是否在超时前全部完成。
+    """
+    if shutdown_complete.is_set():
+        return True
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+    shutting_down.set()
+    # 先等待预处理中的任务入队，再停止分派
+    drained = shutdown_executor(preprocess_executor.shutdown, deadline)
+    if task_dispatcher is not None:
+        drained = shutdown_executor(task_dispatcher.shutdown, deadline) and drained
+    # 等待已提交的历史图片写入完成
+    drained = shutdown_executor(history_executor.shutdown, deadline) and drained
+    with postprocess_pool_lock:
+        pool = postprocess_pool
+    if pool is not None:
+        drained = shutdown_executor(pool.shutdown, deadline) and drained
+    # 注销后，超时未完成的任务可以被其他进程立即恢复
+    task_store.unregister()
+    shutdown_complete.set()
+    if not drained:
+        logger.warning(f"等待 {SHUTDOWN_TIMEOUT_SECONDS} 秒后仍有任务未完成，将由其他进程或下次启动时恢复")
+    return drained
+
+def handle_sigterm(signum, frame):
+    if shutdown_dispatcher():
+        raise SystemExit(0)
+    # 仍在执行的任务已交给其他进程恢复，直接退出，不再等待工作线程
+    logging.shutdown()
+    os._exit(0)
+
+atexit.register(shutdown_dispatcher)
+
+@app.route('/sd/metrics', methods=['GET'])
+@require_auth
+def get_metrics():
+    return jsonify({
+        "prompt_cache": [moderation_cache.stats(), translation_cache.stats()],
+        "result_cache": result_cache.stats() if result_cache is not None else None,
+        "jwt_cache": jwt_cache.stats(),
+        "image_cleaner": image_expiry.stats()
+    })
+
+@app.route('/sd/backends', methods=['GET'])
+@require_auth
+def get_backends():
+    return jsonify({
+        "backends": [{k: v for k, v in b.items() if k != 'url'} for b in backend_pool.snapshot()],
+        "queue_size": task_queue.qsize(),
+        "max_queue_size": MAX_QUEUE_SIZE
+    })
+
+# 历史查询总数缓存: {user_id: {过滤条件: (总数, 过期时间, 版本号)}}
+# 每个进程各自缓存，新增或删除图片时递增共享状态中该用户的版本号，其他进程读取时发现版本变化即重新计数
+history_count_cache = {}
+history_count_lock = threading.Lock()
+
+def get_history_count(user_id, filter_key, query):
+    now = time.time()
+    revision = state.get_revision(f'history:{user_id}')
+    with history_count_lock:
+        cached = history_count_cache.get(user_id, {}).get(filter_key)
+    if cached and cached[1] > now and cached[2] == revision:
+        return cached[0]
+    total = query.order_by(None).count()
+    with history_count_lock:
+        history_count_cache.setdefault(user_id, {})[filter_key] = (total, now + HISTORY_COUNT_CACHE_SECONDS, revision)
+    return total
+
+def invalidate_history_count(user_id):
+    state.bump_revision(f'history:{user_id}')
+    with history_count_lock:
+        history_count_cache.pop(user_id, None)
 
 @app.route('/sd/query_images', methods=['POST'])
 @require_auth
@@ -1124,20 +1878,50 @@ def query_images():
         return jsonify({"error": "未授权访问"}), 401
 
     data = request.json
-    keyword = translate_to_english(data.get('keyword', ''))
+    original_keyword = (data.get('keyword') or '').strip()
+    keyword = original_keyword
+    # 纯 ASCII 关键词无需翻译
+    if SEARCH_TRANSLATE_KEYWORD and original_keyword and not original_keyword.isascii():
+        keyword = translate_to_english(original_keyword)
     start_date = data.get('start_date')
     end_date = data.get('end_date')
-    page = data.get('page', 1)  # 默认第一页
-    per_page = data.get('per_page', 8)  # 默认每页8条
+    try:
+        page, per_page = parse_page_params(data)  # 默认第一页，每页8条
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # 游标分页：传入上一页返回的 next_cursor，深页与第一页代价相同
+    cursor = data.get('cursor')
+    # 总数需要额外的 COUNT 查询，默认只在第一页返回
+    include_total = data.get('include_total', not cursor)
 
-    logger.info(f"查询参数: user_id={user_id}, keyword='{keyword}', start_date={start_date}, end_date={end_date}, page={page}, per_page={per_page}")
+    logger.info(f"查询参数: user_id={user_id}, keyword='{keyword}', start_date={start_date}, end_date={end_date}, page={page}, per_page={per_page}, cursor={cursor}")
 
     try:
-        query = Image.query.filter(Image.user_id == user_id)
+        cursor_values = decode_cursor(cursor) if cursor else {}
+    except Exception:
+        return jsonify({"error": "无效的分页游标"}), 400
 
-        if keyword:
-            query = query.filter(Image.prompt.like(f'%{keyword}%'))
-            logger.info(f"应用关键词过滤: '{keyword}'")
+    try:
+        query = Image.query.filter(Image.user_id == user_id)
+        order_by = [desc(Image.created_at), desc(Image.id)]
+        by_relevance = False
+
+        if original_keyword:
+            tokenizer = get_fts_tokenizer()
+            match_expression = build_match_expression([original_keyword, keyword], tokenizer) if tokenizer else None
+            if match_expression:
+                # 使用全文索引，按相关度排序
+                fts = fts_match_subquery(match_expression)
+                query = query.join(fts, fts.c.image_id == Image.id)
+                order_by = [fts.c.rank, desc(Image.id)]
+                by_relevance = True
+                logger.info(f"应用全文索引关键词过滤: {match_expression}")
+            else:
+                query = query.filter(db.or_(
+                    Image.prompt.like(f'%{keyword}%'),
+                    Image.original_prompt.like(f'%{original_keyword}%')
+                ))
+                logger.info(f"应用关键词过滤: '{keyword}'")
 
         if start_date:
             start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
@@ -1149,29 +1933,65 @@ def query_images():
             query = query.filter(Image.created_at <= end_date_obj)
             logger.info(f"应用结束日期过滤: {end_date}")
 
-        total = query.count()
-        images = query.order_by(desc(Image.created_at)).paginate(page=page, per_page=per_page, error_out=False)
+        if cursor_values and not valid_cursor(cursor_values, by_relevance):
+            return jsonify({"error": "无效的分页游标"}), 400
+
+        total = None
+        if include_total:
+            total = get_history_count(user_id, (original_keyword, keyword, start_date, end_date), query)
+
+        offset = 0
+        if by_relevance:
+            # 按 (rank, id) 取下一页：rank 越小相关度越高，相同 rank 按 id 倒序
+            query = query.add_columns(fts.c.rank)
+            if cursor_values:
+                query = query.filter(db.or_(
+                    fts.c.rank > cursor_values['rank'],
+                    db.and_(fts.c.rank == cursor_values['rank'], Image.id < cursor_values['id'])
+                ))
+        elif cursor_values:
+            # 按 (created_at, id) 取下一页，游标中的时间按列的存储格式绑定，同一秒内的记录不会重复或遗漏
+            cursor_time = db.bindparam('cursor_created_at', datetime.fromisoformat(cursor_values['created_at']),
+                                       type_=StoredTimestamp)
+            query = query.filter(db.tuple_(Image.created_at, Image.id) < db.tuple_(cursor_time, cursor_values['id']))
+        if not cursor_values and page > 1:
+            # 兼容旧的按页码请求
+            offset = (page - 1) * per_page
+        rows = query.order_by(*order_by).offset(offset).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        items = [row[0] for row in rows] if by_relevance else rows
+        next_cursor = None
+        if has_more:
+            last = items[-1]
+            if by_relevance:
+                next_cursor = encode_cursor({'rank': rows[-1][1], 'id': last.id})
+            else:
+                next_cursor = encode_cursor({'created_at': last.created_at.isoformat(), 'id': last.id})
 
         results = []
-        for image in images.items:
+        for image in items:
             results.append({
                 'id': image.id,
                 'created_at': image.created_at.isoformat(),
                 'prompt': image.prompt,
-                'base64': image.base64,
+                'thumbnail_url': f"/sd/image/{image.id}/thumb",
+                'image_url': f"/sd/image/{image.id}",
                 'seed': image.seed,
                 'lora': image.lora,
                 'model': image.model
             })
             logger.debug(f"处理图片: id={image.id}, created_at={image.created_at.isoformat()}, prompt='{image.prompt[:50]}...', seed={image.seed}, lora={image.lora}, model={image.model}")
 
-        logger.info(f"返回第 {page} 页结果，共 {len(results)} 条")
+        logger.info(f"返回查询结果，共 {len(results)} 条，has_more={has_more}")
         return jsonify({
             'images': results,
             'total': total,
             'page': page,
             'per_page': per_page,
-            'total_pages': (total + per_page - 1) // per_page
+            'total_pages': (total + per_page - 1) // per_page if total is not None else None,
+            'next_cursor': next_cursor,
+            'has_more': has_more
         })
 
     except Exception as e:
@@ -1207,8 +2027,11 @@ def delete_image():
             return jsonify({"error": "未找到图片或无权删除"}), 404
 
         # 删除图片
+        image_key, thumb_key = image.image_key, image.thumb_key
         db.session.delete(image)
         db.session.commit()
+        invalidate_history_count(user_id)
+        delete_stored_image(image_key, thumb_key)
 
         logger.info(f"成功删除图片: image_id={image_id}")
         return jsonify({"message": "图片已成功删除"}), 200
@@ -1218,6 +2041,59 @@ def delete_image():
         logger.error(f"删除图片时发生错误: {str(e)}")
         return jsonify({"error": "删除图片时发生错误"}), 500
 
+def send_stored_image(data_or_key, mimetype, etag):
+    # 同一 id 的图片内容不会变化，允许浏览器长期缓存
+    source = image_store.path(data_or_key) if isinstance(data_or_key, str) else BytesIO(data_or_key)
+    response = send_file(source, mimetype=mimetype, conditional=True, etag=etag, max_age=IMAGE_CACHE_MAX_AGE)
+    response.cache_control.private = True
+    response.cache_control.public = False
+    return response
+
+def get_owned_image(image_id):
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+    return Image.query.filter_by(id=image_id, user_id=user_id).first()
+
+@app.route('/sd/image/<int:image_id>', methods=['GET'])
+@require_auth
+def get_image(image_id):
+    image = get_owned_image(image_id)
+    if not image:
+        return jsonify({"error": "未找到图片或无权访问"}), 404
+
+    if image.image_key and image_store.exists(image.image_key):
+        return send_stored_image(image.image_key, 'image/jpeg', image.image_key)
+
+    data = load_image_bytes(image)
+    if not data:
+        return jsonify({"error": "图片文件不存在"}), 404
+    return send_stored_image(data, 'image/jpeg', f"image-{image.id}")
+
+@app.route('/sd/image/<int:image_id>/thumb', methods=['GET'])
+@require_auth
+def get_image_thumbnail(image_id):
+    image = get_owned_image(image_id)
+    if not image:
+        return jsonify({"error": "未找到图片或无权访问"}), 404
+
+    if not (image.thumb_key and image_store.exists(image.thumb_key)):
+        # 旧数据没有缩略图，首次访问时生成并保存
+        data = load_image_bytes(image)
+        if not data:
+            return jsonify({"error": "图片文件不存在"}), 404
+        try:
+            with PILImage.open(BytesIO(data)) as img:
+                thumb_data = make_thumbnail(img.convert('RGB'))
+            image.thumb_key = image_store.put(thumb_data, 'webp')
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"生成缩略图失败: image_id={image_id}, {str(e)}")
+            return jsonify({"error": "生成缩略图失败"}), 500
+
+    return send_stored_image(image.thumb_key, 'image/webp', image.thumb_key)
+
 def translate_to_english_with_history(prompt, conversation_history, tmp_id):
     try:
         logger.info(f"正在使用对话历史将提示词翻译为英语: {conversation_history}")
@@ -1243,7 +2119,11 @@ def translate_to_english_with_history(prompt, conversation_history, tmp_id):
         logger.error(f"ChatGPT API调用错误: {str(e)}")
         return conversation_history[-1]["content"]  # 如果API调用失败，返回原始prompt
 
+# 所有处理函数已定义，开始恢复和分派任务
+start_leadership()
+
 if __name__ == '__main__':
     logger.info(f"启动服务器,端口 25001, AUTH_SERVICE_URL: {AUTH_SERVICE_URL}")
+    signal.signal(signal.SIGTERM, handle_sigterm)
     sd_port = os.environ.get('SD_ROUTE_PORT', '25001')  # 假设前端运行在 25001 端口
     app.run(host='0.0.0.0', port=sd_port, threaded=True)
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStateBackend:
+    """进程内的共享状态：IP 限制、任务状态和对话历史，只适用于单进程部署"""
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ip_locks = {}
+        self._statuses = {}
+        self._versions = {}
+        self._conversations = {}
+        self._revisions = {}
+
+    def try_acquire_ip(self, ip_address, owner=None):
+        with self._lock:
+            if ip_address in self._ip_locks:
+                return False
+            self._ip_locks[ip_address] = owner
+            return True
+
+    def hold_ip(self, ip_address, owner=None):
+        with self._lock:
+            self._ip_locks[ip_address] = owner
+
+    def release_ip(self, ip_address):
+        with self._lock:
+            self._ip_locks.pop(ip_address, None)
+
+    def release_orphan_ip_locks(self, live_owners):
+        # 进程内的锁与进程同生共死，不存在遗留的锁
+        return 0
+
+    def get_status(self, task_id):
+        with self._lock:
+            status = self._statuses.get(task_id)
+            return dict(status) if status is not None else None
+
+    def set_status(self, task_id, status):
+        with self._lock:
+            self._statuses[task_id] = dict(status)
+            self._versions[task_id] = self._versions.get(task_id, 0) + 1
+            return self._versions[task_id]
+
+    def status_version(self, task_id):
+        with self._lock:
+            return self._versions.get(task_id, 0)
+
+    def load_conversation(self, tmp_id):
+        with self._lock:
+            return list(self._conversations.get(tmp_id, []))
+
+    def save_conversation(self, tmp_id, messages):
+        with self._lock:
+            self._conversations[tmp_id] = list(messages)
+
+    def get_revision(self, name):
+        with self._lock:
+            return self._revisions.get(name, 0)
+
+    def bump_revision(self, name):
+        with self._lock:
+            self._revisions[name] = self._revisions.get(name, 0) + 1
+            return self._revisions[name]
+
+    def purge(self, older_than):
+        # 进程内状态随进程结束而释放，这里不做清理
+        return 0
+
+
+class SQLiteStateBackend:
+    """多个进程通过同一个 SQLite 文件（WAL 模式）共享状态，用于 gunicorn 多 worker 部署"""
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute('PRAGMA synchronous=NORMAL;')
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ip_locks (ip_address TEXT PRIMARY KEY, owner TEXT, acquired_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS task_status ("
+            "task_id TEXT PRIMARY KEY, status TEXT NOT NULL, version INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "tmp_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        # 各进程内缓存的失效版本号，修改数据的进程递增版本号，其他进程读取时发现变化即丢弃缓存
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS revisions (name TEXT PRIMARY KEY, revision INTEGER NOT NULL)"
+        )
+
+    def _execute(self, sql, params=()):
+        """执行写语句，返回影响的行数"""
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            cursor.close()
+            return cursor.rowcount
+
+    def _query(self, sql, params=()):
+        # 立即取完所有行，避免未结束的语句持有读快照导致其他连接写入时出现 database is locked
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def try_acquire_ip(self, ip_address, owner=None):
+        inserted = self._execute("INSERT OR IGNORE INTO ip_locks (ip_address, owner, acquired_at) VALUES (?, ?, ?)",
+                                 (ip_address, owner, time.time()))
+        return inserted == 1
+
+    def hold_ip(self, ip_address, owner=None):
+        self._execute("INSERT OR REPLACE INTO ip_locks (ip_address, owner, acquired_at) VALUES (?, ?, ?)",
+                      (ip_address, owner, time.time()))
+
+    def release_ip(self, ip_address):
+        self._execute("DELETE FROM ip_locks WHERE ip_address = ?", (ip_address,))
+
+    def release_orphan_ip_locks(self, live_owners):
+        """释放已退出进程遗留的 IP 锁，live_owners 为仍在运行的进程标识"""
+        rows = self._query("SELECT ip_address, owner FROM ip_locks")
+        orphans = [ip for ip, owner in rows if owner not in live_owners]
+        for ip_address in orphans:
+            self.release_ip(ip_address)
+        return len(orphans)
+
+    def get_status(self, task_id):
+        rows = self._query("SELECT status FROM task_status WHERE task_id = ?", (task_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set_status(self, task_id, status):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO task_status (task_id, status, version, updated_at) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(task_id) DO UPDATE SET status = excluded.status, version = version + 1, "
+                "updated_at = excluded.updated_at",
+                (task_id, json.dumps(status, ensure_ascii=False), time.time())
+            )
+            rows = self._conn.execute("SELECT version FROM task_status WHERE task_id = ?", (task_id,)).fetchall()
+        return rows[0][0]
+
+    def status_version(self, task_id):
+        rows = self._query("SELECT version FROM task_status WHERE task_id = ?", (task_id,))
+        return rows[0][0] if rows else 0
+
+    def load_conversation(self, tmp_id):
+        rows = self._query("SELECT messages FROM conversations WHERE tmp_id = ?", (tmp_id,))
+        return json.loads(rows[0][0]) if rows else []
+
+    def save_conversation(self, tmp_id, messages):
+        self._execute(
+            "INSERT OR REPLACE INTO conversations (tmp_id, messages, updated_at) VALUES (?, ?, ?)",
+            (tmp_id, json.dumps(messages, ensure_ascii=False), time.time())
+        )
+
+    def get_revision(self, name):
+        rows = self._query("SELECT revision FROM revisions WHERE name = ?", (name,))
+        return rows[0][0] if rows else 0
+
+    def bump_revision(self, name):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO revisions (name, revision) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET revision = revision + 1",
+                (name,)
+            )
+            rows = self._conn.execute("SELECT revision FROM revisions WHERE name = ?", (name,)).fetchall()
+        return rows[0][0]
+
+    def purge(self, older_than):
+        cutoff = time.time() - older_than
+        removed = self._execute("DELETE FROM task_status WHERE updated_at < ?", (cutoff,))
+        self._execute("DELETE FROM conversations WHERE updated_at < ?", (cutoff,))
+        return removed
+
+
+def create_state_backend(kind, path, **kwargs):
+    if kind == 'memory':
+        return MemoryStateBackend()
+    if kind == 'sqlite':
+        return SQLiteStateBackend(path, **kwargs)
+    raise ValueError(f"未知的状态存储类型: {kind}")
+
+
+@contextmanager
+def file_lock(path):
+    """进程间互斥的文件锁，用于多个 worker 同时启动时只需执行一次的初始化（如数据库结构升级）"""
+    import fcntl
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class LeaderLock:
+    """基于文件锁的主进程选举：多个 worker 中只有持有锁的进程运行任务分派
+
+    持有锁的进程退出后操作系统会自动释放文件锁，等待中的进程随即接管。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        import fcntl
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def wait_and_run(self, on_acquired):
+        """在后台线程中等待成为主进程，获得锁后调用 on_acquired"""
+        def run():
+            if self.acquire(blocking=True):
+                logger.info(f"进程 {os.getpid()} 成为主进程，开始分派任务")
+                on_acquired()
+
+        thread = threading.Thread(target=run, name='leader-election', daemon=True)
+        thread.start()
+        return thread
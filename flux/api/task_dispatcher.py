@@ -0,0 +1,74 @@
+import threading
+import logging
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class TaskDispatcher:
+    """常驻的任务分派线程：占用后端槽位后从队列取出任务，交给固定大小的工作线程池执行"""
+
+    def __init__(self, task_queue, backend_pool, handler, on_dispatch=None, num_workers=None, poll_interval=0.5,
+                 preference=None):
+        self.task_queue = task_queue
+        self.backend_pool = backend_pool
+        self.handler = handler
+        self.on_dispatch = on_dispatch
+        # preference(backend) 返回传给 task_queue.get 的额外参数，用于按后端状态选择任务
+        self.preference = preference
+        self.num_workers = num_workers or backend_pool.total_capacity
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='sd-worker')
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def accepting(self):
+        return self._thread is not None and not self._stopping.is_set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='sd-dispatcher', daemon=True)
+        self._thread.start()
+        logger.info(f"Started task dispatcher with {self.num_workers} worker thread(s).")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            backend = self.backend_pool.acquire(timeout=self.poll_interval)
+            if backend is None:
+                continue
+            try:
+                extra = self.preference(backend) if self.preference else {}
+                task = self.task_queue.get(timeout=self.poll_interval, **extra)
+            except Empty:
+                self.backend_pool.cancel(backend)
+                continue
+
+            try:
+                if self.on_dispatch:
+                    self.on_dispatch(task, backend)
+                self._executor.submit(self._execute, task, backend)
+                logger.info(f"Dispatched task {task['task_id']} to backend {backend.name}")
+            except Exception as e:
+                # 分派失败时仍交给工作线程处理，由 handler 负责记录失败状态并释放槽位
+                logger.error(f"Error dispatching task {task.get('task_id')}: {str(e)}")
+                self._execute(task, backend)
+
+    def _execute(self, task, backend):
+        try:
+            self.handler(task, backend)
+        except Exception as e:
+            logger.error(f"Unhandled error in worker for task {task.get('task_id')}: {str(e)}")
+
+    def shutdown(self, wait=True):
+        """停止分派新任务，并等待正在执行的任务完成"""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        logger.info("Task dispatcher stopping, draining running tasks...")
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval * 4)
+        self._executor.shutdown(wait=wait)
+        logger.info(f"Task dispatcher stopped, {self.task_queue.qsize()} task(s) left in queue.")
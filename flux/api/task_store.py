@@ -0,0 +1,386 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from queue import Empty, Full
+
+logger = logging.getLogger(__name__)
+
+# 任务状态机: preprocessing -> queued -> running -> done
+STATE_PREPROCESSING = 'preprocessing'
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+
+def scheduled_tasks(condition=''):
+    """按调度顺序列出排队中的任务：优先级高的先执行；同一优先级内按用户轮转（先比较任务在
+    该用户队列中的序号，再让最久没有被服务的用户先执行），同一用户的任务按入队顺序执行
+
+    condition 为附加的过滤条件（以 AND 开头），用户轮转只在过滤后的任务之间进行。
+    """
+    return (
+        "SELECT id, task_id, payload, batch_key, checkpoint FROM ("
+        "SELECT id, task_id, payload, batch_key, checkpoint, priority, queued_at, "
+        "ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY queued_at, id) AS user_rank, "
+        "(SELECT MAX(served.claimed_at) FROM tasks AS served WHERE served.user_id = tasks.user_id) AS last_served "
+        f"FROM tasks WHERE state = '{STATE_QUEUED}' {condition}) "
+        "ORDER BY priority DESC, user_rank, last_served, queued_at, id"
+    )
+
+
+SCHEDULED_TASKS = scheduled_tasks()
+# 合并生成时只扫描 batch_key 相同的排队任务（走 ix_tasks_batch_key 索引）
+SCHEDULED_BATCH_TASKS = scheduled_tasks('AND batch_key = ?')
+
+class TaskStore:
+    """基于 SQLite（WAL 模式）的持久化任务队列
+
+    提供与 queue.Queue 相同的 put_nowait / get / qsize / full 接口供分派线程使用。
+    get 会把任务标记为 running（认领），任务结束后调用 complete；认领任务的进程在任务
+    结束前退出时，由 recover 把任务放回队列，因此任务至少会被执行一次。
+
+    多个进程可以共用同一个数据库文件。每个进程以 worker_id 登记并定期发送心跳，
+    任务记录所属的 worker，心跳超时的 worker 留下的任务会被视为中断。
+
+    blob_fields 中的字段（如重绘的原图和遮罩）单独存放在 task_blobs 表中，只在认领或恢复任务时
+    读取，调度排序、排队位置等扫描整个队列的查询不会复制这些大字段。
+    """
+
+    def __init__(self, path, maxsize=0, poll_interval=0.5, retention_seconds=24 * 3600, worker_timeout=30,
+                 model_group_window=0, blob_fields=()):
+        self.path = path
+        self.maxsize = maxsize
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.worker_timeout = worker_timeout
+        # 认领任务时在调度顺序的前 model_group_window 个任务中优先选择与后端已加载模型相同的任务
+        self.model_group_window = model_group_window
+        self.blob_fields = tuple(blob_fields)
+        self.worker_id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition()
+        self._last_purge = 0
+        # isolation_level=None 以便手动使用 BEGIN IMMEDIATE 控制事务
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute('PRAGMA synchronous=NORMAL;')
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "task_id TEXT NOT NULL UNIQUE, "
+            "payload TEXT NOT NULL, "
+            "state TEXT NOT NULL, "
+            "owner TEXT, "
+            "user_id TEXT, "
+            "priority INTEGER NOT NULL DEFAULT 0, "
+            "batch_key TEXT, "
+            "checkpoint TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, "
+            "queued_at REAL, "
+            "claimed_at REAL, "
+            "finished_at REAL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+        for name, ddl in (('owner', 'TEXT'), ('user_id', 'TEXT'), ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+                          ('batch_key', 'TEXT'), ('checkpoint', 'TEXT')):
+            if name not in columns:
+                self._conn.execute(f"ALTER TABLE tasks ADD COLUMN {name} {ddl}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_tasks_state_queued_at ON tasks (state, queued_at, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_tasks_user_claimed_at ON tasks (user_id, claimed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_tasks_user_state ON tasks (user_id, state)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_tasks_batch_key ON tasks (batch_key, state)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS task_blobs (task_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, pid INTEGER, heartbeat_at REAL NOT NULL)"
+        )
+        self.heartbeat()
+
+    def _execute(self, sql, params=()):
+        """执行写语句，返回影响的行数"""
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            cursor.close()
+            return cursor.rowcount
+
+    def _query(self, sql, params=()):
+        # 立即取完所有行，避免未结束的语句持有读快照导致其他连接写入时出现 database is locked
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # ---- 任务 ----
+
+    def _write_task_blobs(self, task):
+        """把 blob_fields 写入 task_blobs（需在事务中调用），返回不含这些字段的任务 JSON"""
+        blobs = {name: task[name] for name in self.blob_fields if task.get(name) is not None}
+        if blobs:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO task_blobs (task_id, data) VALUES (?, ?)",
+                (task['task_id'], json.dumps(blobs, ensure_ascii=False))
+            )
+        elif self.blob_fields:
+            self._conn.execute("DELETE FROM task_blobs WHERE task_id = ?", (task['task_id'],))
+        payload = {name: value for name, value in task.items() if name not in blobs}
+        return json.dumps(payload, ensure_ascii=False)
+
+    def _load_task(self, task_id, payload):
+        """解析任务 JSON 并合并单独存放的大字段（需持有 self._lock）"""
+        task = json.loads(payload)
+        if self.blob_fields:
+            rows = self._conn.execute("SELECT data FROM task_blobs WHERE task_id = ?", (task_id,)).fetchall()
+            if rows:
+                task.update(json.loads(rows[0][0]))
+        return task
+
+    def _pending_count(self):
+        # 预处理中的任务已占用队列名额，入队时不会再因队列已满而失败
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE state IN (?, ?)", (STATE_QUEUED, STATE_PREPROCESSING)
+        ).fetchall()[0][0]
+
+    def add(self, task, state=STATE_PREPROCESSING, max_per_user=0):
+        """登记新任务并占用队列名额，队列已满时抛出 queue.Full；max_per_user > 0 时，该用户未结束的任务
+        已达上限则不登记并返回 False"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if 0 < self.maxsize <= self._pending_count():
+                    raise Full
+                if max_per_user > 0:
+                    active = self._conn.execute(
+                        "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND state != ?", (task.get('user_id'), STATE_DONE)
+                    ).fetchall()[0][0]
+                    if active >= max_per_user:
+                        self._conn.execute('ROLLBACK')
+                        return False
+                payload = self._write_task_blobs(task)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO tasks (task_id, payload, state, owner, user_id, priority, created_at, queued_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (task['task_id'], payload, state, self.worker_id,
+                     task.get('user_id'), task.get('priority', 0), now, now if state == STATE_QUEUED else None)
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return True
+
+    def active_count(self, user_id):
+        """用户未结束（预处理、排队、执行中）的任务数"""
+        return self._query(
+            "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND state != ?", (user_id, STATE_DONE)
+        )[0][0]
+
+    def put_nowait(self, task):
+        """把任务加入队列（已存在的预处理任务会被更新，使用登记时占用的名额），队列已满时抛出 queue.Full"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.maxsize > 0:
+                    rows = self._conn.execute("SELECT state FROM tasks WHERE task_id = ?", (task['task_id'],)).fetchall()
+                    reserved = bool(rows) and rows[0][0] == STATE_PREPROCESSING
+                    if not reserved and self._pending_count() >= self.maxsize:
+                        raise Full
+                payload = self._write_task_blobs(task)
+                self._conn.execute(
+                    "INSERT INTO tasks (task_id, payload, state, user_id, priority, batch_key, checkpoint, "
+                    "created_at, queued_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(task_id) DO UPDATE SET payload = excluded.payload, state = excluded.state, "
+                    "user_id = excluded.user_id, priority = excluded.priority, batch_key = excluded.batch_key, "
+                    "checkpoint = excluded.checkpoint, queued_at = excluded.queued_at",
+                    (task['task_id'], payload, STATE_QUEUED, task.get('user_id'), task.get('priority', 0),
+                     task.get('batch_key'), task.get('checkpoint'), now, now)
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        with self._not_empty:
+            self._not_empty.notify()
+
+    def claim_next(self, prefer_checkpoint=None):
+        """按调度顺序认领下一个任务，没有任务时返回 None
+
+        指定 prefer_checkpoint 时，在调度顺序的前 model_group_window 个任务中优先认领使用该模型的任务，
+        避免后端在不同模型之间来回切换；窗口之外的任务不会被提前，防止其他模型的任务长时间等待。
+        """
+        window = self.model_group_window if prefer_checkpoint else 0
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(f"{SCHEDULED_TASKS} LIMIT ?", (max(window, 1),)).fetchall()
+                row = next((r for r in rows if r[4] == prefer_checkpoint), rows[0] if rows else None)
+                task = None
+                if row:
+                    self._conn.execute(
+                        "UPDATE tasks SET state = ?, owner = ?, attempts = attempts + 1, claimed_at = ? WHERE id = ?",
+                        (STATE_RUNNING, self.worker_id, time.time(), row[0])
+                    )
+                    task = self._load_task(row[1], row[2])
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return task
+
+    def claim_batch(self, batch_key, capacity, size_of):
+        """按调度顺序认领 batch_key 相同的排队任务，直到总大小（由 size_of 计算）达到 capacity
+
+        用于把参数相同的任务合并成一次后端调用，返回认领到的任务列表。
+        """
+        claimed = []
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for row_id, task_id, payload, _, _ in self._conn.execute(SCHEDULED_BATCH_TASKS, (batch_key,)).fetchall():
+                    task = self._load_task(task_id, payload)
+                    size = size_of(task)
+                    if size > capacity:
+                        continue
+                    self._conn.execute(
+                        "UPDATE tasks SET state = ?, owner = ?, attempts = attempts + 1, claimed_at = ? WHERE id = ?",
+                        (STATE_RUNNING, self.worker_id, time.time(), row_id)
+                    )
+                    claimed.append(task)
+                    capacity -= size
+                    if capacity <= 0:
+                        break
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return claimed
+
+    def get(self, block=True, timeout=None, prefer_checkpoint=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            task = self.claim_next(prefer_checkpoint)
+            if task is not None:
+                return task
+            remaining = None if deadline is None else deadline - time.time()
+            if not block or (remaining is not None and remaining <= 0):
+                raise Empty
+            # 同进程内入队会立即唤醒，其他进程写入的任务靠定期轮询发现
+            wait = self.poll_interval if remaining is None else min(remaining, self.poll_interval)
+            with self._not_empty:
+                self._not_empty.wait(timeout=wait)
+
+    def complete(self, task_id):
+        self._execute(
+            "UPDATE tasks SET state = ?, finished_at = ? WHERE task_id = ?", (STATE_DONE, time.time(), task_id)
+        )
+        if self.blob_fields:
+            self._execute("DELETE FROM task_blobs WHERE task_id = ?", (task_id,))
+        if time.time() - self._last_purge > 3600:
+            self.purge_finished()
+
+    def qsize(self):
+        return self._query("SELECT COUNT(*) FROM tasks WHERE state = ?", (STATE_QUEUED,))[0][0]
+
+    def full(self):
+        """排队中和预处理中的任务数已达上限"""
+        with self._lock:
+            return 0 < self.maxsize <= self._pending_count()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def queued_ids(self):
+        """按调度顺序返回排队中的任务"""
+        return [row[1] for row in self._query(SCHEDULED_TASKS)]
+
+    def position(self, task_id):
+        """返回任务按当前调度顺序的位置（从 0 开始），不在队列中时返回 -1"""
+        queued_ids = self.queued_ids()
+        return queued_ids.index(task_id) if task_id in queued_ids else -1
+
+    # ---- worker 心跳 ----
+
+    def heartbeat(self):
+        self._execute(
+            "INSERT OR REPLACE INTO workers (worker_id, pid, heartbeat_at) VALUES (?, ?, ?)",
+            (self.worker_id, os.getpid(), time.time())
+        )
+
+    def start_heartbeat(self, interval=10):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logger.error(f"更新 worker 心跳失败: {str(e)}")
+
+        threading.Thread(target=run, name='task-store-heartbeat', daemon=True).start()
+
+    def unregister(self):
+        """正常退出时注销，留下的任务可以被立即恢复，无需等待心跳超时"""
+        self._execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+
+    def live_workers(self):
+        rows = self._query(
+            "SELECT worker_id FROM workers WHERE heartbeat_at >= ?", (time.time() - self.worker_timeout,)
+        )
+        return {row[0] for row in rows}
+
+    # ---- 恢复与清理 ----
+
+    def recover(self, max_attempts):
+        """把所属 worker 已退出（心跳超时或已注销）的未完成任务放回队列
+
+        返回 (放回队列的任务, 超过重试次数的任务, 需要重新预处理的任务)，重新预处理
+        的任务归属于当前 worker。放回的任务保留原来的入队时间，因此会排在新任务之前。
+        """
+        live_workers = self.live_workers() | {self.worker_id}
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    "SELECT task_id, payload, state, attempts, owner FROM tasks WHERE state IN (?, ?) ORDER BY id",
+                    (STATE_RUNNING, STATE_PREPROCESSING)
+                ).fetchall()
+                requeued, exhausted, preprocessing = [], [], []
+                for task_id, payload, state, attempts, owner in rows:
+                    if owner in live_workers:
+                        continue
+                    task = self._load_task(task_id, payload)
+                    if state == STATE_PREPROCESSING:
+                        self._conn.execute("UPDATE tasks SET owner = ? WHERE task_id = ?", (self.worker_id, task_id))
+                        preprocessing.append(task)
+                    elif attempts < max_attempts:
+                        self._conn.execute("UPDATE tasks SET state = ?, owner = NULL WHERE task_id = ?", (STATE_QUEUED, task_id))
+                        requeued.append(task)
+                    else:
+                        self._conn.execute(
+                            "UPDATE tasks SET state = ?, finished_at = ? WHERE task_id = ?",
+                            (STATE_DONE, time.time(), task_id)
+                        )
+                        self._conn.execute("DELETE FROM task_blobs WHERE task_id = ?", (task_id,))
+                        exhausted.append(task)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return requeued, exhausted, preprocessing
+
+    def purge_finished(self, older_than=None):
+        older_than = self.retention_seconds if older_than is None else older_than
+        self._last_purge = time.time()
+        cutoff = time.time() - older_than
+        removed = self._execute(
+            "DELETE FROM tasks WHERE state = ? AND finished_at < ?", (STATE_DONE, cutoff)
+        )
+        self._execute("DELETE FROM workers WHERE heartbeat_at < ?", (cutoff,))
+        # 已结束任务的大字段在 complete 时删除，这里清理进程中途退出遗留的记录
+        self._execute(
+            "DELETE FROM task_blobs WHERE task_id NOT IN (SELECT task_id FROM tasks WHERE state != ?)", (STATE_DONE,)
+        )
+        if removed:
+            logger.info(f"已清理 {removed} 条过期的任务记录")
+        return removed
@@ -0,0 +1,146 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt):
+    """统一全半角、去掉首尾空白并合并连续空白，使等价的提示词命中同一缓存"""
+    return ' '.join(unicodedata.normalize('NFKC', prompt or '').split())
+
+
+class SQLiteCacheBacking:
+    """TTLCache 的磁盘存储，使缓存在重启后仍然有效；多个缓存通过 namespace 共用一个文件"""
+
+    def __init__(self, path, namespace):
+        self.path = path
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchall()
+        if not rows:
+            return None
+        return json.loads(rows[0][0]), rows[0][1]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key))
+            self._conn.commit()
+
+    def purge_expired(self):
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time())
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+
+class TTLCache:
+    """线程安全的 LRU + TTL 缓存，可选 SQLite 磁盘存储作为二级缓存"""
+
+    def __init__(self, maxsize=1024, ttl=3600, backing=None, name='cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backing = backing
+        self.name = name
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+        if self.backing is not None:
+            try:
+                stored = self.backing.get(key)
+            except Exception as e:
+                logger.error(f"读取缓存 {self.name} 的磁盘存储失败: {str(e)}")
+                stored = None
+            if stored is not None and stored[1] > now:
+                with self._lock:
+                    self._store(key, stored[0], stored[1])
+                    self.hits += 1
+                return stored[0]
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._store(key, value, expires_at)
+        if self.backing is not None:
+            try:
+                self.backing.set(key, value, expires_at)
+            except Exception as e:
+                logger.error(f"写入缓存 {self.name} 的磁盘存储失败: {str(e)}")
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.backing is not None:
+            self.backing.delete(key)
+
+    def _store(self, key, value, expires_at):
+        # 调用方需持有 self._lock
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "name": self.name,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0,
+            }
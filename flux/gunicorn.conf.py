@@ -0,0 +1,29 @@
+# 多进程部署: gunicorn -c gunicorn.conf.py
+# 需要 STATE_BACKEND=sqlite（默认）并设置固定的 FLASK_SECRET_KEY，所有 worker 共享任务队列和状态
+import os
+import sys
+import logging
+
+bind = f"0.0.0.0:{os.getenv('SD_ROUTE_PORT', '25001')}"
+pythonpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api')
+wsgi_app = 'sd_route:app'
+
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# 状态推送（SSE）会长时间占用连接，使用线程 worker；每个推送连接占用一个线程，
+# 每个 worker 最多 SSE_MAX_STREAMS（默认 8）个推送连接，其余线程处理普通请求
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '330'))
+
+# 每个 worker 独立加载应用，各自建立数据库连接，并通过文件锁选出一个主进程分派任务
+preload_app = False
+
+
+def worker_exit(server, worker):
+    # 在 worker 进程退出前排空预处理、正在执行的任务和历史图片写入（最多等待 SHUTDOWN_TIMEOUT_SECONDS 秒）；
+    # 超时后直接退出，不再等待仍在执行的任务，这些任务已注销并由其他 worker 恢复
+    sd_route = sys.modules.get('sd_route')
+    if sd_route is not None and not sd_route.shutdown_dispatcher():
+        logging.shutdown()
+        os._exit(0)
@@ -2,6 +2,8 @@ import { apiRequest } from './api.js';
 
 let currentPage = 1;
 let totalPages = 1;
+let totalImages = null;
+let nextCursor = null;
 const perPage = 10;
 let isDeleteMode = false;
 
@@ -12,6 +14,8 @@ export async function searchImages(loadMore = false) {
     if (!loadMore) {
         // 清除之前的搜索结果和分页信息
         currentPage = 1;
+        nextCursor = null;
+        totalImages = null;
         resultsContainer.innerHTML = '';
         paginationContainer.innerHTML = '';
     }
@@ -25,7 +29,8 @@ export async function searchImages(loadMore = false) {
             keyword, 
             start_date: startDate, 
             end_date: endDate,
-            page: currentPage
+            page: currentPage,
+            cursor: loadMore ? nextCursor : null
             // per_page: perPage
         });
         
@@ -47,7 +52,9 @@ function displayResults(images) {
         card.setAttribute('data-image-id', image.id); // 添加这一行
         card.innerHTML = `
             <div class="image-wrapper">
-                <img src="data:image/jpeg;base64,${image.base64}" alt="Generated Image">
+                <a href="${image.image_url}" target="_blank" rel="noopener">
+                    <img src="${image.thumbnail_url}" alt="Generated Image" loading="lazy">
+                </a>
                 <button class="delete-icon" style="display: ${isDeleteMode ? 'block' : 'none'};">X</button>
             </div>
             <div class="image-info">
@@ -141,16 +148,23 @@ async function deleteImage(imageId) {
 }
 
 function updatePagination(data) {
-    totalPages = data.total_pages;
+    // 总数只在第一页返回
+    if (data.total !== null && data.total !== undefined) {
+        totalImages = data.total;
+        totalPages = data.total_pages;
+    }
+    nextCursor = data.next_cursor;
     const paginationContainer = document.getElementById('pagination');
     paginationContainer.innerHTML = '';
 
     const paginationInfo = document.createElement('div');
     paginationInfo.className = 'pagination-info';
-    paginationInfo.textContent = `第 ${currentPage} 页，共 ${totalPages} 页`;
+    paginationInfo.textContent = totalImages !== null
+        ? `第 ${currentPage} 页，共 ${totalPages} 页（${totalImages} 张）`
+        : `第 ${currentPage} 页`;
     paginationContainer.appendChild(paginationInfo);
 
-    if (currentPage < totalPages) {
+    if (data.has_more && nextCursor) {
         const loadMoreButton = document.createElement('button');
         loadMoreButton.className = 'load-more-button';
         loadMoreButton.textContent = '加载更多';
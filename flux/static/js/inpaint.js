@@ -404,9 +404,66 @@ async function sendMaskedImage(inpaintPrompt, expandSelect) {
     // 发送请求，更新状态但不关闭窗口（因为窗口已经在点击发送按钮时关闭）
     updateStatus("重绘请求已发送，请等待结果...");
 }
+// 处理一次任务状态，任务结束时返回 true
+function handleTaskStatus(taskId, result) {
+    if (result.status === '重绘完成') {
+        console.log('重绘任务完成，处理结果');
+        processTaskResult(result);
+        return true;
+    } else if (result.status.startsWith('重绘失败') || result.status.startsWith('失败')) {
+        console.error('重绘任务失败:', result.error);
+        updateStatus("重绘失败：" + (result.error || result.status));
+        return true;
+    } else if (result.status === '未知任务') {
+        console.warn(`未知任务 ID: ${taskId}`);
+        updateStatus("重绘失败：未知任务");
+        return true;
+    }
+
+    // 更新进度
+    if (result.status.startsWith('排队中')) {
+        updateStatus(`排队中，当前位置：${result.queuePosition + 1}/${result.max_queue_size}`);
+    } else {
+        updateStatus(`重绘处理中：${result.status} (${result.progress}%)`);
+    }
+    return false;
+}
+
+// 优先通过服务器推送等待任务结束，推送不可用或断开时回退到轮询
+function streamTaskStatus(taskId) {
+    return new Promise((resolve) => {
+        if (!window.EventSource) {
+            resolve(false);
+            return;
+        }
+        let finished = false;
+        const source = new EventSource(`${apiUrl}/sd/stream/${taskId}`, { withCredentials: true });
+        source.onmessage = (event) => {
+            if (handleTaskStatus(taskId, JSON.parse(event.data))) {
+                finished = true;
+                source.close();
+                resolve(true);
+            }
+        };
+        // 连接达到服务器设置的最长时间后重新建立
+        source.addEventListener('reconnect', () => {
+            source.close();
+            streamTaskStatus(taskId).then(resolve);
+        });
+        source.onerror = () => {
+            source.close();
+            resolve(finished);
+        };
+    });
+}
+
 async function pollTaskStatus(taskId) {
     const pollInterval = 2000; // 每2秒轮询一次
 
+    if (await streamTaskStatus(taskId)) {
+        return;
+    }
+
     while (true) {
         try {
             const response = await fetch(`${apiUrl}/sd/task_status/${taskId}`);
@@ -416,27 +473,10 @@ async function pollTaskStatus(taskId) {
 
             const result = await response.json();
 
-            if (result.status === '重绘完成') {
-                console.log('重绘任务完成，处理结果');
-                processTaskResult(result);
-                return;
-            } else if (result.status === '重绘失败') {
-                console.error('重绘任务失败:', result.error);
-                updateStatus("重绘失败：" + (result.error || "未知错误"));
-                return;
-            } else if (result.status === '未知任务') {
-                console.warn(`未知任务 ID: ${taskId}`);
-                updateStatus("重绘失败：未知任务");
+            if (handleTaskStatus(taskId, result)) {
                 return;
             }
 
-            // 更新进度
-            if (result.status === '排队中') {
-                updateStatus(`排队中，当前位置：${result.queuePosition + 1}/${result.max_queue_size}`);
-            } else {
-                updateStatus(`重绘处理中：${result.status} (${result.progress}%)`);
-            }
-
             // 等待一段时间后再次轮询
             await new Promise(resolve => setTimeout(resolve, pollInterval));
         } catch (error) {
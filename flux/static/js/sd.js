@@ -9,6 +9,7 @@ const DEBUG_MODE = false;  // 设置为 true 以启用更多日志
 let currentTaskId = null;
 let taskQueue = [];
 let statusCheckInterval = null;
+let statusEventSource = null;
 const taskDisplayStatus = {};
 
 let generateBtn;
@@ -330,8 +331,7 @@ async function generateImages() {
         }
 
         updateDebugLog(`成功接收到任务 ID: ${response.task_id}`);
-        addToQueue(response.task_id, response.queuePosition, response.max_queue_size);
-        await checkStatus(response.task_id);
+        addToQueue(response.task_id, response.queuePosition, response.max_queue_size, response.status);
 
     } catch (error) {
         updateDebugLog(`生成图像时发生错误: ${error.message}`);
@@ -354,11 +354,12 @@ function clearPreviousImages() {
     }
 }
 
-function addToQueue(taskId, queuePosition, maxQueueSize) {
+function addToQueue(taskId, queuePosition, maxQueueSize, status = "排队中") {
     taskQueue.push(taskId);
     taskDisplayStatus[taskId] = false; // 初始化任务显示状态
     createTaskStatusElement(taskId, queuePosition, maxQueueSize);
-    updateStatus("排队中", queuePosition, maxQueueSize);
+    // 任务先经过审核、翻译再进入队列
+    updateStatus(status, queuePosition, maxQueueSize);
     if (!currentTaskId) {
         processNextTask();
     }
@@ -387,31 +388,98 @@ function createTaskStatusElement(taskId, queuePosition, maxQueueSize) {
 }
 
 function startStatusCheck(taskId) {
-    clearInterval(statusCheckInterval);
-    statusCheckInterval = setInterval(() => checkStatus(taskId), 10000);
+    clearTimeout(statusCheckInterval);
+    closeStatusStream();
+
+    if (!window.EventSource) {
+        checkStatus(taskId);
+        return;
+    }
+
+    // 优先使用服务器推送获取任务状态，断开时回退到轮询
+    statusEventSource = new EventSource(`/sd/stream/${taskId}`, { withCredentials: true });
+    statusEventSource.onmessage = (event) => {
+        handleStatusUpdate(taskId, JSON.parse(event.data));
+    };
+    // 连接达到服务器设置的最长时间后重新建立
+    statusEventSource.addEventListener('reconnect', () => {
+        closeStatusStream();
+        if (currentTaskId === taskId) {
+            startStatusCheck(taskId);
+        }
+    });
+    statusEventSource.onerror = () => {
+        closeStatusStream();
+        if (currentTaskId === taskId) {
+            updateDebugLog(`任务 ${taskId} 状态推送断开，改为轮询`);
+            checkStatus(taskId);
+        }
+    };
+}
+
+function closeStatusStream() {
+    if (statusEventSource) {
+        statusEventSource.close();
+        statusEventSource = null;
+    }
+}
+
+function formatProgress(response) {
+    if (response.progress > 0 && response.progress < 100) {
+        const eta = response.eta ? `，剩余约 ${Math.ceil(response.eta)} 秒` : '';
+        return `${response.status} ${response.progress}%${eta}`;
+    }
+    return response.status;
+}
+
+function updateProgressPreview(preview) {
+    let previewImg = document.getElementById('sd-progress-preview');
+    if (!preview) {
+        if (previewImg) previewImg.remove();
+        return;
+    }
+    if (!previewImg) {
+        const container = document.getElementById('sd-result-container');
+        if (!container) return;
+        previewImg = document.createElement('img');
+        previewImg.id = 'sd-progress-preview';
+        previewImg.alt = '生成预览';
+        previewImg.style.maxWidth = '100%';
+        container.appendChild(previewImg);
+    }
+    previewImg.src = preview;
+}
+
+// 处理一次状态更新，任务结束时返回 true
+function handleStatusUpdate(taskId, response) {
+    updateDebugLog(`任务 ${taskId} 状态更新: ${JSON.stringify(response)}`);
+
+    updateTaskElement(taskId, response);
+    // updateStatus(response.status, response.queuePosition, response.max_queue_size);
+    updateStatus(formatProgress(response));
+    updateProgressPreview(response.preview);
+
+    if (response.status === "完成") {
+        if (!taskDisplayStatus[taskId] && response.file_names && response.seeds && response.translated_prompt) {
+            displayImages(taskId, response.file_names, response.seeds, response.translated_prompt);
+            taskDisplayStatus[taskId] = true;
+        }
+        finishCurrentTask();
+        return true;
+    } else if (response.status.startsWith("失败") || response.status === "未知任务") {
+        updateDebugLog(`任务 ${taskId} 失败: ${response.error || response.status}`);
+        updateStatus(`生成失败：${response.error || response.status}`);
+        finishCurrentTask();
+        return true;
+    }
+    return false;
 }
 
 async function checkStatus(taskId) {
     try {
         const response = await apiRequest(`/sd/status/${taskId}`, 'GET');
-        updateDebugLog(`任务 ${taskId} 状态更新: ${JSON.stringify(response)}`);
-
-        updateTaskElement(taskId, response);
-        // updateStatus(response.status, response.queuePosition, response.max_queue_size);
-        updateStatus(response.status);
-
-        if (response.status === "完成" && !taskDisplayStatus[taskId]) {
-            if (response.file_names && response.seeds && response.translated_prompt) {
-                displayImages(taskId, response.file_names, response.seeds, response.translated_prompt);
-                taskDisplayStatus[taskId] = true;
-            }
-            finishCurrentTask();
-        } else if (response.status.startsWith("失败")) {
-            updateDebugLog(`任务 ${taskId} 失败: ${response.error || '未知错误'}`);
-            updateStatus(`生成失败：${response.error || '未知错误'}`);
-            finishCurrentTask();
-        } else if (response.status !== "完成") {
-            setTimeout(() => checkStatus(taskId), 10000);
+        if (!handleStatusUpdate(taskId, response)) {
+            statusCheckInterval = setTimeout(() => checkStatus(taskId), 10000);
         }
     } catch (error) {
         updateDebugLog(`查任务 ${taskId} 状态时出错: ${error.message}`);
@@ -439,6 +507,10 @@ function getStatusMessage(status, queuePosition, maxQueueSize) {
     switch (status) {
         case "排队中":
             return `正在排队，当前位置：${queuePosition + 1}/${maxQueueSize}`;
+        case "审核中":
+            return "正在审核提示词";
+        case "翻译中":
+            return "正在翻译提示词";
         case "处理中":
             return "正在生成图片";
         case "完成":
@@ -449,7 +521,8 @@ function getStatusMessage(status, queuePosition, maxQueueSize) {
 }
 
 function finishCurrentTask() {
-    clearInterval(statusCheckInterval);
+    clearTimeout(statusCheckInterval);
+    closeStatusStream();
     currentTaskId = null;
     processNextTask();
 }
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# 服务代码以 flux/api 为工作目录平铺导入（如 from task_store import TaskStore），测试保持一致
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+
+from backend_pool import BackendPool, SDBackend  # noqa: E402
+
+
+@pytest.fixture
+def make_pool():
+    """按每个后端的并发数创建后端池，后端依次命名为 sd0、sd1……"""
+    def make(*concurrency, **kwargs):
+        return BackendPool([SDBackend(f'http://sd{i}:7860/', c, name=f'sd{i}') for i, c in enumerate(concurrency)],
+                           **kwargs)
+
+    return make
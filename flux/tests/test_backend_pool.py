@@ -0,0 +1,139 @@
+import threading
+
+import pytest
+
+import backend_pool as backend_pool_module
+from backend_pool import BackendPool, checkpoint_name, load_backends
+
+
+def test_requires_at_least_one_backend():
+    with pytest.raises(ValueError):
+        BackendPool([])
+
+
+def test_acquire_spreads_load_and_respects_concurrency(make_pool):
+    pool = make_pool(2, 1)
+    picked = [pool.acquire().name for _ in range(3)]
+    assert sorted(picked) == ['sd0', 'sd0', 'sd1']
+    assert pool.active_count == 3
+    assert pool.acquire() is None
+    assert not pool.has_capacity()
+
+
+def test_release_frees_slot_for_waiting_acquire(make_pool):
+    pool = make_pool(1)
+    backend = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire(timeout=5)))
+    waiter.start()
+    pool.release(backend)
+    waiter.join(timeout=5)
+    assert got == [backend]
+
+
+def test_cancel_does_not_count_as_task(make_pool):
+    pool = make_pool(1)
+    backend = pool.acquire()
+    pool.cancel(backend)
+    assert backend.active == 0
+    assert backend.total_tasks == 0
+    assert backend.healthy
+
+
+def test_failures_mark_backend_unhealthy_until_cooldown(monkeypatch, make_pool):
+    now = {'t': 1000.0}
+    monkeypatch.setattr(backend_pool_module.time, 'time', lambda: now['t'])
+    pool = make_pool(1, 1, failure_threshold=2, cooldown_seconds=60)
+    bad = pool.backends[0]
+    bad.loaded_model = 'model.safetensors'
+    for _ in range(2):
+        first, second = pool.acquire(), pool.acquire()
+        assert first is bad
+        pool.release(bad, success=False, error='timeout')
+        pool.release(second)
+    assert not bad.healthy
+    assert bad.last_error == 'timeout'
+    assert bad.loaded_model is None
+    # 冷却期内只会选择健康的后端
+    assert pool.acquire().name == 'sd1'
+    assert pool.acquire() is None
+    # 冷却期结束后允许再试一次（半开状态）
+    now['t'] += 61
+    assert pool.acquire() is bad
+    pool.release(bad, success=True)
+    assert bad.healthy and bad.consecutive_failures == 0
+
+
+def test_check_health_probes_only_unhealthy_backends(make_pool):
+    pool = make_pool(1, 1, failure_threshold=1)
+    pool.release(pool.acquire(), success=False)
+    probed = []
+
+    def probe(backend):
+        probed.append(backend.name)
+        return True
+
+    pool.check_health(probe)
+    assert probed == ['sd0']
+    assert all(b.healthy for b in pool.backends)
+
+
+def test_failed_probe_extends_cooldown(monkeypatch, make_pool):
+    now = {'t': 1000.0}
+    monkeypatch.setattr(backend_pool_module.time, 'time', lambda: now['t'])
+    pool = make_pool(1, failure_threshold=1, cooldown_seconds=60)
+    backend = pool.acquire()
+    pool.release(backend, success=False)
+    now['t'] += 61
+
+    def probe(backend):
+        raise ConnectionError('refused')
+
+    pool.check_health(probe)
+    assert not backend.healthy
+    assert backend.unhealthy_until == now['t'] + 60
+    assert pool.acquire() is None
+
+
+def test_load_backends_prefers_config(monkeypatch):
+    monkeypatch.setenv('SD_URLS', 'http://env:7860')
+    config = {'sd_backends': [
+        'http://plain:7860/',
+        {'url': 'http://named:7860', 'name': 'gpu1', 'max_concurrency': 3},
+        {'url': 'http://off:7860', 'enabled': False},
+        {'name': 'no-url'},
+    ]}
+    backends = load_backends(config, 'http://default:7860', default_concurrency=2)
+    assert [(b.name, b.url, b.max_concurrency) for b in backends] == [
+        ('http://plain:7860', 'http://plain:7860', 2),
+        ('gpu1', 'http://named:7860', 3),
+    ]
+
+
+def test_load_backends_falls_back_to_sd_urls(monkeypatch):
+    monkeypatch.setenv('SD_URLS', 'http://a:7860, ,http://b:7860 ')
+    backends = load_backends({'sd_backends': [{'url': 'http://off:7860', 'enabled': False}]}, 'http://default:7860')
+    assert [b.url for b in backends] == ['http://a:7860', 'http://b:7860']
+
+
+def test_load_backends_falls_back_to_sd_url(monkeypatch):
+    monkeypatch.delenv('SD_URLS', raising=False)
+    backends = load_backends({}, 'http://default:7860/', default_concurrency=4)
+    assert [(b.url, b.max_concurrency) for b in backends] == [('http://default:7860', 4)]
+
+
+@pytest.mark.parametrize('value', [
+    'flux1-dev-bnb-nf4-v2.safetensors',
+    'flux1-dev-bnb-nf4-v2.safetensors [a1b2c3d4e5]',
+    'flux/flux1-dev-bnb-nf4-v2.safetensors [a1b2c3d4e5]',
+    'models\\flux\\flux1-dev-bnb-nf4-v2.ckpt',
+    'flux1-dev-bnb-nf4-v2',
+    'flux1-dev-bnb-nf4-v2.safetensors<lora:detail:0.7>',
+])
+def test_checkpoint_name_normalizes_webui_titles(value):
+    assert checkpoint_name(value) == 'flux1-dev-bnb-nf4-v2'
+
+
+def test_checkpoint_name_of_unknown_model():
+    assert checkpoint_name(None) == ''
+    assert checkpoint_name('other.safetensors [a1b2c3d4e5]') != checkpoint_name('flux1-dev-bnb-nf4-v2.safetensors')
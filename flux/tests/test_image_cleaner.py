@@ -0,0 +1,115 @@
+import os
+
+import image_cleaner
+from image_cleaner import ImageExpiryIndex, bootstrap_index, delete_expired_images
+
+
+def make_entry(output_dir, name, mtime=None):
+    path = output_dir / name
+    path.mkdir()
+    (path / 'image_0.png').write_bytes(b'png')
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_expired_returns_oldest_first(tmp_path):
+    index = ImageExpiryIndex(str(tmp_path / 'expiry.db'))
+    index.register('b', 100, created_at=1000)
+    index.register('a', 50, created_at=1000)
+    index.register('c', 500, created_at=1000)
+    assert index.expired(10, now=1100) == ['a', 'b']
+    assert index.expired(1, now=1100) == ['a']
+    assert index.expired(10, now=1000) == []
+
+
+def test_register_keeps_first_expiry(tmp_path):
+    index = ImageExpiryIndex(str(tmp_path / 'expiry.db'))
+    index.register('task', 100, created_at=1000)
+    index.register('task', 100, created_at=5000)
+    assert index.expired(10, now=1100) == ['task']
+    index.remove(['task'])
+    assert index.expired(10, now=10 ** 10) == []
+
+
+def test_meta_values_and_increments(tmp_path):
+    path = str(tmp_path / 'expiry.db')
+    index = ImageExpiryIndex(path)
+    index.update_meta({'last_run': 1.5}, {'deleted_total': 2})
+    index.update_meta({}, {'deleted_total': 3})
+    # 多个进程共用同一个数据库文件时读到相同的统计
+    stats = ImageExpiryIndex(path).stats()
+    assert stats['deleted_total'] == 5
+    assert stats['last_run'] == 1.5
+    assert stats['bootstrapped'] is False
+
+
+def test_bootstrap_indexes_existing_entries_once(tmp_path):
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    make_entry(output_dir, 'old', mtime=1000)
+    index = ImageExpiryIndex(str(tmp_path / 'expiry.db'))
+    bootstrap_index(index, str(output_dir), 100)
+    assert index.expired(10, now=1100) == ['old']
+    assert index.stats()['bootstrapped'] is True
+
+    make_entry(output_dir, 'later', mtime=1000)
+    bootstrap_index(index, str(output_dir), 100)
+    assert index.stats()['indexed'] == 1
+
+
+def test_bootstrap_without_output_dir(tmp_path):
+    index = ImageExpiryIndex(str(tmp_path / 'expiry.db'))
+    bootstrap_index(index, str(tmp_path / 'missing'), 100)
+    assert index.stats()['bootstrapped'] is True
+    assert index.stats()['indexed'] == 0
+
+
+def test_delete_expired_images(tmp_path):
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    index = ImageExpiryIndex(str(tmp_path / 'expiry.db'))
+    make_entry(output_dir, 'expired')
+    make_entry(output_dir, 'fresh')
+    (output_dir / 'single.png').write_bytes(b'png')
+    index.register('expired', -10)
+    index.register('single.png', -10)
+    index.register('gone', -10)
+    index.register('fresh', 3600)
+
+    assert delete_expired_images(index, str(output_dir)) == 2
+    assert sorted(os.listdir(output_dir)) == ['fresh']
+    stats = index.stats()
+    assert stats['indexed'] == 1
+    assert stats['deleted_total'] == 2
+    assert stats['missing_total'] == 1
+    assert stats['last_run_deleted'] == 2
+
+
+def test_delete_runs_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_cleaner, 'BATCH_SIZE', 2)
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    index = ImageExpiryIndex(str(tmp_path / 'expiry.db'))
+    for i in range(5):
+        make_entry(output_dir, f'task{i}')
+        index.register(f'task{i}', -10)
+    assert delete_expired_images(index, str(output_dir)) == 5
+    assert os.listdir(output_dir) == []
+    assert index.stats()['indexed'] == 0
+
+
+def test_failed_deletes_stay_indexed(tmp_path, monkeypatch):
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+    index = ImageExpiryIndex(str(tmp_path / 'expiry.db'))
+    make_entry(output_dir, 'locked')
+    index.register('locked', -10)
+
+    def fail(path):
+        raise OSError('permission denied')
+
+    monkeypatch.setattr(image_cleaner.shutil, 'rmtree', fail)
+    assert delete_expired_images(index, str(output_dir)) == 0
+    assert index.expired(10) == ['locked']
+    assert index.stats()['errors_total'] == 1
@@ -0,0 +1,61 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from image_codec import encode_history_images, image_size_from_base64, split_data_url
+
+
+def encode(size=(64, 48), fmt='PNG', mode='RGB'):
+    buffer = io.BytesIO()
+    Image.new(mode, size, (10, 20, 30) if mode == 'RGB' else (10, 20, 30, 128)).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def test_split_data_url():
+    assert split_data_url('data:image/png;base64,iVBORw0KGgo=') == 'iVBORw0KGgo='
+    assert split_data_url('iVBORw0KGgo=') == 'iVBORw0KGgo='
+    assert split_data_url('data:image/png;base64,') == ''
+
+
+def test_split_data_url_rejects_non_base64():
+    with pytest.raises(ValueError):
+        split_data_url('data:image/svg+xml,<svg/>')
+
+
+def test_png_size_from_header_only():
+    png = b64(encode((640, 360)))
+    assert image_size_from_base64(png) == (640, 360)
+    # 只需要文件头：截断到 32 个字符后仍能读出 IHDR 中的宽高
+    assert image_size_from_base64(png[:32]) == (640, 360)
+    assert image_size_from_base64(split_data_url('data:image/png;base64,' + png)) == (640, 360)
+
+
+@pytest.mark.parametrize('fmt', ['JPEG', 'WEBP'])
+def test_other_formats_use_pillow(fmt):
+    assert image_size_from_base64(b64(encode((33, 17), fmt))) == (33, 17)
+
+
+@pytest.mark.parametrize('data', [
+    b64(encode()[:20]),  # PNG 文件头不完整
+    b64(encode(fmt='JPEG')[:40]),
+    b64(b'not an image at all'),
+    'iVBORw0KGgo',  # base64 长度不完整
+    '',
+])
+def test_truncated_or_invalid_input_raises_value_error(data):
+    with pytest.raises(ValueError):
+        image_size_from_base64(data)
+
+
+def test_encode_history_images_drops_alpha_and_thumbnails():
+    jpg, thumb = encode_history_images(encode((512, 256), mode='RGBA'), thumb_size=128)
+    with Image.open(io.BytesIO(jpg)) as img:
+        assert (img.format, img.mode, img.size) == ('JPEG', 'RGB', (512, 256))
+    with Image.open(io.BytesIO(thumb)) as img:
+        assert (img.format, img.size) == ('WEBP', (128, 64))
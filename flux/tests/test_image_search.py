@@ -0,0 +1,65 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from image_search import FTS_TABLE, build_match_expression, detect_fts, ensure_fts
+
+
+def test_terms_within_keyword_are_anded():
+    assert build_match_expression(['red cat'], 'unicode61') == '("red" AND "cat")'
+
+
+def test_keywords_are_ored_and_deduplicated():
+    assert build_match_expression(['red cat', '红色的猫', 'red  cat'], 'trigram') == \
+        '("red" AND "cat") OR ("红色的猫")'
+
+
+def test_quotes_are_escaped():
+    assert build_match_expression(['say "hello"'], 'unicode61') == '("say" AND """hello""")'
+
+
+def test_empty_keywords_return_none():
+    assert build_match_expression(['', '  ', None], 'trigram') is None
+
+
+def test_short_terms_fall_back_with_trigram():
+    assert build_match_expression(['a cat'], 'trigram') is None
+    assert build_match_expression(['猫'], 'trigram') is None
+    assert build_match_expression(['a cat'], 'unicode61') == '("a" AND "cat")'
+
+
+def test_expression_matches_in_sqlite():
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE t USING fts5(prompt, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        pytest.skip('SQLite 不支持 FTS5 trigram 分词器')
+    conn.executemany("INSERT INTO t(rowid, prompt) VALUES (?, ?)",
+                     [(1, 'a red cat on a mat'), (2, '一只红色的猫'), (3, 'blue dog'), (4, 'say "hello" world')])
+
+    def match(keywords):
+        expression = build_match_expression(keywords, 'trigram')
+        return sorted(row[0] for row in conn.execute("SELECT rowid FROM t WHERE t MATCH ?", (expression,)))
+
+    assert match(['red cat']) == [1]
+    assert match(['cat red', '红色的猫']) == [1, 2]
+    assert match(['say "hello"']) == [4]
+
+
+def test_ensure_fts_is_idempotent_and_detectable(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'images.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE image (id INTEGER PRIMARY KEY, prompt TEXT, original_prompt TEXT)"))
+        conn.execute(text("INSERT INTO image (prompt, original_prompt) VALUES ('a red cat', '红色的猫')"))
+    assert detect_fts(engine) is None
+
+    tokenizer = ensure_fts(engine)
+    if tokenizer is None:
+        pytest.skip('SQLite 不支持 FTS5')
+    # 其他进程创建索引后，只做检测即可得到相同的分词器；重复执行 ensure_fts 不会重建索引
+    assert detect_fts(engine) == tokenizer
+    assert ensure_fts(engine) == tokenizer
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH 'cat'")).fetchall()
+    assert [row[0] for row in rows] == [1]
@@ -0,0 +1,83 @@
+import base64
+import io
+import sqlite3
+
+import pytest
+from PIL import Image
+
+from image_store import ImageStore
+from migrate_image_store import migrate
+
+
+def jpeg(color=(200, 100, 50), size=(600, 300)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    # 迁移前的表结构：图片以 base64 保存在 image 表中，没有 image_key 和 thumb_key 列
+    path = str(tmp_path / 'images.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE image (id INTEGER PRIMARY KEY, user_id TEXT, base64 TEXT)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT id, base64, image_key, thumb_key FROM image ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+
+def test_moves_images_and_generates_thumbnails(db_path, tmp_path):
+    data = [jpeg((i * 40, 0, 0)) for i in range(5)]
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO image (id, user_id, base64) VALUES (?, 'u1', ?)",
+                     [(i + 1, base64.b64encode(d).decode()) for i, d in enumerate(data)])
+    conn.commit()
+    conn.close()
+    store = ImageStore(str(tmp_path / 'store'))
+
+    assert migrate(db_path, store, batch_size=2) == (5, 0)
+    for (image_id, b64, image_key, thumb_key), original in zip(rows(db_path), data):
+        assert b64 == ''
+        assert store.get(image_key) == original
+        with Image.open(io.BytesIO(store.get(thumb_key))) as thumb:
+            assert (thumb.format, thumb.size) == ('WEBP', (256, 128))
+    # 重复执行时没有需要迁移的记录
+    assert migrate(db_path, store) == (0, 0)
+
+
+def test_backfills_thumbnails_for_migrated_rows(db_path, tmp_path):
+    store = ImageStore(str(tmp_path / 'store'))
+    migrate(db_path, store)
+    key = store.put(jpeg(), 'jpg')
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO image (id, user_id, base64, image_key) VALUES (1, 'u1', '', ?)", (key,))
+    conn.commit()
+    conn.close()
+
+    assert migrate(db_path, store) == (1, 0)
+    (_, _, image_key, thumb_key), = rows(db_path)
+    assert image_key == key and store.exists(thumb_key)
+
+
+def test_bad_rows_are_kept_for_retry(db_path, tmp_path):
+    store = ImageStore(str(tmp_path / 'store'))
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO image (id, user_id, base64) VALUES (1, 'u1', '!!not base64!!')")
+    conn.execute("INSERT INTO image (id, user_id, base64) VALUES (2, 'u1', ?)",
+                 (base64.b64encode(b'not an image').decode(),))
+    conn.commit()
+    conn.close()
+
+    assert migrate(db_path, store) == (1, 2)
+    first, second = rows(db_path)
+    # 无法解码的记录保留 base64；图片已写入存储但缩略图失败的记录，缩略图留到首次访问时生成
+    assert first[1] == '!!not base64!!' and first[2] is None
+    assert second[1] == '' and store.get(second[2]) == b'not an image' and second[3] is None
@@ -0,0 +1,102 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, bindparam, create_engine, func, select, tuple_
+
+from pagination import (MAX_PER_PAGE, StoredTimestamp, decode_cursor, encode_cursor, parse_page_params,
+                        stored_timestamp, valid_cursor)
+
+
+def test_page_params_defaults_and_clamping():
+    assert parse_page_params({}) == (1, 8)
+    assert parse_page_params({'page': 0, 'per_page': 0}) == (1, 1)
+    assert parse_page_params({'page': -3, 'per_page': -5}) == (1, 1)
+    assert parse_page_params({'page': '2', 'per_page': '20'}) == (2, 20)
+    assert parse_page_params({'per_page': 10000}) == (1, MAX_PER_PAGE)
+
+
+@pytest.mark.parametrize('data', [{'page': 'abc'}, {'per_page': None}, {'page': [1]}, {'per_page': '1.5'}])
+def test_page_params_rejects_non_integers(data):
+    with pytest.raises(ValueError):
+        parse_page_params(data)
+
+
+def test_cursor_round_trip():
+    values = {'created_at': '2024-05-01 12:30:00', 'id': 42}
+    cursor = encode_cursor(values)
+    assert cursor.isascii() and '/' not in cursor and '+' not in cursor
+    assert decode_cursor(cursor) == values
+
+
+@pytest.mark.parametrize('cursor', ['not base64!', encode_cursor('x')[:-2] + '@@', 'bm90IGpzb24='])
+def test_malformed_cursor_fails_to_decode_or_validate(cursor):
+    try:
+        values = decode_cursor(cursor)
+    except Exception:
+        return
+    assert not valid_cursor(values, by_relevance=False)
+    assert not valid_cursor(values, by_relevance=True)
+
+
+def test_time_ordered_cursor_shape():
+    assert valid_cursor({'created_at': '2024-05-01 12:30:00', 'id': 1}, by_relevance=False)
+    assert valid_cursor({'created_at': '2024-05-01 12:30:00.123456', 'id': 1}, by_relevance=False)
+    assert not valid_cursor({'created_at': 'yesterday', 'id': 1}, by_relevance=False)
+    assert not valid_cursor({'created_at': 20240501, 'id': 1}, by_relevance=False)
+    assert not valid_cursor({'created_at': '2024-05-01 12:30:00', 'id': '1'}, by_relevance=False)
+    assert not valid_cursor({'created_at': '2024-05-01 12:30:00', 'id': True}, by_relevance=False)
+    assert not valid_cursor({'id': 1}, by_relevance=False)
+    assert not valid_cursor([1, 2], by_relevance=False)
+
+
+def test_relevance_cursor_shape():
+    assert valid_cursor({'rank': -1.25, 'id': 3}, by_relevance=True)
+    assert valid_cursor({'rank': 0, 'id': 3}, by_relevance=True)
+    assert valid_cursor(decode_cursor(encode_cursor({'rank': -0.1 - 0.2, 'id': 3})), by_relevance=True)
+    assert not valid_cursor({'rank': '-1.25', 'id': 3}, by_relevance=True)
+    assert not valid_cursor({'rank': float('nan'), 'id': 3}, by_relevance=True)
+    assert not valid_cursor({'rank': True, 'id': 3}, by_relevance=True)
+    assert not valid_cursor({'rank': -1.25}, by_relevance=True)
+    # 旧版本的偏移量游标不再接受
+    assert not valid_cursor({'offset': 8}, by_relevance=True)
+
+
+def test_cursor_from_other_ordering_is_rejected():
+    # 切换关键词后沿用旧游标：时间排序的游标不能用于相关度排序，反之亦然
+    assert not valid_cursor({'created_at': '2024-05-01 12:30:00', 'id': 1}, by_relevance=True)
+    assert not valid_cursor({'rank': -1.0, 'id': 1}, by_relevance=False)
+
+
+def test_stored_timestamp_matches_column_text():
+    assert stored_timestamp(datetime(2024, 5, 1, 12, 30, 0)) == '2024-05-01 12:30:00'
+    assert stored_timestamp(datetime(2024, 5, 1, 12, 30, 0, 1500)) == '2024-05-01 12:30:00.001500'
+
+
+def test_keyset_pages_over_mixed_timestamp_formats():
+    # CURRENT_TIMESTAMP 写入的记录不带小数秒，SQLAlchemy 写入的记录带微秒，同一秒内有多条记录
+    engine = create_engine('sqlite://')
+    image = Table('image', MetaData(), Column('id', Integer, primary_key=True),
+                  Column('created_at', DateTime, server_default=func.current_timestamp()))
+    image.create(engine)
+    with engine.begin() as conn:
+        conn.execute(image.insert(), [{'id': i, 'created_at': datetime(2024, 5, 1, 12, 0, i % 3, 250 * (i % 2))}
+                                      for i in range(1, 9)])
+        conn.execute(image.insert(), [{'id': i} for i in range(9, 12)])
+        expected = [row.id for row in conn.execute(select(image.c.id).order_by(image.c.created_at.desc(),
+                                                                               image.c.id.desc()))]
+
+    seen, cursor = [], None
+    with engine.connect() as conn:
+        for _ in range(len(expected) + 1):
+            query = select(image).order_by(image.c.created_at.desc(), image.c.id.desc()).limit(2)
+            if cursor:
+                values = decode_cursor(cursor)
+                cursor_time = bindparam('cursor_created_at', datetime.fromisoformat(values['created_at']),
+                                        type_=StoredTimestamp)
+                query = query.where(tuple_(image.c.created_at, image.c.id) < tuple_(cursor_time, values['id']))
+            rows = conn.execute(query).fetchall()
+            if not rows:
+                break
+            seen.extend(row.id for row in rows)
+            cursor = encode_cursor({'created_at': rows[-1].created_at.isoformat(), 'id': rows[-1].id})
+    assert seen == expected
@@ -0,0 +1,63 @@
+import os
+
+import result_cache as result_cache_module
+from result_cache import ResultCache, result_key
+
+
+def test_result_key_ignores_key_order_and_detects_changes():
+    payload = {'prompt': 'cat', 'seed': 1, 'width': 512, 'override_settings': {'sd_model_checkpoint': 'm'}}
+    reordered = dict(reversed(list(payload.items())))
+    assert result_key(payload) == result_key(reordered)
+    assert result_key(payload) != result_key({**payload, 'seed': 2})
+    assert result_key(payload) != result_key({**payload, 'override_settings': {'sd_model_checkpoint': 'n'}})
+
+
+def test_put_and_get(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1000)
+    key = result_key({'seed': 1})
+    assert cache.get(key) is None
+    cache.put(key, [b'one', b'two'], [11, 12, 13])
+    paths, seeds = cache.get(key)
+    assert seeds == [11, 12]
+    assert [open(path, 'rb').read() for path in paths] == [b'one', b'two']
+    assert cache.stats()['entries'] == 1
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_index_is_shared_between_instances(tmp_path):
+    key = result_key({'seed': 1})
+    ResultCache(str(tmp_path), max_bytes=1000).put(key, [b'data'], [1])
+    assert ResultCache(str(tmp_path), max_bytes=1000).get(key)[1] == [1]
+
+
+def test_missing_files_invalidate_entry(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1000)
+    key = result_key({'seed': 1})
+    cache.put(key, [b'data'], [1])
+    os.remove(cache.get(key)[0][0])
+    assert cache.get(key) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_evicts_least_recently_used_over_limit(tmp_path, monkeypatch):
+    now = {'t': 1000.0}
+    monkeypatch.setattr(result_cache_module.time, 'time', lambda: now['t'])
+    cache = ResultCache(str(tmp_path), max_bytes=10)
+    keys = [result_key({'seed': i}) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        now['t'] += 1
+        cache.put(key, [b'12345'], [i])
+    now['t'] += 1
+    cache.get(keys[0])
+    now['t'] += 1
+    cache.put(keys[2], [b'12345'], [2])
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    assert cache.stats()['bytes'] == 10
+
+
+def test_oversized_result_is_not_cached(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=4)
+    key = result_key({'seed': 1})
+    cache.put(key, [b'12345'], [1])
+    assert cache.get(key) is None
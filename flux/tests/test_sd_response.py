@@ -0,0 +1,86 @@
+import io
+import json
+import base64
+import random
+
+import pytest
+from PIL import Image
+
+from sd_response import SDResponseReader
+
+
+def png_bytes(color=(255, 0, 0), size=(16, 16)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def chunked(text, size):
+    data = text.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def read(text, size=7, **kwargs):
+    return SDResponseReader(chunked(text, size), **kwargs).read()
+
+
+def test_decodes_images_and_keeps_other_fields():
+    images = [png_bytes((255, 0, 0)), png_bytes((0, 255, 0), (20, 10))]
+    body = json.dumps({
+        'images': [base64.b64encode(data).decode() for data in images],
+        'parameters': {'prompt': 'cat', 'init_images': ['x' * 100]},
+        'info': json.dumps({'all_seeds': [1, 2], 'prompt': '猫 "quoted" \\ slash'}),
+    })
+    result = read(body)
+    assert result['images'] == images
+    assert json.loads(result['info'])['all_seeds'] == [1, 2]
+    # parameters 只扫描不解析
+    assert 'parameters' not in result
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 64, 1 << 20])
+def test_chunk_boundaries_do_not_change_result(size):
+    images = [png_bytes((i * 40, 0, 0)) for i in range(3)]
+    body = json.dumps({
+        'parameters': {'nested': [{'a': '}]"'}, [1, 2, {'b': None}]]},
+        'images': ['data:image/png;base64,' + base64.b64encode(data).decode() for data in images],
+        'info': '{"seed": 5}',
+    }, ensure_ascii=False)
+    result = read(body, size)
+    assert result['images'] == images
+    assert result['info'] == '{"seed": 5}'
+
+
+def test_escaped_slashes_and_whitespace():
+    data = bytes(range(256)) * 3
+    encoded = base64.b64encode(data).decode().replace('/', '\\/')
+    body = '{ "images" : [ "' + encoded + '" ] ,\n "info" : "x" }'
+    for size in (1, 4, 9):
+        assert read(body, size) == {'images': [data], 'info': 'x'}
+
+
+def test_random_payloads_match_json_parse():
+    rng = random.Random(0)
+    for _ in range(50):
+        images = [bytes(rng.randrange(256) for _ in range(rng.randrange(0, 300))) for _ in range(rng.randrange(0, 4))]
+        info = {'seed': rng.randrange(10 ** 6), 'text': ''.join(rng.choice('ab"\\/{}[],: 中') for _ in range(20))}
+        body = json.dumps({'info': json.dumps(info), 'images': [base64.b64encode(d).decode() for d in images],
+                           'parameters': info})
+        result = read(body, rng.randrange(1, 40))
+        assert result['images'] == images
+        assert json.loads(result['info']) == info
+
+
+def test_empty_images_and_null_fields():
+    assert read('{"images": [], "info": null}') == {'images': [], 'info': None}
+
+
+@pytest.mark.parametrize('body', [
+    '{"images": ["aGVsbG8=',
+    '{"images": ["aGVsbG8="], "info": "abc',
+    '{"images": ["aGVsbG8="], "parameters": {"a": [1, 2',
+    '["images"]',
+])
+def test_truncated_or_malformed_response_raises(body):
+    with pytest.raises(ValueError):
+        read(body, 3)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import pytest
+
+from state_backend import create_state_backend, file_lock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    return create_state_backend(request.param, str(tmp_path / 'state.db'))
+
+
+def test_revisions_start_at_zero_and_increase(backend):
+    assert backend.get_revision('history:u1') == 0
+    assert backend.bump_revision('history:u1') == 1
+    assert backend.bump_revision('history:u1') == 2
+    assert backend.get_revision('history:u1') == 2
+    assert backend.get_revision('history:u2') == 0
+
+
+def test_revisions_are_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'state.db')
+    writer, reader = create_state_backend('sqlite', path), create_state_backend('sqlite', path)
+    writer.bump_revision('history:u1')
+    assert reader.get_revision('history:u1') == 1
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / 'schema.lock')
+    events = []
+
+    def worker(name):
+        with file_lock(path):
+            events.append(f'{name} start')
+            time.sleep(0.1)
+            events.append(f'{name} end')
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 两次加锁分别打开文件，即使在同一进程中也互斥
+    assert [e.split()[1] for e in events] == ['start', 'end', 'start', 'end']
+
+
+def test_file_lock_is_released_on_error(tmp_path):
+    path = str(tmp_path / 'schema.lock')
+    with pytest.raises(RuntimeError):
+        with file_lock(path):
+            raise RuntimeError('upgrade failed')
+    with file_lock(path):
+        pass
@@ -0,0 +1,119 @@
+import threading
+import time
+from queue import Queue
+
+from task_dispatcher import TaskDispatcher
+from task_store import TaskStore
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('condition not met in time')
+        time.sleep(0.01)
+
+
+def make_dispatcher(task_queue, pool, handler, **kwargs):
+    def run(task, backend):
+        try:
+            handler(task, backend)
+        finally:
+            pool.release(backend)
+
+    return TaskDispatcher(task_queue, pool, run, poll_interval=0.05, **kwargs)
+
+
+def test_dispatches_queued_tasks_to_handler(make_pool):
+    task_queue = Queue()
+    for i in range(5):
+        task_queue.put({'task_id': f't{i}'})
+    done = []
+    dispatcher = make_dispatcher(task_queue, make_pool(1, 1), lambda task, backend: done.append(task['task_id']))
+    dispatcher.start()
+    assert dispatcher.accepting
+    wait_until(lambda: len(done) == 5)
+    dispatcher.shutdown()
+    assert sorted(done) == [f't{i}' for i in range(5)]
+    assert dispatcher.num_workers == 2
+
+
+def test_running_tasks_never_exceed_backend_capacity(make_pool):
+    task_queue = Queue()
+    for i in range(5):
+        task_queue.put({'task_id': f't{i}'})
+    pool = make_pool(2)
+    release = threading.Event()
+    running = []
+    dispatcher = make_dispatcher(task_queue, pool, lambda task, backend: (running.append(task), release.wait(5)))
+    dispatcher.start()
+    wait_until(lambda: len(running) == 2)
+    time.sleep(0.2)
+    # 后端槽位全部占用时，其余任务留在队列中
+    assert len(running) == 2
+    assert task_queue.qsize() == 3
+    release.set()
+    wait_until(lambda: len(running) == 5)
+    dispatcher.shutdown()
+    assert pool.active_count == 0
+
+
+def test_idle_dispatcher_returns_unused_slots(make_pool):
+    pool = make_pool(1)
+    dispatcher = make_dispatcher(Queue(), pool, lambda task, backend: None)
+    dispatcher.start()
+    time.sleep(0.2)
+    dispatcher.shutdown()
+    assert pool.active_count == 0
+    assert pool.backends[0].total_tasks == 0
+
+
+def test_preference_selects_task_for_backend_model(tmp_path, make_pool):
+    store = TaskStore(str(tmp_path / 'tasks.db'), poll_interval=0.05, model_group_window=4)
+    store.put_nowait({'task_id': 'a', 'checkpoint': 'anime'})
+    store.put_nowait({'task_id': 'b', 'checkpoint': 'photo'})
+    pool = make_pool(1)
+    pool.backends[0].loaded_model = 'photo'
+    done = []
+    dispatcher = make_dispatcher(store, pool, lambda task, backend: done.append(task['task_id']),
+                                 preference=lambda backend: {'prefer_checkpoint': backend.loaded_model})
+    dispatcher.start()
+    wait_until(lambda: len(done) == 2)
+    dispatcher.shutdown()
+    assert done == ['b', 'a']
+
+
+def test_dispatch_errors_still_reach_handler(make_pool):
+    task_queue = Queue()
+    task_queue.put({'task_id': 't1'})
+    done = []
+
+    def on_dispatch(task, backend):
+        raise RuntimeError('status store unavailable')
+
+    dispatcher = make_dispatcher(task_queue, make_pool(1), lambda task, backend: done.append(task['task_id']),
+                                 on_dispatch=on_dispatch)
+    dispatcher.start()
+    wait_until(lambda: done == ['t1'])
+    dispatcher.shutdown()
+
+
+def test_shutdown_drains_running_tasks_and_leaves_queue(make_pool):
+    task_queue = Queue()
+    for i in range(3):
+        task_queue.put({'task_id': f't{i}'})
+    started = threading.Event()
+    done = []
+
+    def handler(task, backend):
+        started.set()
+        time.sleep(0.3)
+        done.append(task['task_id'])
+
+    dispatcher = make_dispatcher(task_queue, make_pool(1), handler)
+    dispatcher.start()
+    started.wait(5)
+    dispatcher.shutdown(wait=True)
+    assert not dispatcher.accepting
+    assert done == ['t0']
+    assert task_queue.qsize() == 2
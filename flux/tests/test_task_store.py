@@ -0,0 +1,259 @@
+from queue import Full
+
+import pytest
+
+from task_store import SCHEDULED_BATCH_TASKS, TaskStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'tasks.db')
+
+
+def make_task(task_id, user_id='u1', **fields):
+    return {'task_id': task_id, 'user_id': user_id, **fields}
+
+
+def drain(store, **kwargs):
+    claimed = []
+    while True:
+        task = store.claim_next(**kwargs)
+        if task is None:
+            return claimed
+        claimed.append(task['task_id'])
+
+
+# ---- 持久化与恢复 ----
+
+def test_queue_survives_reopen(db_path):
+    store = TaskStore(db_path)
+    for i in range(3):
+        store.put_nowait(make_task(f't{i}'))
+    reopened = TaskStore(db_path)
+    assert reopened.qsize() == 3
+    assert reopened.queued_ids() == ['t0', 't1', 't2']
+
+
+def test_claim_and_complete(db_path):
+    store = TaskStore(db_path)
+    store.put_nowait(make_task('t1', prompt='cat'))
+    task = store.get(timeout=0.1)
+    assert task == make_task('t1', prompt='cat')
+    assert store.qsize() == 0
+    store.complete('t1')
+    assert store.active_count('u1') == 0
+
+
+def test_recover_requeues_tasks_of_exited_worker(db_path):
+    dead = TaskStore(db_path)
+    for task_id in ('running', 'preprocessing'):
+        dead.add(make_task(task_id))
+    dead.put_nowait(make_task('running'))
+    assert dead.claim_next()['task_id'] == 'running'
+    dead.unregister()
+
+    alive = TaskStore(db_path)
+    alive.put_nowait(make_task('mine'))
+    alive.claim_next()  # 当前 worker 执行中的任务不应被恢复
+
+    requeued, exhausted, preprocessing = alive.recover(max_attempts=3)
+    assert [t['task_id'] for t in requeued] == ['running']
+    assert exhausted == []
+    assert [t['task_id'] for t in preprocessing] == ['preprocessing']
+    assert alive.queued_ids() == ['running']
+    # 重新预处理的任务归属于当前 worker，不会被再次恢复
+    assert alive.recover(max_attempts=3) == ([], [], [])
+
+
+def test_recover_gives_up_after_max_attempts(db_path):
+    dead = TaskStore(db_path)
+    dead.put_nowait(make_task('t1'))
+    dead.claim_next()
+    dead.unregister()
+
+    alive = TaskStore(db_path)
+    requeued, exhausted, _ = alive.recover(max_attempts=1)
+    assert requeued == []
+    assert [t['task_id'] for t in exhausted] == ['t1']
+    assert alive.qsize() == 0
+
+
+def test_recover_skips_workers_with_recent_heartbeat(db_path):
+    other = TaskStore(db_path)
+    other.put_nowait(make_task('t1'))
+    other.claim_next()
+
+    alive = TaskStore(db_path)
+    assert alive.recover(max_attempts=3) == ([], [], [])
+
+
+# ---- 公平调度 ----
+
+def test_round_robin_across_users(db_path):
+    store = TaskStore(db_path)
+    for task_id in ('a1', 'a2', 'a3'):
+        store.put_nowait(make_task(task_id, 'A'))
+    store.put_nowait(make_task('b1', 'B'))
+    store.put_nowait(make_task('c1', 'C'))
+    assert store.queued_ids() == ['a1', 'b1', 'c1', 'a2', 'a3']
+    assert store.position('b1') == 1
+    assert store.position('missing') == -1
+    assert drain(store) == ['a1', 'b1', 'c1', 'a2', 'a3']
+
+
+def test_higher_priority_runs_first(db_path):
+    store = TaskStore(db_path)
+    store.put_nowait(make_task('low1', 'A', priority=0))
+    store.put_nowait(make_task('low2', 'A', priority=0))
+    store.put_nowait(make_task('high', 'B', priority=2))
+    assert drain(store) == ['high', 'low1', 'low2']
+
+
+def test_least_recently_served_user_goes_first(db_path):
+    store = TaskStore(db_path)
+    store.put_nowait(make_task('a1', 'A'))
+    assert store.claim_next()['task_id'] == 'a1'
+    # a2 先入队，但用户 A 刚被服务过，B 优先
+    store.put_nowait(make_task('a2', 'A'))
+    store.put_nowait(make_task('b1', 'B'))
+    assert store.queued_ids() == ['b1', 'a2']
+
+
+def test_add_enforces_max_per_user(db_path):
+    store = TaskStore(db_path)
+    assert store.add(make_task('a1', 'A'), max_per_user=2)
+    assert store.add(make_task('a2', 'A'), max_per_user=2)
+    assert not store.add(make_task('a3', 'A'), max_per_user=2)
+    # 其他用户不受影响
+    assert store.add(make_task('b1', 'B'), max_per_user=2)
+    assert store.active_count('A') == 2
+
+    store.complete('a1')
+    assert store.add(make_task('a3', 'A'), max_per_user=2)
+    # 不限制时总是登记
+    assert store.add(make_task('a4', 'A'), max_per_user=0)
+
+
+# ---- 合并生成 ----
+
+def test_claim_batch_collects_matching_tasks_up_to_capacity(db_path):
+    store = TaskStore(db_path)
+    store.put_nowait(make_task('k1', 'A', batch_key='k', num_images=2))
+    store.put_nowait(make_task('other', 'A', batch_key='x', num_images=1))
+    store.put_nowait(make_task('k2', 'B', batch_key='k', num_images=3))
+    store.put_nowait(make_task('k3', 'C', batch_key='k', num_images=1))
+    store.put_nowait(make_task('k4', 'D', batch_key='k', num_images=1))
+
+    claimed = store.claim_batch('k', 3, lambda task: task['num_images'])
+    # k2 超出剩余容量被跳过，按调度顺序继续认领更小的任务
+    assert [t['task_id'] for t in claimed] == ['k1', 'k3']
+    # 用户 A、C 刚被服务过，排在尚未被服务的 B、D 之后
+    assert store.queued_ids() == ['k2', 'k4', 'other']
+
+
+def test_claim_batch_without_matches(db_path):
+    store = TaskStore(db_path)
+    store.put_nowait(make_task('t1', batch_key='a'))
+    assert store.claim_batch('b', 4, lambda task: 1) == []
+    assert store.claim_batch('a', 0, lambda task: 1) == []
+    assert store.qsize() == 1
+
+
+def test_claim_batch_only_loads_matching_rows(db_path):
+    store = TaskStore(db_path)
+    store.put_nowait(make_task('k1', batch_key='k', num_images=1))
+    store.put_nowait(make_task('other', batch_key='x', num_images=1))
+    sizes = []
+    store.claim_batch('k', 4, lambda task: sizes.append(task['task_id']) or 1)
+    assert sizes == ['k1']
+    plan = ' '.join(row[3] for row in store._query(f"EXPLAIN QUERY PLAN {SCHEDULED_BATCH_TASKS}", ('k',)))
+    assert 'ix_tasks_batch_key' in plan
+
+
+# ---- 大字段单独存放 ----
+
+def test_blob_fields_are_kept_out_of_payload(db_path):
+    store = TaskStore(db_path, blob_fields=('image', 'mask'))
+    task = make_task('t1', image='A' * 1000, mask='B' * 1000, prompt='cat')
+    store.add(task)
+    store.put_nowait(task)
+    payload = store._query("SELECT payload FROM tasks WHERE task_id = 't1'")[0][0]
+    assert 'AAAA' not in payload and 'BBBB' not in payload
+    assert store.claim_next() == task
+    store.complete('t1')
+    assert store._query("SELECT COUNT(*) FROM task_blobs")[0][0] == 0
+
+
+def test_blob_fields_survive_recovery(db_path):
+    dead = TaskStore(db_path, blob_fields=('image',))
+    dead.add(make_task('pre', image='data:pre'))
+    dead.put_nowait(make_task('run', image='data:run'))
+    dead.claim_next()
+    dead.unregister()
+
+    alive = TaskStore(db_path, blob_fields=('image',))
+    requeued, _, preprocessing = alive.recover(max_attempts=3)
+    assert requeued == [make_task('run', image='data:run')]
+    assert preprocessing == [make_task('pre', image='data:pre')]
+    assert alive.claim_next()['image'] == 'data:run'
+
+
+def test_purge_removes_orphan_blobs(db_path):
+    store = TaskStore(db_path, blob_fields=('image',))
+    store.put_nowait(make_task('done', image='x'))
+    store.put_nowait(make_task('queued', image='y'))
+    store._execute("UPDATE tasks SET state = 'done', finished_at = 0 WHERE task_id = 'done'")
+    store.purge_finished(older_than=0)
+    assert [row[0] for row in store._query("SELECT task_id FROM task_blobs")] == ['queued']
+
+
+# ---- 按已加载模型选择任务 ----
+
+def test_prefer_checkpoint_within_window(db_path):
+    store = TaskStore(db_path, model_group_window=3)
+    store.put_nowait(make_task('a', 'A', checkpoint='m1'))
+    store.put_nowait(make_task('b', 'B', checkpoint='m2'))
+    store.put_nowait(make_task('c', 'C', checkpoint='m1'))
+    store.put_nowait(make_task('d', 'D', checkpoint='m2'))
+    assert store.claim_next(prefer_checkpoint='m2')['task_id'] == 'b'
+    # 没有匹配的任务时按调度顺序认领
+    assert store.claim_next(prefer_checkpoint='m3')['task_id'] == 'a'
+
+
+def test_prefer_checkpoint_does_not_reach_past_window(db_path):
+    store = TaskStore(db_path, model_group_window=2)
+    for i, checkpoint in enumerate(['m1', 'm1', 'm2']):
+        store.put_nowait(make_task(f't{i}', f'U{i}', checkpoint=checkpoint))
+    assert store.claim_next(prefer_checkpoint='m2')['task_id'] == 't0'
+
+
+def test_window_zero_keeps_scheduling_order(db_path):
+    store = TaskStore(db_path, model_group_window=0)
+    store.put_nowait(make_task('a', 'A', checkpoint='m1'))
+    store.put_nowait(make_task('b', 'B', checkpoint='m2'))
+    assert drain(store, prefer_checkpoint='m2') == ['a', 'b']
+
+
+# ---- 队列容量 ----
+
+def test_preprocessing_tasks_reserve_capacity(db_path):
+    store = TaskStore(db_path, maxsize=2)
+    store.add(make_task('p1'))
+    store.put_nowait(make_task('q1'))
+    assert store.full()
+    with pytest.raises(Full):
+        store.add(make_task('p2'))
+    with pytest.raises(Full):
+        store.put_nowait(make_task('q2'))
+    # 已登记的预处理任务使用自己占用的名额入队
+    store.put_nowait(make_task('p1'))
+    assert store.qsize() == 2
+
+
+def test_capacity_is_released_when_tasks_start(db_path):
+    store = TaskStore(db_path, maxsize=1)
+    store.add(make_task('t1'))
+    store.put_nowait(make_task('t1'))
+    store.claim_next()
+    assert not store.full()
+    store.add(make_task('t2'))
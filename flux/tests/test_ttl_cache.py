@@ -0,0 +1,73 @@
+import types
+
+import pytest
+
+import ttl_cache
+from ttl_cache import TTLCache, SQLiteCacheBacking, normalize_prompt
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = {'t': 1000.0}
+    monkeypatch.setattr(ttl_cache, 'time', types.SimpleNamespace(time=lambda: now['t']))
+    return now
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set('k', 'v')
+    clock['t'] += 59
+    assert cache.get('k') == 'v'
+    clock['t'] += 1
+    assert cache.get('k') is None
+    assert cache.get('k', 'default') == 'default'
+    assert len(cache) == 0
+
+
+def test_per_entry_ttl_overrides_default(clock):
+    cache = TTLCache(maxsize=10, ttl=3600)
+    cache.set('short', 1, ttl=5)
+    clock['t'] += 6
+    assert cache.get('short') is None
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 3 and stats['misses'] == 1
+
+
+def test_delete(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set('k', 'v')
+    cache.delete('k')
+    assert cache.get('k') is None
+
+
+def test_backing_survives_restart_and_respects_expiry(tmp_path, clock):
+    path = str(tmp_path / 'cache.db')
+    cache = TTLCache(maxsize=10, ttl=60, backing=SQLiteCacheBacking(path, 'translation'))
+    cache.set('k', ['猫', 1])
+
+    restarted = TTLCache(maxsize=10, ttl=60, backing=SQLiteCacheBacking(path, 'translation'))
+    assert restarted.get('k') == ['猫', 1]
+    # 不同 namespace 互不影响
+    other = TTLCache(maxsize=10, ttl=60, backing=SQLiteCacheBacking(path, 'moderation'))
+    assert other.get('k') is None
+
+    clock['t'] += 61
+    fresh = TTLCache(maxsize=10, ttl=60, backing=SQLiteCacheBacking(path, 'translation'))
+    assert fresh.get('k') is None
+    assert fresh.backing.purge_expired() == 1
+
+
+def test_normalize_prompt():
+    assert normalize_prompt('  ａ  cat\n\tdog ') == 'a cat dog'
+    assert normalize_prompt(None) == ''
@@ -3,11 +3,18 @@ from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta, timezone
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urlencode
 import secrets
 import logging
 from dotenv import load_dotenv
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from sqlalchemy import text
 
 # 加载环境变量
 load_dotenv()
@@ -19,7 +26,7 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
 # 数据库配置
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///oauth_sessions.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('OAUTH_DATABASE_URI', 'sqlite:///oauth_sessions.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
@@ -32,30 +39,249 @@ TOKEN_ENDPOINT = os.getenv('OAUTH_TOKEN_ENDPOINT')
 USER_ENDPOINT = os.getenv('OAUTH_USER_ENDPOINT')
 PROGRAM_SERVICE_URL = os.getenv('PROGRAM_SERVICE_URL')
 
+# 请求 OAuth 提供方的连接超时、读取超时和失败重试次数
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+OAUTH_REQUEST_TIMEOUT = float(os.getenv('OAUTH_REQUEST_TIMEOUT', '15'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.5'))
+
+def create_session():
+    """请求 OAuth 提供方的 HTTP 会话，复用连接
+
+    认证服务以 oauth/ 为构建目录单独部署，无法引用 flux/api 中的同名函数，重试策略也按这里的两类请求设置：
+    令牌交换和刷新是 POST，授权码只能使用一次，提供方返回 5xx 时可能已经消费了授权码，重试只会得到
+    invalid_grant，因此 POST 只在连接失败（请求尚未发出）时重试；获取用户信息的 GET 在 502/503/504
+    或读取失败时也会重试。
+    """
+    retry = Retry(total=HTTP_MAX_RETRIES, connect=HTTP_MAX_RETRIES, read=HTTP_MAX_RETRIES, status=HTTP_MAX_RETRIES,
+                  backoff_factor=HTTP_RETRY_BACKOFF, status_forcelist=(502, 503, 504),
+                  allowed_methods=frozenset(['GET']), raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+oauth_session = create_session()
+OAUTH_TIMEOUT = (HTTP_CONNECT_TIMEOUT, OAUTH_REQUEST_TIMEOUT)
+
+# 未完成的登录状态和临时令牌的有效秒数，以及后台清理的间隔秒数和每批删除的行数
+OAUTH_STATE_TTL = int(os.getenv('OAUTH_STATE_TTL', '600'))
+TEMP_TOKEN_TTL = int(os.getenv('TEMP_TOKEN_TTL', '300'))
+REAPER_INTERVAL = int(os.getenv('REAPER_INTERVAL', '300'))
+REAPER_BATCH_SIZE = int(os.getenv('REAPER_BATCH_SIZE', '500'))
+
+# 用户会话缓存的条目数上限和最长缓存秒数（不会超过访问令牌自身的过期时间）
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '1024'))
+SESSION_CACHE_TTL = int(os.getenv('SESSION_CACHE_TTL', '300'))
+# 多进程部署时检查其他进程是否使会话失效（登出、刷新、重新登录）的间隔秒数，0 表示每次命中缓存都检查
+SESSION_REVISION_CHECK_INTERVAL = float(os.getenv('SESSION_REVISION_CHECK_INTERVAL', '1'))
+
+def hash_token(token):
+    """令牌以 SHA-256 哈希建立索引和查询"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest() if token else None
+
+def utc_now():
+    return datetime.now(timezone.utc)
+
+def as_utc(value):
+    """SQLite 读出的时间不带时区，统一视为 UTC"""
+    if value is None:
+        return None
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+class SessionCache:
+    """按访问令牌哈希缓存解码后的用户会话，令牌刷新、重新登录或登出时删除对应条目
+
+    缓存只在本进程内有效。其他进程使会话失效时会递增数据库中的版本号，sync 发现版本号变化后清空缓存。
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revision = None
+        self.checked_at = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sync(self, revision):
+        with self._lock:
+            if revision != self.revision:
+                self._data.clear()
+                self.revision = revision
+            self.checked_at = time.time()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, expires_at):
+        expires_at = min(expires_at, time.time() + self.ttl)
+        if self.maxsize <= 0 or expires_at <= time.time():
+            return
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        if key:
+            with self._lock:
+                self._data.pop(key, None)
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
 # 模型定义
 class OAuthState(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     state = db.Column(db.String(50), unique=True, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=utc_now, index=True)
 
 class UserSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(100), unique=True, nullable=False)
     access_token = db.Column(db.String(500), nullable=False)
+    access_token_hash = db.Column(db.String(64), index=True)
     refresh_token = db.Column(db.String(500))
+    refresh_token_hash = db.Column(db.String(64), index=True)
     token_expiry = db.Column(db.DateTime, nullable=False)
     user_info = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-    updated_at = db.Column(db.DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=utc_now)
+    updated_at = db.Column(db.DateTime, default=utc_now, onupdate=utc_now)
+
+    def set_tokens(self, access_token, refresh_token, expires_in):
+        self.access_token = access_token
+        self.access_token_hash = hash_token(access_token)
+        self.refresh_token = refresh_token
+        self.refresh_token_hash = hash_token(refresh_token)
+        self.token_expiry = utc_now() + timedelta(seconds=expires_in)
+
+    def snapshot(self):
+        """会话的只读副本，user_info 已解码，token_expiry 带 UTC 时区"""
+        return {
+            "user_id": self.user_id,
+            "user_info": json.loads(self.user_info) if self.user_info else None,
+            "access_token": self.access_token,
+            "refresh_token": self.refresh_token,
+            "token_expiry": as_utc(self.token_expiry)
+        }
+
+class SessionRevision(db.Model):
+    # 只有一行，会话失效时递增，供各进程判断本地缓存是否过期
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.Integer, nullable=False, default=0)
 
 class TempToken(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     token = db.Column(db.String(100), unique=True, nullable=False)
     user_id = db.Column(db.String(100), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=utc_now, index=True)
+
+def upgrade_schema():
+    """为旧数据库补充令牌哈希列、各表索引和会话版本号，并回填已有会话的哈希"""
+    columns = {row[1] for row in db.session.execute(text("PRAGMA table_info(user_session)"))}
+    for column in ('access_token_hash', 'refresh_token_hash'):
+        if column not in columns:
+            db.session.execute(text(f"ALTER TABLE user_session ADD COLUMN {column} VARCHAR(64)"))
+            db.session.execute(text(f"CREATE INDEX IF NOT EXISTS ix_user_session_{column} ON user_session ({column})"))
+            logger.info(f"已为 user_session 表添加列 {column}")
+    for table in ('o_auth_state', 'temp_token'):
+        db.session.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_created_at ON {table} (created_at)"))
+    pending = UserSession.query.filter(UserSession.access_token_hash.is_(None)).all()
+    for user_session in pending:
+        user_session.access_token_hash = hash_token(user_session.access_token)
+        user_session.refresh_token_hash = hash_token(user_session.refresh_token)
+    # 多个进程可能同时执行到这里，先查询再插入会因主键冲突失败
+    db.session.execute(text("INSERT OR IGNORE INTO session_revision (id, revision) VALUES (1, 0)"))
+    db.session.commit()
+    if pending:
+        logger.info(f"已回填 {len(pending)} 个用户会话的令牌哈希")
+
+def invalidate_session(user_session):
+    """使会话的缓存失效：删除本进程的缓存条目，并递增版本号通知其他进程，随会话的修改一起提交"""
+    session_cache.delete(user_session.access_token_hash)
+    SessionRevision.query.filter_by(id=1).update({SessionRevision.revision: SessionRevision.revision + 1})
+
+def sync_session_cache():
+    # 每 SESSION_REVISION_CHECK_INTERVAL 秒最多读取一次版本号
+    if time.time() - session_cache.checked_at < SESSION_REVISION_CHECK_INTERVAL:
+        return
+    session_cache.sync(db.session.query(SessionRevision.revision).filter_by(id=1).scalar())
+
+def find_session_by_access_token(access_token):
+    """按访问令牌查找用户会话快照，命中缓存时通常不访问数据库；未找到时返回 None"""
+    sync_session_cache()
+    key = hash_token(access_token)
+    snapshot = session_cache.get(key)
+    if snapshot is not None:
+        return snapshot
+    user_session = UserSession.query.filter_by(access_token_hash=key).first()
+    if not user_session:
+        return None
+    snapshot = user_session.snapshot()
+    session_cache.set(key, snapshot, snapshot["token_expiry"].timestamp())
+    return snapshot
+
+def is_expired(created_at, ttl):
+    return created_at is None or as_utc(created_at) < utc_now() - timedelta(seconds=ttl)
+
+# 后台清理的累计结果，由 /health 返回
+reaper_stats = {"runs": 0, "last_run": None, "oauth_states_deleted": 0, "temp_tokens_deleted": 0}
+
+def delete_expired(model, ttl):
+    """按批删除 created_at 早于 ttl 的行，每批单独提交，避免长时间持有写锁；返回删除的行数"""
+    cutoff = utc_now() - timedelta(seconds=ttl)
+    deleted = 0
+    while True:
+        ids = [row.id for row in model.query.with_entities(model.id)
+               .filter(model.created_at < cutoff).limit(REAPER_BATCH_SIZE).all()]
+        if not ids:
+            break
+        deleted += model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        if len(ids) < REAPER_BATCH_SIZE:
+            break
+    return deleted
+
+def reap_expired_rows():
+    while True:
+        try:
+            with app.app_context():
+                states = delete_expired(OAuthState, OAUTH_STATE_TTL)
+                tokens = delete_expired(TempToken, TEMP_TOKEN_TTL)
+            reaper_stats["runs"] += 1
+            reaper_stats["last_run"] = utc_now().isoformat()
+            reaper_stats["oauth_states_deleted"] += states
+            reaper_stats["temp_tokens_deleted"] += tokens
+            if states or tokens:
+                logger.info(f"已清理过期的OAuth状态 {states} 个、临时令牌 {tokens} 个")
+        except Exception as e:
+            logger.error(f"清理过期的OAuth状态和临时令牌失败: {str(e)}")
+        time.sleep(REAPER_INTERVAL)
+
+def start_reaper():
+    reaper_thread = threading.Thread(target=reap_expired_rows, name='oauth-reaper', daemon=True)
+    reaper_thread.start()
+    logger.info(f"启动过期数据清理线程，每 {REAPER_INTERVAL} 秒清理一次，"
+                f"OAuth状态保留 {OAUTH_STATE_TTL} 秒，临时令牌保留 {TEMP_TOKEN_TTL} 秒")
 
 with app.app_context():
     db.create_all()
+    upgrade_schema()
+
+start_reaper()
 
 @app.route('/oauth/authorize')
 def authorize():
@@ -86,18 +312,26 @@ def callback():
     if not db_state:
         logger.warning(f"收到无效的state: {state}")
         return jsonify({"error": "Invalid state"}), 400
+    state_expired = is_expired(db_state.created_at, OAUTH_STATE_TTL)
     db.session.delete(db_state)
     db.session.commit()
+    if state_expired:
+        logger.warning(f"state已过期: {state}")
+        return jsonify({"error": "State expired"}), 400
     logger.info(f"验证并删除state: {state}")
 
     logger.info(f"开始请求访问令牌")
-    token_response = requests.post(TOKEN_ENDPOINT, data={
-        'grant_type': 'authorization_code',
-        'code': code,
-        'redirect_uri': REDIRECT_URI,
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    })
+    try:
+        token_response = oauth_session.post(TOKEN_ENDPOINT, data={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': REDIRECT_URI,
+            'client_id': CLIENT_ID,
+            'client_secret': CLIENT_SECRET
+        }, timeout=OAUTH_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error(f"请求访问令牌失败: {str(e)}")
+        return jsonify({"error": "Failed to obtain access token"}), 400
 
     if token_response.status_code != 200:
         logger.error(f"获取访问令牌失败。状态码: {token_response.status_code}，响应: {token_response.text}")
@@ -111,7 +345,12 @@ def callback():
     expires_in = token_data.get('expires_in', 3600)
 
     logger.info(f"开始获取用户信息")
-    user_response = requests.get(USER_ENDPOINT, headers={'Authorization': f"Bearer {access_token}"})
+    try:
+        user_response = oauth_session.get(USER_ENDPOINT, headers={'Authorization': f"Bearer {access_token}"},
+                                          timeout=OAUTH_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error(f"请求用户信息失败: {str(e)}")
+        return jsonify({"error": "Failed to obtain user info"}), 400
     
     if user_response.status_code != 200:
         logger.error(f"获取用户信息失败。状态码: {user_response.status_code}，响应: {user_response.text}")
@@ -124,19 +363,13 @@ def callback():
     user_session = UserSession.query.filter_by(user_id=user_id).first()
     if user_session:
         logger.info(f"更新现有用户会话，用户ID: {user_id}")
-        user_session.access_token = access_token
-        user_session.refresh_token = refresh_token
-        user_session.token_expiry = datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+        invalidate_session(user_session)
+        user_session.set_tokens(access_token, refresh_token, expires_in)
         user_session.user_info = json.dumps(user_info)
     else:
         logger.info(f"创建新用户会话，用户ID: {user_id}")
-        user_session = UserSession(
-            user_id=user_id,
-            access_token=access_token,
-            refresh_token=refresh_token,
-            token_expiry=datetime.now(timezone.utc) + timedelta(seconds=expires_in),
-            user_info=json.dumps(user_info)
-        )
+        user_session = UserSession(user_id=user_id, user_info=json.dumps(user_info))
+        user_session.set_tokens(access_token, refresh_token, expires_in)
         db.session.add(user_session)
     
     db.session.commit()
@@ -161,42 +394,45 @@ def get_user_info():
         logger.warning("未提供令牌")
         return jsonify({"error": "No token provided"}), 400
 
-    user_id = None
     if temp_token:
         # 处理临时令牌
         token_record = TempToken.query.filter_by(token=temp_token).first()
         if token_record:
             user_id = token_record.user_id
-            logger.info(f"临时令牌有效，用户ID: {user_id}")
+            token_expired = is_expired(token_record.created_at, TEMP_TOKEN_TTL)
             db.session.delete(token_record)
             db.session.commit()
             logger.info(f"临时令牌已删除，用户ID: {user_id}")
+            if token_expired:
+                logger.warning(f"临时令牌已过期，用户ID: {user_id}")
+                return jsonify({"error": "Temporary token expired"}), 400
+            logger.info(f"临时令牌有效，用户ID: {user_id}")
         else:
             logger.warning(f"无效的临时令牌: {temp_token}")
             return jsonify({"error": "Invalid temporary token"}), 400
-    elif access_token:
+
+        user_session = UserSession.query.filter_by(user_id=user_id).first()
+        if not user_session:
+            logger.error(f"未找到用户会话，用户ID: {user_id}")
+            return jsonify({"error": "User session not found"}), 404
+        snapshot = user_session.snapshot()
+    else:
         # 处理访问令牌
-        user_session = UserSession.query.filter_by(access_token=access_token).first()
-        if user_session:
-            if user_session.token_expiry < datetime.now(timezone.utc):
-                logger.warning(f"访问令牌已过期，用户ID: {user_session.user_id}")
-                return jsonify({"error": "Access token expired"}), 401
-            user_id = user_session.user_id
-        else:
+        snapshot = find_session_by_access_token(access_token)
+        if not snapshot:
             logger.warning(f"无效的访问令牌")
             return jsonify({"error": "Invalid access token"}), 401
-
-    user_session = UserSession.query.filter_by(user_id=user_id).first()
-    if not user_session:
-        logger.error(f"未找到用户会话，用户ID: {user_id}")
-        return jsonify({"error": "User session not found"}), 404
+        user_id = snapshot["user_id"]
+        if snapshot["token_expiry"] < datetime.now(timezone.utc):
+            logger.warning(f"访问令牌已过期，用户ID: {user_id}")
+            return jsonify({"error": "Access token expired"}), 401
 
     logger.info(f"返回用户信息，用户ID: {user_id}")
     return jsonify({
-        "user_info": json.loads(user_session.user_info),
-        "access_token": user_session.access_token,
-        "refresh_token": user_session.refresh_token,
-        "token_expiry": user_session.token_expiry.isoformat()
+        "user_info": snapshot["user_info"],
+        "access_token": snapshot["access_token"],
+        "refresh_token": snapshot["refresh_token"],
+        "token_expiry": snapshot["token_expiry"].isoformat()
     })
 
 @app.route('/oauth/refresh', methods=['POST'])
@@ -207,12 +443,16 @@ def refresh_token():
         return jsonify({"error": "No refresh token provided"}), 400
 
     logger.info(f"开始刷新令牌")
-    token_response = requests.post(TOKEN_ENDPOINT, data={
-        'grant_type': 'refresh_token',
-        'refresh_token': refresh_token,
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
-    })
+    try:
+        token_response = oauth_session.post(TOKEN_ENDPOINT, data={
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'client_id': CLIENT_ID,
+            'client_secret': CLIENT_SECRET
+        }, timeout=OAUTH_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error(f"请求刷新令牌失败: {str(e)}")
+        return jsonify({"error": "Failed to refresh token"}), 400
 
     if token_response.status_code != 200:
         logger.error(f"刷新令牌失败。状态码: {token_response.status_code}，响应: {token_response.text}")
@@ -221,11 +461,12 @@ def refresh_token():
     new_token_data = token_response.json()
     logger.info(f"成功刷新令牌，新的有效期: {new_token_data.get('expires_in')} 秒")
 
-    user_session = UserSession.query.filter_by(refresh_token=refresh_token).first()
+    user_session = UserSession.query.filter_by(refresh_token_hash=hash_token(refresh_token)).first()
     if user_session:
-        user_session.access_token = new_token_data['access_token']
-        user_session.refresh_token = new_token_data.get('refresh_token', refresh_token)
-        user_session.token_expiry = datetime.now(timezone.utc) + timedelta(seconds=new_token_data.get('expires_in', 3600))
+        # 旧访问令牌的缓存立即失效
+        invalidate_session(user_session)
+        user_session.set_tokens(new_token_data['access_token'], new_token_data.get('refresh_token', refresh_token),
+                                new_token_data.get('expires_in', 3600))
         db.session.commit()
         logger.info(f"用户会话已更新，用户ID: {user_session.user_id}")
     else:
@@ -243,6 +484,7 @@ def logout():
 
     user_session = UserSession.query.filter_by(user_id=user_id).first()
     if user_session:
+        invalidate_session(user_session)
         db.session.delete(user_session)
         db.session.commit()
         logger.info(f"用户已登出，用户ID: {user_id}")
@@ -254,7 +496,7 @@ def logout():
 @app.route('/health')
 def health_check():
     logger.info("健康检查请求")
-    return jsonify({"status": "healthy"}), 200
+    return jsonify({"status": "healthy", "reaper": reaper_stats}), 200
 
 @app.route('/oauth/verify', methods=['POST'])
 def verify_token():
@@ -263,21 +505,20 @@ def verify_token():
         logger.warning("未提供访问令牌")
         return jsonify({"error": "No access token provided"}), 400
 
-    user_session = UserSession.query.filter_by(access_token=access_token).first()
-    if not user_session:
+    snapshot = find_session_by_access_token(access_token)
+    if not snapshot:
         logger.warning(f"未找到与访问令牌关联的用户会话")
         return jsonify({"error": "Invalid access token"}), 401
 
-    # 确保 token_expiry 是带时区信息的
-    token_expiry = user_session.token_expiry.replace(tzinfo=timezone.utc)
+    token_expiry = snapshot["token_expiry"]
     if token_expiry < datetime.now(timezone.utc):
-        logger.warning(f"访问令牌已过期，用户ID: {user_session.user_id}")
+        logger.warning(f"访问令牌已过期，用户ID: {snapshot['user_id']}")
         return jsonify({"error": "Access token expired"}), 401
 
-    logger.info(f"访问令牌验证成功，用户ID: {user_session.user_id}")
+    logger.info(f"访问令牌验证成功，用户ID: {snapshot['user_id']}")
     return jsonify({
-        "user_id": user_session.user_id,
-        "user_info": json.loads(user_session.user_info),
+        "user_id": snapshot["user_id"],
+        "user_info": snapshot["user_info"],
         "token_expiry": token_expiry.isoformat()
     })
 
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# 认证服务以 oauth/api 为工作目录运行，测试同样平铺导入 auth_service；导入时会建表，需先指向临时数据库
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+os.environ.setdefault('OAUTH_DATABASE_URI', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'oauth_sessions.db'))
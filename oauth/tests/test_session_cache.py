@@ -0,0 +1,121 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+import auth_service
+from auth_service import SessionCache, SessionRevision, UserSession, app, db, hash_token, utc_now
+
+
+@pytest.fixture
+def ctx(monkeypatch):
+    cache = SessionCache(maxsize=8, ttl=300)
+    monkeypatch.setattr(auth_service, 'session_cache', cache)
+    monkeypatch.setattr(auth_service, 'SESSION_REVISION_CHECK_INTERVAL', 0)
+    with app.app_context():
+        yield cache
+        db.session.rollback()
+        UserSession.query.delete()
+        db.session.commit()
+
+
+def add_session(user_id, access_token):
+    user_session = UserSession(user_id=user_id, user_info='{"id": "%s"}' % user_id)
+    user_session.set_tokens(access_token, f'refresh-{access_token}', 3600)
+    db.session.add(user_session)
+    db.session.commit()
+    return user_session
+
+
+def revision():
+    return db.session.query(SessionRevision.revision).filter_by(id=1).scalar()
+
+
+# ---- SessionCache ----
+
+def test_cache_evicts_least_recently_used():
+    cache = SessionCache(maxsize=2, ttl=300)
+    expires_at = time.time() + 60
+    cache.set('a', 1, expires_at)
+    cache.set('b', 2, expires_at)
+    assert cache.get('a') == 1
+    cache.set('c', 3, expires_at)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+
+def test_cache_expiry_is_capped_by_ttl():
+    cache = SessionCache(maxsize=2, ttl=0.05)
+    cache.set('a', 1, time.time() + 3600)
+    cache.set('expired', 2, time.time() - 1)
+    assert cache.get('a') == 1
+    assert cache.get('expired') is None
+    time.sleep(0.1)
+    assert cache.get('a') is None
+
+
+def test_sync_clears_cache_only_when_revision_changes():
+    cache = SessionCache(maxsize=2, ttl=300)
+    cache.sync(1)
+    cache.set('a', 1, time.time() + 60)
+    cache.sync(1)
+    assert cache.get('a') == 1
+    cache.sync(2)
+    assert cache.get('a') is None
+
+
+# ---- 按令牌哈希查找 ----
+
+def test_lookup_by_token_hash_is_cached(ctx):
+    add_session('u1', 'token-1')
+    snapshot = auth_service.find_session_by_access_token('token-1')
+    assert snapshot['user_id'] == 'u1' and snapshot['user_info'] == {'id': 'u1'}
+    assert auth_service.find_session_by_access_token('token-1') == snapshot
+    assert (ctx.hits, ctx.misses) == (1, 1)
+    assert auth_service.find_session_by_access_token('unknown') is None
+    assert UserSession.query.filter_by(access_token_hash=hash_token('token-1')).count() == 1
+
+
+def test_invalidate_session_bumps_revision(ctx):
+    user_session = add_session('u1', 'token-1')
+    auth_service.find_session_by_access_token('token-1')
+    before = revision()
+    auth_service.invalidate_session(user_session)
+    user_session.set_tokens('token-2', 'refresh-2', 3600)
+    db.session.commit()
+    assert revision() == before + 1
+    assert auth_service.find_session_by_access_token('token-1') is None
+    assert auth_service.find_session_by_access_token('token-2')['user_id'] == 'u1'
+
+
+def test_revision_change_from_another_process_clears_cache(ctx):
+    user_session = add_session('u1', 'token-1')
+    auth_service.find_session_by_access_token('token-1')
+    # 模拟其他进程：直接修改令牌并递增版本号，不经过本进程的缓存
+    user_session.token_expiry = utc_now() - timedelta(seconds=1)
+    SessionRevision.query.filter_by(id=1).update({SessionRevision.revision: SessionRevision.revision + 1})
+    db.session.commit()
+    snapshot = auth_service.find_session_by_access_token('token-1')
+    assert snapshot['token_expiry'] < utc_now()
+    assert ctx.misses == 2
+
+
+# ---- 数据库升级 ----
+
+def test_upgrade_schema_keeps_existing_revision(ctx):
+    SessionRevision.query.filter_by(id=1).update({SessionRevision.revision: 5})
+    db.session.commit()
+    # 另一个进程已插入版本号行时不会因主键冲突失败，也不会重置版本号
+    auth_service.upgrade_schema()
+    auth_service.upgrade_schema()
+    assert SessionRevision.query.count() == 1
+    assert revision() == 5
+
+
+def test_upgrade_schema_backfills_token_hashes(ctx):
+    db.session.add(UserSession(user_id='old', access_token='legacy', refresh_token='legacy-refresh',
+                               token_expiry=utc_now() + timedelta(hours=1)))
+    db.session.commit()
+    auth_service.upgrade_schema()
+    assert auth_service.find_session_by_access_token('legacy')['user_id'] == 'old'
+    assert UserSession.query.filter_by(refresh_token_hash=hash_token('legacy-refresh')).count() == 1